@@ -0,0 +1,19 @@
+#!/bin/bash
+
+# Fails if importing the law task modules takes longer than the budget of
+# scripts/BenchmarkImports.py or pulls in modules that are only needed on first use.
+# Further arguments are passed on, e.g. --budget or --runs.
+
+SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
+
+echo "⏱  Measuring the import time of the task modules ..."
+
+if python3 "$SCRIPT_DIR/../scripts/BenchmarkImports.py" "$@"; then
+    echo "✨ Task modules import within the budget!"
+    exit 0
+else
+    echo "------------------------------------------------------"
+    echo "❌ ERROR: Importing the task modules is too slow or imports deferred modules."
+    echo "------------------------------------------------------"
+    exit 1
+fi
@@ -1,60 +1,592 @@
 import os
 import json
 import time
-import fcntl
 import atexit
+import sqlite3
 import law
+import glob
 import hashlib
-from threading import Lock
-from law.util import no_value, flatten
+import re
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, RLock, Thread, local
+from types import MappingProxyType
+from law.util import no_value
 from law.logger import get_logger
 
 logger = get_logger("custom.caching")
 
 law.contrib.load("wlcg")
 
-CACHE_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/target_exists_cache.json'
+CACHE_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/target_exists_cache.sqlite'
+# Whole-file JSON cache used by earlier versions, imported once into the SQLite store
+LEGACY_CACHE_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/target_exists_cache.json'
+# One database per (storage base, production_tag) shard, see register_cache_shard()
+CACHE_SHARD_DIR = f'{os.getenv("LAW_HOME", "/tmp")}/target_exists_cache'
+# If this environment variable is set, the statistics are also written as JSON to this directory
+CACHE_STATS_ENV = "KINGMAKER_CACHE_STATS"
+CACHE_STATS_DIR = f'{os.getenv("LAW_HOME", "/tmp")}/cache_stats'
 
+# Serializes writers (flushes); readers never take it
 CACHE_LOCK = Lock()
 
+# Entries written by this process that may not be part of the snapshot yet
 _TARGET_CACHE = {}
-_TARGET_CACHE_MTIME = 0
 
 MAX_CACHE_ENTRY_AGE = 7 * 86400
 FLUSH_BATCH_SIZE = 25
 FLUSH_INTERVAL = 5.0
+PRUNE_INTERVAL = 3600.0
+# Oldest entries beyond this many are dropped from a shard when it is pruned
+MAX_SHARD_ENTRIES = 2000000
+REFRESH_INTERVAL = 5.0
+# Directory listings and negative results go stale quickly while a production runs
+LISTING_TTL = 300
+# Collections missing at most this many targets in a directory re-check them one by one
+# instead of listing the directory
+PARTIAL_RECHECK_LIMIT = 50
+# exists_many() lists a directory instead of stat'ing its targets from this many targets on
+EXISTS_MANY_LIST_THRESHOLD = 8
+EXISTS_MANY_WORKERS = 16
+# Tree indexes (see use_tree_index()) confirm existing targets for this long after the walk,
+# targets they do not list are checked through the listing cache
+TREE_INDEX_TTL = 6 * 3600
+TREE_INDEX_WORKERS = 32
+# Layout of the completion bitmaps, entries with another version are ignored
+BITMAP_VERSION = 1
+# The in-process copies below keep at most this many entries, the least recently used are
+# dropped first and read from the store again if needed
+MAX_CACHED_LISTINGS = 10000
+MAX_CACHED_BITMAPS = 10000
+MAX_CACHED_NEGATIVES = 100000
 
 _PENDING_UPDATES = {}
 _PENDING_LOCK = Lock()
 _LAST_FLUSH_TIME = 0
 
+# Immutable key -> ts view of the store. The refresher thread builds a new mapping and
+# rebinds the global, so readers always see a consistent snapshot without locking.
+_SNAPSHOT = MappingProxyType({})
+# newest write time seen per shard database
+_SNAPSHOT_UPDATED = {}
+_SNAPSHOT_PRUNE_TIME = 0
+_REFRESHER = None
+_REFRESHER_LOCK = Lock()
 
-def _load_json(path):
-    if not os.path.exists(path):
-        return {}
-    try:
-        with open(path, "r") as f:
-            return json.load(f)
-    except Exception:
-        return {}
 
+class _LRUCache:
+    """
+    Thread-safe mapping that keeps the *maxsize* most recently used entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._entries.pop(key, default)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# In-process copies of listings ({dir: (ts, basenames)}), completion bitmaps
+# ({collection key: bitmap entry, see _TargetCacheStore.get_bitmap}) and targets last
+# found missing ({key: ts})
+_LISTINGS = _LRUCache(MAX_CACHED_LISTINGS)
+_BITMAPS = _LRUCache(MAX_CACHED_BITMAPS)
+_NEGATIVE_CACHE = _LRUCache(MAX_CACHED_NEGATIVES)
+# Recursive listings of whole production tags ({root: (ts, {dir: basenames})})
+_TREE_INDEXES = {}
+_TREE_INDEX_LOCK = Lock()
+# (file system, production_tag) pairs for which use_tree_index() was called
+_INDEXED_TAGS = set()
+
+
+class _ThreadStats:
+    """
+    Counters of one thread, dropped together with the thread-local storage when it ends.
+    """
+
+    __slots__ = ("counts", "timings", "__weakref__")
+
+    def __init__(self):
+        self.counts = {}
+        self.timings = {}
+
+
+class _CacheStats:
+    """
+    Counters and timers of the existence cache, broken down by target class.
+
+    Every thread updates its own dicts, so counting takes no lock on the hot path.
+    The per-thread dicts are only merged when the statistics are read, or when their thread
+    ends, so short-lived threads do not accumulate.
+    """
+
+    def __init__(self):
+        self._local = local()
+        # the counters of a thread may be merged by the garbage collector in any thread
+        self._lock = RLock()
+        self._all = {}
+        self._finished = ({}, {})
+
+    def _own(self):
+        own = getattr(self._local, "stats", None)
+        if own is None:
+            own = _ThreadStats()
+            self._local.stats = own
+            token = object()
+            with self._lock:
+                self._all[token] = (own.counts, own.timings)
+            weakref.finalize(own, self._finish, token)
+        return own
+
+    def _finish(self, token):
+        with self._lock:
+            counts, timings = self._all.pop(token)
+            finished_counts, finished_timings = self._finished
+            for key, n in counts.items():
+                finished_counts[key] = finished_counts.get(key, 0) + n
+            for key, (n, total, longest) in timings.items():
+                n_0, total_0, longest_0 = finished_timings.get(key, (0, 0.0, 0.0))
+                finished_timings[key] = (
+                    n_0 + n,
+                    total_0 + total,
+                    max(longest_0, longest),
+                )
+
+    def count(self, kind, event, n=1):
+        counts = self._own().counts
+        counts[(kind, event)] = counts.get((kind, event), 0) + n
+
+    def timing(self, kind, event, seconds):
+        timings = self._own().timings
+        n, total, longest = timings.get((kind, event), (0, 0.0, 0.0))
+        timings[(kind, event)] = (n + 1, total + seconds, max(longest, seconds))
+
+    def collect(self):
+        result = {}
+        with self._lock:
+            own_stats = [
+                (dict(counts), dict(timings))
+                for counts, timings in [self._finished] + list(self._all.values())
+            ]
+        for counts, timings in own_stats:
+            for (kind, event), n in counts.items():
+                events = result.setdefault(kind, {})
+                events[event] = events.get(event, 0) + n
+            for (kind, event), (n, total, longest) in timings.items():
+                events = result.setdefault(kind, {})
+                timing = events.setdefault(
+                    event, {"count": 0, "total": 0.0, "max": 0.0}
+                )
+                timing["count"] += n
+                timing["total"] += total
+                timing["max"] = max(timing["max"], longest)
+        return result
+
+
+_STATS = _CacheStats()
+
+
+class _TargetCacheStore:
+    """
+    Existence cache backed by a SQLite database in WAL mode.
+
+    Entries are upserted by key and expired with a delete on the indexed timestamp,
+    so a flush only touches the updated rows and a lookup is a single index query.
+    WAL mode lets any number of law processes read while one of them writes.
+    """
+
+    # Each entry upgrades the schema by one version, tracked in PRAGMA user_version
+    _MIGRATIONS = [
+        [
+            "CREATE TABLE IF NOT EXISTS targets (key TEXT PRIMARY KEY, ts REAL NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS targets_ts ON targets (ts)",
+        ],
+        [
+            # time of the write, lets readers fetch only rows changed since their last refresh
+            "ALTER TABLE targets ADD COLUMN updated REAL NOT NULL DEFAULT 0",
+            "CREATE INDEX IF NOT EXISTS targets_updated ON targets (updated)",
+        ],
+        [
+            # directory listings (JSON list of basenames), also recording absent files
+            "CREATE TABLE IF NOT EXISTS listings "
+            "(dir TEXT PRIMARY KEY, ts REAL NOT NULL, names TEXT NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS listings_ts ON listings (ts)",
+            # one bit per target of a collection, set once the target was seen
+            "CREATE TABLE IF NOT EXISTS collections "
+            "(key TEXT PRIMARY KEY, ts REAL NOT NULL, size INTEGER NOT NULL, bitmap BLOB NOT NULL)",
+            "CREATE INDEX IF NOT EXISTS collections_ts ON collections (ts)",
+        ],
+        [
+            # roots of recursive listings, the listings below a root that are at least as new
+            # as its ts form a complete index of the tree
+            "CREATE TABLE IF NOT EXISTS tree_indexes (root TEXT PRIMARY KEY, ts REAL NOT NULL)",
+        ],
+        [
+            # layout of the bitmap (BITMAP_VERSION), existing rows have the first one
+            "ALTER TABLE collections ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        ],
+    ]
+
+    def __init__(self, path, legacy_path=None):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.last_prune = 0
+        self._local = local()
+        self._schema_lock = Lock()
+        self._schema_ready = False
+
+    def _connect(self):
+        # sqlite connections must not be shared between threads or forked processes
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with self._schema_lock:
+            if not self._schema_ready:
+                self._create_schema(conn)
+                self._schema_ready = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _create_schema(self, conn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for statements in self._MIGRATIONS[version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {len(self._MIGRATIONS)}")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if self.legacy_path is None:
+            return
+        if conn.execute("SELECT 1 FROM targets LIMIT 1").fetchone() is None:
+            self._import_legacy_json(conn)
+
+    def _import_legacy_json(self, conn):
+        if not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, "r") as f:
+                legacy = json.load(f)
+        except Exception:
+            return
+        cutoff = time.time() - MAX_CACHE_ENTRY_AGE
+        now = time.time()
+        rows = [
+            (k, v["ts"], now)
+            for k, v in legacy.items()
+            if not k.startswith("collection_") and v.get("ts", 0) >= cutoff
+        ]
+        self._executemany(conn, self._UPSERT_TARGET, rows)
+        logger.info(f"Imported {len(rows)} entries from {self.legacy_path}")
+        try:
+            os.replace(self.legacy_path, f"{self.legacy_path}.imported")
+        except OSError:
+            pass
+
+    _UPSERT_TARGET = (
+        "INSERT INTO targets (key, ts, updated) VALUES (?, ?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET ts = excluded.ts, updated = excluded.updated"
+    )
+
+    def _executemany(self, conn, statement, rows):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(statement, rows)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _read(self, statement, params=()):
+        try:
+            return self._connect().execute(statement, params).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Reading {self.path} failed: {e}")
+            return []
+
+    def _write(self, statement, rows):
+        try:
+            self._executemany(self._connect(), statement, rows)
+        except sqlite3.Error as e:
+            logger.warning(f"Writing {len(rows)} rows to {self.path} failed: {e}")
+
+    def get_ts(self, key):
+        rows = self._read("SELECT ts FROM targets WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def updated_since(self, since):
+        """
+        Return the ``{key: ts}`` entries written at or after *since* and the newest write time.
+        """
+        rows = self._read(
+            "SELECT key, ts, updated FROM targets WHERE updated >= ?", (since,)
+        )
+        newest = max((row[2] for row in rows), default=since)
+        return {row[0]: row[1] for row in rows}, newest
+
+    def put_many(self, entries):
+        now = time.time()
+        self._write(
+            self._UPSERT_TARGET, [(k, v["ts"], now) for k, v in entries.items()]
+        )
+
+    def get_listing(self, directory):
+        rows = self._read("SELECT ts, names FROM listings WHERE dir = ?", (directory,))
+        if not rows:
+            return None
+        return rows[0][0], frozenset(json.loads(rows[0][1]))
+
+    def put_listing(self, directory, ts, names):
+        self._write(
+            "INSERT OR REPLACE INTO listings (dir, ts, names) VALUES (?, ?, ?)",
+            [(directory, ts, json.dumps(sorted(names)))],
+        )
+
+    def get_bitmap(self, key):
+        """
+        Return the bitmap entry of the collection *key* as a dict with its layout "version",
+        the time the first bit was set "ts", the number of targets "size" and the "bitmap".
+        """
+        rows = self._read(
+            "SELECT version, ts, size, bitmap FROM collections WHERE key = ?", (key,)
+        )
+        if not rows:
+            return None
+        return dict(zip(("version", "ts", "size", "bitmap"), rows[0]))
+
+    def put_bitmap(self, key, ts, size, bitmap):
+        self._write(
+            "INSERT OR REPLACE INTO collections (key, version, ts, size, bitmap) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(key, BITMAP_VERSION, ts, size, bytes(bitmap))],
+        )
+
+    def get_tree_index(self, root):
+        rows = self._read("SELECT ts FROM tree_indexes WHERE root = ?", (root,))
+        if not rows:
+            return None
+        ts = rows[0][0]
+        listings = self._read(
+            "SELECT dir, names FROM listings "
+            "WHERE (dir = ? OR (dir >= ? AND dir < ?)) AND ts >= ?",
+            (root, root + "/", root + "0", ts),
+        )
+        return ts, {d: frozenset(json.loads(names)) for d, names in listings}
 
-def _save_json_atomic(path, data):
-    tmp = f"{path}.tmp.{os.getpid()}"
-    with open(tmp, "w") as f:
-        json.dump(data, f)
-    os.replace(tmp, path)
+    def put_tree_index(self, root, ts, listings):
+        self._write(
+            "INSERT OR REPLACE INTO listings (dir, ts, names) VALUES (?, ?, ?)",
+            [(d, ts, json.dumps(sorted(names))) for d, names in listings.items()],
+        )
+        self._write(
+            "INSERT OR REPLACE INTO tree_indexes (root, ts) VALUES (?, ?)", [(root, ts)]
+        )
 
+    def delete_many(self, keys):
+        self._write("DELETE FROM targets WHERE key = ?", [(k,) for k in keys])
 
-def _prune_expired_entries(cache, cutoff_time):
-    expired_keys = [k for k, v in cache.items() if v.get("ts", 0) < cutoff_time]
-    for k in expired_keys:
-        del cache[k]
-    return cache
+    def all_targets(self):
+        return dict(self._read("SELECT key, ts FROM targets"))
+
+    def summary(self):
+        """
+        Return the number of rows and the oldest and newest timestamp of every table.
+        """
+        result = {}
+        for table in ("targets", "listings", "collections"):
+            rows = self._read(f"SELECT COUNT(*), MIN(ts), MAX(ts) FROM {table}")
+            result[table] = rows[0] if rows else (0, None, None)
+        return result
+
+    def prune(self, cutoff_time, max_entries=None):
+        try:
+            conn = self._connect()
+            for table in ("targets", "listings", "collections", "tree_indexes"):
+                conn.execute(f"DELETE FROM {table} WHERE ts < ?", (cutoff_time,))
+            if max_entries is not None:
+                conn.execute(
+                    "DELETE FROM targets WHERE key IN "
+                    "(SELECT key FROM targets ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+                    (max_entries,),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"Pruning {self.path} failed: {e}")
+
+
+class _ShardedTargetCacheStore:
+    """
+    Routes cache operations to one _TargetCacheStore per registered shard.
+
+    A shard covers all keys below a URI prefix, i.e. a production_tag on one storage base.
+    Keys are routed to the shard with the longest matching prefix and to the default store
+    if there is none, so concurrent productions write to separate databases that can be
+    pruned and dropped independently.
+    """
+
+    def __init__(self, default, shard_dir):
+        self.default = default
+        self.shard_dir = shard_dir
+        # (prefix, store) pairs, longest prefix first
+        self._shards = []
+        self._lock = Lock()
+
+    def register(self, prefix, name):
+        with self._lock:
+            if any(p == prefix for p, _ in self._shards):
+                return
+            store = _TargetCacheStore(os.path.join(self.shard_dir, f"{name}.sqlite"))
+            shards = self._shards + [(prefix, store)]
+            self._shards = sorted(shards, key=lambda shard: -len(shard[0]))
+
+    def stores(self):
+        return [self.default] + [store for _, store in self._shards]
+
+    def route(self, key):
+        for prefix, store in self._shards:
+            if key.startswith(prefix):
+                return store
+        return self.default
+
+    def get_ts(self, key):
+        return self.route(key).get_ts(key)
+
+    def updated_since(self, since):
+        """
+        Return the ``{key: ts}`` entries of all shards written at or after the per-shard times
+        in the ``{path: time}`` dict *since*, and the updated dict.
+        """
+        rows, newest = {}, dict(since)
+        for store in self.stores():
+            # overlap by a second, a row committed with the same timestamp may have been missed
+            store_since = since.get(store.path, 0)
+            store_rows, store_newest = store.updated_since(max(store_since - 1.0, 0))
+            newest[store.path] = max(store_since, store_newest)
+            rows.update(store_rows)
+        return rows, newest
+
+    def put_many(self, entries):
+        by_store = {}
+        for key, value in entries.items():
+            by_store.setdefault(self.route(key), {})[key] = value
+        for store, store_entries in by_store.items():
+            store.put_many(store_entries)
+
+    def get_listing(self, directory):
+        return self.route(directory).get_listing(directory)
+
+    def put_listing(self, directory, ts, names):
+        self.route(directory).put_listing(directory, ts, names)
+
+    # the root of a tree index is the shard prefix without the trailing slash
+    def get_tree_index(self, root):
+        return self.route(root + "/").get_tree_index(root)
+
+    def put_tree_index(self, root, ts, listings):
+        self.route(root + "/").put_tree_index(root, ts, listings)
+
+    # collection keys are hashes, they are routed by the key of one of their targets
+    def get_bitmap(self, key, route_key):
+        return self.route(route_key).get_bitmap(key)
+
+    def put_bitmap(self, key, route_key, ts, size, bitmap):
+        self.route(route_key).put_bitmap(key, ts, size, bitmap)
+
+
+_STORE = _ShardedTargetCacheStore(
+    _TargetCacheStore(CACHE_PATH, legacy_path=LEGACY_CACHE_PATH), CACHE_SHARD_DIR
+)
+# (file system, production_tag) pairs already registered by this process
+_REGISTERED_SHARDS = set()
+
+
+def _shard_name(tag, prefix):
+    return f"{tag.strip('/').replace('/', '__')}@{hashlib.sha256(prefix.encode()).hexdigest()[:12]}"
+
+
+def register_cache_shard(fs, tag):
+    """
+    Store the cache entries of all targets below *tag* on the file system *fs* in a separate
+    shard database.
+
+    :param fs: The (WLCG) file system the targets are stored on.
+    :param tag: The production_tag, i.e. the top-level directory of the targets.
+    """
+    if (fs, tag) in _REGISTERED_SHARDS:
+        return
+    prefix = fs.uri(tag).rstrip("/") + "/"
+    _STORE.register(prefix, _shard_name(tag, prefix))
+    _REGISTERED_SHARDS.add((fs, tag))
+
+
+def _shard_pattern(tag=None):
+    if tag is None:
+        return "*@*.sqlite"
+    return f"{glob.escape(tag.strip('/').replace('/', '__'))}@*.sqlite"
+
+
+def cache_stores(tag=None):
+    """
+    Open the default database and all shard databases found on disk, or only the shards of *tag*.
+
+    :param tag: The production_tag to select, or None for all databases.
+    :return: A list of `_TargetCacheStore` objects.
+    """
+    paths = sorted(
+        glob.glob(os.path.join(glob.escape(CACHE_SHARD_DIR), _shard_pattern(tag)))
+    )
+    if tag is None and os.path.exists(CACHE_PATH):
+        paths.insert(0, CACHE_PATH)
+    return [_TargetCacheStore(path) for path in paths]
+
+
+def drop_cache_shard(tag):
+    """
+    Delete the shard databases of *tag* on all storage bases, e.g. once a production is finished.
+
+    :param tag: The production_tag of the shards.
+    :return: The list of deleted files.
+    """
+    deleted = []
+    pattern = _shard_pattern(tag) + "*"
+    for path in glob.glob(os.path.join(glob.escape(CACHE_SHARD_DIR), pattern)):
+        os.remove(path)
+        deleted.append(path)
+    return deleted
 
 
 def _flush_pending_locked():
-    global _LAST_FLUSH_TIME, _TARGET_CACHE
+    global _LAST_FLUSH_TIME
 
     with _PENDING_LOCK:
         if not _PENDING_UPDATES:
@@ -62,23 +594,16 @@ def _flush_pending_locked():
         pending_copy = dict(_PENDING_UPDATES)
         _PENDING_UPDATES.clear()
 
-    cache_dir = os.path.dirname(CACHE_PATH)
-    if cache_dir and not os.path.exists(cache_dir):
-        os.makedirs(cache_dir, exist_ok=True)
-
-    lock_path = CACHE_PATH + ".lock"
-    with open(lock_path, "a") as lock_file:
-        fcntl.flock(lock_file, fcntl.LOCK_EX)
-        try:
-            cache = _load_json(CACHE_PATH)
-            cache.update(pending_copy)
-            cutoff = time.time() - MAX_CACHE_ENTRY_AGE
-            cache = _prune_expired_entries(cache, cutoff)
-            _save_json_atomic(CACHE_PATH, cache)
-            _TARGET_CACHE = cache
-            _LAST_FLUSH_TIME = time.time()
-        finally:
-            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    start = time.perf_counter()
+    _STORE.put_many(pending_copy)
+    _STATS.timing("store", "flush", time.perf_counter() - start)
+    _STATS.count("store", "flushed_rows", len(pending_copy))
+    now = time.time()
+    _LAST_FLUSH_TIME = now
+    for store in _STORE.stores():
+        if now - store.last_prune >= PRUNE_INTERVAL:
+            store.prune(now - MAX_CACHE_ENTRY_AGE, MAX_SHARD_ENTRIES)
+            store.last_prune = now
 
 
 def _queue_cache_update(key, value_dict):
@@ -97,54 +622,474 @@ def _queue_cache_update(key, value_dict):
             _flush_pending_locked()
 
 
+def _queue_cache_updates(updates):
+    """
+    Queue many cache updates at once and flush them together in a single transaction.
+    """
+    if not updates:
+        return
+    with _PENDING_LOCK:
+        _PENDING_UPDATES.update(updates)
+        _TARGET_CACHE.update(updates)
+    with CACHE_LOCK:
+        _flush_pending_locked()
+
+
 def _atexit_flush():
     with CACHE_LOCK:
         _flush_pending_locked()
 
 
-atexit.register(_atexit_flush)
+def get_cache_stats():
+    """
+    Return the cache statistics of this process as ``{kind: {event: value}}``. The kind is a
+    target class name, or "store" for the database. Counted events have an integer value,
+    timed events (remote stats, listings, flushes and snapshot reloads) a dict with the
+    ``count``, ``total`` and ``max`` duration in seconds.
+    """
+    return _STATS.collect()
+
+
+def report_cache_stats():
+    """
+    Log a summary of the cache statistics. If the environment variable CACHE_STATS_ENV is set,
+    the full statistics are written as JSON to CACHE_STATS_DIR as well.
+    """
+    stats = get_cache_stats()
+    if not stats:
+        return
+    for kind, events in sorted(stats.items()):
+        parts = []
+        lookups = sum(events.get(e, 0) for e in ("hit", "miss", "expired"))
+        if lookups:
+            parts.append(
+                f"{lookups} lookups, {events.get('hit', 0) / lookups:.1%} hits, "
+                f"{events.get('expired', 0)} expired"
+            )
+        for event, value in sorted(events.items()):
+            if isinstance(value, dict):
+                parts.append(
+                    f"{event}: {value['count']}x, "
+                    f"mean {value['total'] / value['count'] * 1e3:.1f} ms, "
+                    f"max {value['max'] * 1e3:.1f} ms"
+                )
+            elif event not in ("hit", "miss", "expired"):
+                parts.append(f"{event}: {value}")
+        logger.info(f"Cache statistics for {kind}: {'; '.join(parts)}")
+    if os.getenv(CACHE_STATS_ENV):
+        os.makedirs(CACHE_STATS_DIR, exist_ok=True)
+        path = os.path.join(
+            CACHE_STATS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.json"
+        )
+        with open(path, "w") as f:
+            json.dump(stats, f, indent=2, sort_keys=True)
+        logger.info(f"Cache statistics written to {path}")
 
 
-def _ensure_target_cache_loaded():
-    global _TARGET_CACHE, _TARGET_CACHE_MTIME
-    try:
-        mtime = os.path.getmtime(CACHE_PATH)
-    except OSError:
-        mtime = 0
+def _atexit_hook():
+    _atexit_flush()
+    report_cache_stats()
 
-    if not _TARGET_CACHE or mtime > _TARGET_CACHE_MTIME:
-        _TARGET_CACHE = _load_json(CACHE_PATH)
-        _TARGET_CACHE_MTIME = mtime
 
+atexit.register(_atexit_hook)
 
-def cache_get_exists(key, ttl):
-    entry = _TARGET_CACHE.get(key)
-    if not entry:
-        return False
 
-    hit = ttl is None or (time.time() - entry["ts"] < ttl)
+def _refresh_snapshot():
+    """
+    Merge the store rows written since the last refresh into a new snapshot and swap it in.
+    The first call loads the whole store, later calls only read the recently written rows.
+    """
+    global _SNAPSHOT, _SNAPSHOT_UPDATED, _SNAPSHOT_PRUNE_TIME
+
+    start = time.perf_counter()
+    rows, newest = _STORE.updated_since(_SNAPSHOT_UPDATED)
+    _STATS.timing("store", "refresh", time.perf_counter() - start)
+    _STATS.count("store", "refreshed_rows", len(rows))
+    now = time.time()
+    prune = now - _SNAPSHOT_PRUNE_TIME >= PRUNE_INTERVAL
+    if not rows and not prune:
+        return
+    snapshot = dict(_SNAPSHOT)
+    snapshot.update(rows)
+    if prune:
+        cutoff = now - MAX_CACHE_ENTRY_AGE
+        snapshot = {k: ts for k, ts in snapshot.items() if ts >= cutoff}
+        _SNAPSHOT_PRUNE_TIME = now
+    _SNAPSHOT = MappingProxyType(snapshot)
+    _SNAPSHOT_UPDATED = newest
+
+    # local entries that made it into the snapshot are no longer needed in the overlay
+    for key, entry in list(_TARGET_CACHE.items()):
+        if snapshot.get(key, -1) >= entry["ts"]:
+            _TARGET_CACHE.pop(key, None)
+
+
+def _refresher_loop():
+    while True:
+        try:
+            _refresh_snapshot()
+            if _PENDING_UPDATES and time.time() - _LAST_FLUSH_TIME >= FLUSH_INTERVAL:
+                with CACHE_LOCK:
+                    _flush_pending_locked()
+        except Exception as e:
+            logger.warning(f"Refreshing the target cache snapshot failed: {e}")
+        time.sleep(REFRESH_INTERVAL)
+
+
+def _start_refresher():
+    global _REFRESHER
+    with _REFRESHER_LOCK:
+        if _REFRESHER is None:
+            _REFRESHER = Thread(
+                target=_refresher_loop, name="target-cache-refresher", daemon=True
+            )
+            _REFRESHER.start()
+
+
+def _reset_refresher_after_fork():
+    # threads do not survive a fork, the child starts its own refresher on first use
+    # and reports only its own statistics
+    global _REFRESHER, _REFRESHER_LOCK, _STATS
+    _REFRESHER = None
+    _REFRESHER_LOCK = Lock()
+    _STATS = _CacheStats()
+    # a thread of the parent may have held their locks during the fork
+    for cache in (_LISTINGS, _BITMAPS, _NEGATIVE_CACHE):
+        cache._lock = Lock()
+
+
+os.register_at_fork(after_in_child=_reset_refresher_after_fork)
+
+
+def cache_get_exists(key, ttl, kind="target"):
+    """
+    Return whether *key* is cached as existing and younger than *ttl* seconds.
+    *kind* is the name under which the lookup is counted in the statistics.
+    """
+    if _REFRESHER is None:
+        _start_refresher()
+
+    # lock-free fast path: a dict lookup in the current snapshot and the local overlay
+    ts = _SNAPSHOT.get(key)
+    entry = _TARGET_CACHE.get(key)
+    if entry is not None and (ts is None or entry["ts"] > ts):
+        ts = entry["ts"]
+    now = time.time()
+    if ts is None or (ttl is not None and now - ts >= ttl):
+        # not (yet) in the snapshot or expired there: another process may have stored a
+        # newer entry since the last refresh, so ask the store for this single key
+        ts = _STORE.get_ts(key)
+        if ts is None:
+            _STATS.count(kind, "miss")
+            return False
+        _TARGET_CACHE[key] = {"ts": ts}
+
+    hit = ttl is None or (now - ts < ttl)
+    _STATS.count(kind, "hit" if hit else "expired")
     if hit:
         logger.debug(f"Cache hit for key: {key}")
     return hit
 
 
+def _target_key(target):
+    return target.uri() if hasattr(target, "uri") else str(target.path)
+
+
+def _flat_targets(targets, expand_collections=False):
+    """
+    Flatten nested dicts, lists, tuples and sets of targets into a list. Unlike law.util.flatten,
+    which concatenates the partial lists with sum(), this is linear in the number of targets.
+    With *expand_collections*, target collections are replaced by their targets as well.
+    """
+    flat = []
+    stack = [targets]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, dict):
+            stack.extend(reversed(list(obj.values())))
+        elif isinstance(obj, (list, tuple, set)):
+            stack.extend(reversed(list(obj)))
+        elif expand_collections and isinstance(
+            obj, law.target.collection.TargetCollection
+        ):
+            stack.extend(reversed(obj._flat_target_list))
+        else:
+            flat.append(obj)
+    return flat
+
+
 def _get_collection_key(targets):
     """
     Generates a unique SHA-256 hash for a specific set of targets.
     This keeps different collections pointing to the same dir completely separated.
     """
-    paths = []
-    # Handle both list/tuple of targets and dict of targets
-    all_targets = flatten(targets.values() if isinstance(targets, dict) else targets)
+    paths = [_target_key(t) for t in _flat_targets(targets)]
+    paths.sort()
+    return _hash_collection_paths(paths)
 
-    for t in all_targets:
-        paths.append(t.uri() if hasattr(t, "uri") else str(t.path))
 
-    paths.sort()
-    hash_str = hashlib.sha256(json.dumps(paths).encode("utf-8")).hexdigest()
+def _hash_collection_paths(sorted_paths):
+    hash_str = hashlib.sha256(json.dumps(sorted_paths).encode("utf-8")).hexdigest()
     return f"collection_{hash_str}"
 
 
+def _cached_listdir(directory, ttl, refresh=True):
+    """
+    Return the basenames in *directory*, served from the listing cache while younger than *ttl*.
+    A missing directory is cached as empty. With *refresh* set to False, None is returned
+    instead of listing the directory when no fresh listing is cached.
+    """
+    key = _target_key(directory)
+    now = time.time()
+    entry = _LISTINGS.get(key)
+    if entry is None or now - entry[0] >= ttl:
+        entry = _STORE.get_listing(key)
+        if entry is None or now - entry[0] >= ttl:
+            if not refresh:
+                return None
+            start = time.perf_counter()
+            names = frozenset(directory.listdir() if directory.exists() else [])
+            _STATS.timing(
+                directory.__class__.__name__, "listdir", time.perf_counter() - start
+            )
+            entry = (now, names)
+            _STORE.put_listing(key, now, names)
+        _LISTINGS[key] = entry
+    return entry[1]
+
+
+def record_exists(targets):
+    """
+    Record targets that are known to exist, e.g. right after they were uploaded, without a
+    remote request. Each basename is also added to the cached listing of its parent directory,
+    so collections containing the targets see them as well.
+
+    :param targets: Targets and/or target collections, possibly nested in lists or dicts.
+    """
+    now = time.time()
+    updates = {}
+    for t in _flat_targets(targets, expand_collections=True):
+        if not isinstance(t, (CachedWLCGFileTarget, CachedWLCGDirectoryTarget)):
+            continue
+        key = _target_key(t)
+        updates[key] = {"ts": now}
+        _NEGATIVE_CACHE.pop(key, None)
+        is_file = isinstance(t, CachedWLCGFileTarget)
+        _tree_index_add(key, is_file)
+        if is_file:
+            _add_to_listing(t.parent, os.path.basename(t.path))
+    _queue_cache_updates(updates)
+
+
+def _add_to_listing(directory, basename):
+    key = _target_key(directory)
+    entry = _LISTINGS.get(key) or _STORE.get_listing(key)
+    if entry is None or basename in entry[1]:
+        return
+    entry = (entry[0], entry[1] | {basename})
+    _LISTINGS[key] = entry
+    _STORE.put_listing(key, entry[0], entry[1])
+
+
+def _recheck_target(target, ttl):
+    """
+    Check a single target that is not part of a collection's completion bitmap yet.
+    Negative results are remembered for *ttl* seconds.
+    """
+    key = _target_key(target)
+    checked = _NEGATIVE_CACHE.get(key)
+    if checked is not None and time.time() - checked < ttl:
+        return False
+    if target.exists():
+        _NEGATIVE_CACHE.pop(key, None)
+        return True
+    _NEGATIVE_CACHE[key] = time.time()
+    return False
+
+
+def _bit_is_set(bitmap, index):
+    return bitmap[index >> 3] & (1 << (index & 7))
+
+
+def _load_bitmap(key, route_key, size, ttl):
+    """
+    Return ``(ts, bitmap)`` for the collection *key*, merging the in-process copy with the
+    one in the store, or an empty bitmap if neither is younger than *ttl*.
+    The timestamp is the time the first bit was set, all bits expire together.
+    """
+    now = time.time()
+    candidates = [_BITMAPS.get(key), _STORE.get_bitmap(key, route_key)]
+    ts, bitmap = now, bytearray((size + 7) // 8)
+    for candidate in candidates:
+        if (
+            candidate is None
+            or candidate["version"] != BITMAP_VERSION
+            or candidate["size"] != size
+            or now - candidate["ts"] >= ttl
+        ):
+            continue
+        ts = min(ts, candidate["ts"])
+        bitmap = bytearray(x | y for x, y in zip(bitmap, candidate["bitmap"]))
+    return ts, bitmap
+
+
+def _tree_index_for(key):
+    for root, (ts, listings) in list(_TREE_INDEXES.items()):
+        if key == root or key.startswith(root + "/"):
+            if time.time() - ts < TREE_INDEX_TTL:
+                return root, ts, listings
+    return None, None, None
+
+
+def _tree_index_exists(key, is_file=True):
+    """
+    Return True if a tree index lists *key*, or None otherwise. A target missing from the index
+    may have been written by another process after the walk, so a miss is unknown and has to be
+    checked like any target that is not indexed.
+    """
+    key = key.rstrip("/")
+    _, _, listings = _tree_index_for(key)
+    if listings is None:
+        return None
+    if not is_file:
+        return True if key in listings else None
+    names = listings.get(os.path.dirname(key))
+    return True if names is not None and os.path.basename(key) in names else None
+
+
+def _tree_index_add(key, is_file):
+    """
+    Add *key* and its parent directories to the tree index covering it, both in memory and in
+    the stored listings. Returns False if no index covers *key*.
+    """
+    key = key.rstrip("/")
+    root, ts, listings = _tree_index_for(key)
+    if listings is None:
+        return False
+    changed = {}
+    directory = os.path.dirname(key) if is_file else key
+    if is_file:
+        names = listings.get(directory, frozenset())
+        if os.path.basename(key) not in names:
+            changed[directory] = names | {os.path.basename(key)}
+    while len(directory) > len(root):
+        if directory not in listings and directory not in changed:
+            changed[directory] = frozenset()
+        directory = os.path.dirname(directory)
+    for directory, names in changed.items():
+        listings[directory] = names
+        # with the index timestamp, so that loading the stored index includes the listing
+        _STORE.put_listing(directory, ts, names)
+    return True
+
+
+def _walk_xrootd(root, max_workers):
+    """
+    Return ``{dir: basenames}`` for all directories below the XRootD URI *root*. The directories
+    of each level are listed concurrently, one dirlist request per directory.
+    """
+    from XRootD.client import FileSystem
+    from XRootD.client.flags import DirListFlags, StatInfoFlags
+
+    m = re.match(r"^(root://[^/]+)/+(.*)$", root)
+    client = FileSystem(m.group(1))
+
+    def list_dir(item):
+        key, path = item
+        status, listing = client.dirlist(path, DirListFlags.STAT)
+        if not status.ok:
+            return key, path, status, None, None
+        files, dirs = [], []
+        for entry in listing:
+            if entry.statinfo.flags & StatInfoFlags.IS_DIR:
+                dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+        return key, path, status, files, dirs
+
+    listings = {}
+    level = [(root, f"/{m.group(2)}")]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while level:
+            next_level = []
+            for key, path, status, files, dirs in executor.map(list_dir, level):
+                if not status.ok:
+                    # 3011: kXR_NotFound, nothing was produced for this tag yet
+                    if key == root and status.errno == 3011:
+                        return {}
+                    raise IOError(f"listing {key} failed: {status.message}")
+                listings[key] = frozenset(files)
+                next_level += [(f"{key}/{d}", f"{path.rstrip('/')}/{d}") for d in dirs]
+            level = next_level
+    return listings
+
+
+def _walk_fs(fs, tag):
+    # fallback for other protocols, law lists each directory and stats its entries
+    if not fs.exists(tag):
+        return {}
+    return {
+        fs.uri(path).rstrip("/"): frozenset(files) for path, _, files, _ in fs.walk(tag)
+    }
+
+
+def use_tree_index(fs, tag, max_workers=TREE_INDEX_WORKERS, persist=True):
+    """
+    Answer all existence checks of targets below *tag* on *fs* from an index of the whole tree,
+    taken with one recursive listing, instead of checking targets or directories one by one.
+    The listing runs concurrently with XRootD dirlist requests for root:// storage. With
+    *persist*, the index is stored in the cache database, and other processes load it from there
+    while it is younger than TREE_INDEX_TTL.
+
+    Only targets listed in the index are answered from it. The walk also stores the listing of
+    each directory, so targets it did not find count as missing for LISTING_TTL, like with any
+    other cached listing, and are checked again afterwards. Files uploaded by this process are
+    added to the index.
+
+    :param fs: The (WLCG) file system the targets are stored on.
+    :param tag: The production_tag, i.e. the top-level directory to index.
+    :param max_workers: Maximum number of concurrent directory listings.
+    :param persist: Whether to load and store the index in the cache database.
+    """
+    if (fs, tag) in _INDEXED_TAGS:
+        return
+    root = fs.uri(tag).rstrip("/")
+    with _TREE_INDEX_LOCK:
+        if (fs, tag) in _INDEXED_TAGS:
+            return
+        persisted = _STORE.get_tree_index(root) if persist else None
+        if persisted is not None and time.time() - persisted[0] < TREE_INDEX_TTL:
+            ts, listings = persisted
+            logger.info(f"Loaded tree index of {root} ({len(listings)} directories)")
+        else:
+            ts = time.time()
+            start = time.perf_counter()
+            try:
+                listings = None
+                if root.startswith("root://"):
+                    try:
+                        listings = _walk_xrootd(root, max_workers)
+                    except ImportError:
+                        pass
+                if listings is None:
+                    listings = _walk_fs(fs, tag)
+            except Exception as e:
+                logger.warning(
+                    f"Indexing {root} failed, falling back to individual checks: {e}"
+                )
+                return
+            duration = time.perf_counter() - start
+            _STATS.timing("tree_index", "walk", duration)
+            if persist:
+                _STORE.put_tree_index(root, ts, listings)
+            logger.info(
+                f"Indexed {sum(len(names) for names in listings.values())} files in "
+                f"{len(listings)} directories below {root} in {duration:.1f} s"
+            )
+        _TREE_INDEXES[root] = (ts, dict(listings))
+        _INDEXED_TAGS.add((fs, tag))
+
+
 class CachedWLCGFileTarget(law.wlcg.WLCGFileTarget):
     cache_ttl = 86400
 
@@ -154,16 +1099,28 @@ class CachedWLCGFileTarget(law.wlcg.WLCGFileTarget):
     def exists(self):
         key = self._cache_key()
 
-        with CACHE_LOCK:
-            _ensure_target_cache_loaded()
-            if cache_get_exists(key, self.cache_ttl):
-                return True
+        indexed = _tree_index_exists(key)
+        if indexed is not None:
+            _STATS.count(self.__class__.__name__, "indexed")
+            return indexed
+        if cache_get_exists(key, self.cache_ttl, self.__class__.__name__):
+            return True
 
+        start = time.perf_counter()
         exists = super().exists()
+        _STATS.timing(self.__class__.__name__, "stat", time.perf_counter() - start)
         if exists:
             _queue_cache_update(key, {"ts": time.time()})
         return exists
 
+    def copy_from_local(self, *args, record=True, **kwargs):
+        # write-through: the upload succeeded, so the next exists() needs no remote stat,
+        # callers that verify the upload first record it themselves
+        result = super().copy_from_local(*args, **kwargs)
+        if record:
+            record_exists(self)
+        return result
+
 
 class CachedWLCGDirectoryTarget(law.wlcg.WLCGDirectoryTarget):
     cache_ttl = 86400
@@ -173,19 +1130,127 @@ class CachedWLCGDirectoryTarget(law.wlcg.WLCGDirectoryTarget):
 
     def exists(self):
         key = self._cache_key()
-        with CACHE_LOCK:
-            _ensure_target_cache_loaded()
-            if cache_get_exists(key, self.cache_ttl):
-                return True
 
+        indexed = _tree_index_exists(key, is_file=False)
+        if indexed is not None:
+            _STATS.count(self.__class__.__name__, "indexed")
+            return indexed
+        if cache_get_exists(key, self.cache_ttl, self.__class__.__name__):
+            return True
+
+        start = time.perf_counter()
         exists = super().exists()
+        _STATS.timing(self.__class__.__name__, "stat", time.perf_counter() - start)
         if exists:
             _queue_cache_update(key, {"ts": time.time()})
         return exists
 
 
-class CachedSiblingFileCollection(law.target.collection.SiblingFileCollection):
+class _CachedCollectionMixin:
+    """
+    Shared existence caching of the sibling file collections.
+
+    Targets that were seen once are recorded in a per-collection completion bitmap, so only the
+    targets still missing are checked again. Missing targets are looked up in cached directory
+    listings, re-checked one by one when only a few are missing in a directory, or found with a
+    fresh listing otherwise. Listings and negative results expire after *listing_ttl*, the bitmap
+    after *cache_ttl*.
+    """
+
     cache_ttl = 86400
+    listing_ttl = LISTING_TTL
+
+    def _basenames_key(self, target):
+        raise NotImplementedError
+
+    def _cache_layout(self):
+        """
+        Return the targets sorted by key together with their collection key, parent directory
+        keys, basenames and basenames keys. The targets of a collection do not change after it
+        was created, so this is computed once per instance instead of on every status query.
+        """
+        layout = self.__dict__.get("_cache_layout_memo")
+        if layout is None:
+            keyed = sorted(
+                ((_target_key(t), t) for t in _flat_targets(self.targets)),
+                key=lambda pair: pair[0],
+            )
+            targets = [t for _, t in keyed]
+            collection_key = _hash_collection_paths([key for key, _ in keyed])
+            layout = (
+                targets,
+                collection_key,
+                keyed[0][0] if keyed else collection_key,
+                # same as _target_key(t.parent), without creating the parent targets
+                [os.path.dirname(key) for key, _ in keyed],
+                [os.path.basename(t.path) for t in targets],
+                [self._basenames_key(t) for t in targets],
+            )
+            self.__dict__["_cache_layout_memo"] = layout
+        return layout
+
+    def _cached_basenames(self):
+        (
+            targets,
+            collection_key,
+            route_key,
+            parent_keys,
+            target_basenames,
+            basenames_keys,
+        ) = self._cache_layout()
+        ts, bitmap = _load_bitmap(
+            collection_key, route_key, len(targets), self.cache_ttl
+        )
+
+        changed = False
+        missing = {}
+        for i, parent_key in enumerate(parent_keys):
+            if _bit_is_set(bitmap, i):
+                continue
+            if _TREE_INDEXES and _tree_index_exists(_target_key(targets[i])):
+                bitmap[i >> 3] |= 1 << (i & 7)
+                changed = True
+            else:
+                missing.setdefault(parent_key, []).append(i)
+
+        for indices in missing.values():
+            directory = targets[indices[0]].parent
+            names = _cached_listdir(directory, self.listing_ttl, refresh=False)
+            if names is None and len(indices) > PARTIAL_RECHECK_LIMIT:
+                names = _cached_listdir(directory, self.listing_ttl)
+            for i in indices:
+                if names is not None:
+                    found = target_basenames[i] in names
+                else:
+                    found = _recheck_target(targets[i], self.listing_ttl)
+                if found:
+                    bitmap[i >> 3] |= 1 << (i & 7)
+                    changed = True
+
+        _BITMAPS[collection_key] = {
+            "version": BITMAP_VERSION,
+            "ts": ts,
+            "size": len(targets),
+            "bitmap": bitmap,
+        }
+        if changed:
+            _STORE.put_bitmap(collection_key, route_key, ts, len(targets), bitmap)
+        elif not missing:
+            logger.debug(f"Cache hit for complete collection: {collection_key}")
+        _STATS.count(self.__class__.__name__, "miss" if missing else "hit")
+
+        basenames = {key: set() for key in basenames_keys}
+        for i, key in enumerate(basenames_keys):
+            if _bit_is_set(bitmap, i):
+                basenames[key].add(target_basenames[i])
+        return basenames
+
+
+class CachedSiblingFileCollection(
+    _CachedCollectionMixin, law.target.collection.SiblingFileCollection
+):
+    def _basenames_key(self, target):
+        return None
 
     def _iter_state(
         self,
@@ -196,46 +1261,22 @@ class CachedSiblingFileCollection(law.target.collection.SiblingFileCollection):
         unpack=True,
         exists_func=None,
     ):
-        collection_key = _get_collection_key(self.targets)
-        all_targets = flatten(
-            self.targets.values() if isinstance(self.targets, dict) else self.targets
-        )
-
-        # 1. Check if the entire collection is cached as complete
-        with CACHE_LOCK:
-            _ensure_target_cache_loaded()
-            is_cached = cache_get_exists(collection_key, self.cache_ttl)
-
-        if is_cached:
-            # Mock the basenames list so the parent class bypasses the grid check automatically
-            basenames = {os.path.basename(t.path) for t in all_targets}
-            return super()._iter_state(
-                existing, optional_existing, basenames, keys, unpack, exists_func
-            )
-
-        # 2. If not cached (or incomplete), fetch live directory contents
-        if basenames is None:
-            if self.dir.exists():
-                basenames = set(self.dir.listdir())
-            else:
-                basenames = set()
-
-        # 3. Check if ALL items are present
-        all_present = all(os.path.basename(t.path) in basenames for t in all_targets)
-
-        # 4. Only cache if 100% complete
-        if all_present and all_targets:
-            _queue_cache_update(collection_key, {"ts": time.time()})
-
+        if existing is not None and basenames is None and exists_func is None:
+            basenames = self._cached_basenames().get(None, set())
         return super()._iter_state(
             existing, optional_existing, basenames, keys, unpack, exists_func
         )
 
 
 class CachedNestedSiblingFileCollection(
-    law.target.collection.NestedSiblingFileCollection
+    _CachedCollectionMixin, law.target.collection.NestedSiblingFileCollection
 ):
-    cache_ttl = 86400
+    def _basenames_key(self, target):
+        # use the same directory key as the law base class does for its own listings
+        target_dirs = getattr(self, "_flat_target_dirs", None)
+        if target_dirs and target in target_dirs:
+            return target_dirs[target]
+        return _target_key(target.parent)
 
     def _iter_state(
         self,
@@ -246,51 +1287,86 @@ class CachedNestedSiblingFileCollection(
         unpack=True,
         exists_func=None,
     ):
-        collection_key = _get_collection_key(self.targets)
-        all_targets = flatten(
-            self.targets.values() if isinstance(self.targets, dict) else self.targets
+        if existing is not None and basenames is None and exists_func is None:
+            basenames = self._cached_basenames()
+        return super()._iter_state(
+            existing, optional_existing, basenames, keys, unpack, exists_func
         )
 
-        # 1. Check if the entire collection is cached as complete
-        with CACHE_LOCK:
-            _ensure_target_cache_loaded()
-            is_cached = cache_get_exists(collection_key, self.cache_ttl)
-
-        if is_cached:
-            # Mock the basenames dict mapping {dir_key: set(files)}
-            basenames = {}
-            for t in all_targets:
-                dir_key = (
-                    t.parent.uri() if hasattr(t.parent, "uri") else str(t.parent.path)
-                )
-                basenames.setdefault(dir_key, set()).add(os.path.basename(t.path))
-            return super()._iter_state(
-                existing, optional_existing, basenames, keys, unpack, exists_func
-            )
-
-        # 2. If not cached, fetch live directory contents for all unique directories
-        if basenames is None:
-            unique_dirs = {t.parent for t in all_targets if hasattr(t, "parent")}
-            basenames = {}
-            for d in unique_dirs:
-                dir_key = d.uri() if hasattr(d, "uri") else str(d.path)
-                if d.exists():
-                    basenames[dir_key] = set(d.listdir())
-                else:
-                    basenames[dir_key] = set()
 
-        # 3. Check if ALL items are present across all nested directories
-        all_present = True
-        for t in all_targets:
-            dir_key = t.parent.uri() if hasattr(t.parent, "uri") else str(t.parent.path)
-            if os.path.basename(t.path) not in basenames.get(dir_key, set()):
-                all_present = False
-                break
+def _uncached_exists(target):
+    # the cached target classes would look themselves up in the cache again
+    start = time.perf_counter()
+    if isinstance(target, CachedWLCGFileTarget):
+        exists = law.wlcg.WLCGFileTarget.exists(target)
+    elif isinstance(target, CachedWLCGDirectoryTarget):
+        exists = law.wlcg.WLCGDirectoryTarget.exists(target)
+    else:
+        exists = target.exists()
+    _STATS.timing(target.__class__.__name__, "stat", time.perf_counter() - start)
+    return exists
 
-        # 4. Only cache if 100% complete
-        if all_present and all_targets:
-            _queue_cache_update(collection_key, {"ts": time.time()})
 
-        return super()._iter_state(
-            existing, optional_existing, basenames, keys, unpack, exists_func
-        )
+def exists_many(targets, max_workers=EXISTS_MANY_WORKERS, ttl=None):
+    """
+    Check the existence of many targets at once and record the results in the cache.
+
+    Targets cached as existing are answered right away. The remaining file targets are grouped
+    by parent directory: a directory with at least EXISTS_MANY_LIST_THRESHOLD unresolved targets
+    is listed once (through the listing cache), fewer targets are stat'ed individually. Listings
+    and stats run concurrently in a pool of *max_workers* threads, and all newly found targets
+    are written to the cache in a single flush.
+
+    :param targets: Targets and/or target collections, possibly nested in lists or dicts.
+    :param max_workers: Maximum number of concurrent remote requests.
+    :param ttl: Maximum age of cache entries that are accepted without a new check, the
+        cache_ttl of each target by default.
+    :return: A dict mapping each (flattened) target to whether it exists.
+    """
+    all_targets = _flat_targets(targets, expand_collections=True)
+    results = {}
+    by_dir = {}
+    other_targets = []
+    for t in all_targets:
+        key = _target_key(t)
+        is_file = isinstance(t, law.target.file.FileSystemFileTarget)
+        indexed = _tree_index_exists(key, is_file) if _TREE_INDEXES else None
+        if indexed is not None:
+            results[t] = indexed
+            continue
+        target_ttl = ttl
+        if target_ttl is None:
+            target_ttl = getattr(t, "cache_ttl", CachedWLCGFileTarget.cache_ttl)
+        if cache_get_exists(key, target_ttl, t.__class__.__name__):
+            results[t] = True
+        elif is_file:
+            by_dir.setdefault(_target_key(t.parent), []).append(t)
+        else:
+            other_targets.append(t)
+
+    def check_dir(dir_targets):
+        if len(dir_targets) >= EXISTS_MANY_LIST_THRESHOLD:
+            names = _cached_listdir(dir_targets[0].parent, LISTING_TTL)
+        else:
+            names = _cached_listdir(dir_targets[0].parent, LISTING_TTL, refresh=False)
+        if names is None:
+            return [(t, _uncached_exists(t)) for t in dir_targets]
+        return [(t, os.path.basename(t.path) in names) for t in dir_targets]
+
+    updates = {}
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checked = [
+            pair for pairs in executor.map(check_dir, by_dir.values()) for pair in pairs
+        ]
+        checked += zip(other_targets, executor.map(_uncached_exists, other_targets))
+    for t, exists in checked:
+        results[t] = exists
+        if exists and isinstance(t, (CachedWLCGFileTarget, CachedWLCGDirectoryTarget)):
+            updates[_target_key(t)] = {"ts": now}
+    _queue_cache_updates(updates)
+    logger.debug(
+        f"exists_many: {len(results)} targets, {len(results) - len(checked)} cached, "
+        f"{len(by_dir)} directories checked"
+    )
+    return results
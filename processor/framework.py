@@ -1,19 +1,40 @@
 import os
+import atexit
 import luigi
 import law
+import re
+import json
+import time
+import shlex
+import shutil
+import fnmatch
+import hashlib
 import select
+import signal
 import subprocess
 import socket
 from enum import Enum
-from law.util import interruptable_popen
-from rich.console import Console
+from functools import cache, wraps
+from law.util import interruptable_popen, flatten
+from law.job.base import BaseJobManager
 from datetime import datetime
 from tempfile import mkdtemp
 from getpass import getuser
+from resource_history import (
+    MAX_HISTORY_ATTEMPTS,
+    ResourceHistory,
+    fit_resource_model,
+    predict_resources,
+    query_job_usage,
+)
 from caching import (
     CachedNestedSiblingFileCollection,
     CachedSiblingFileCollection,
     CachedWLCGFileTarget,
+    exists_many,
+    record_exists,
+    register_cache_shard,
+    use_tree_index,
 )
 
 try:
@@ -25,13 +46,35 @@ try:
 except:
     pass
 
-law.contrib.load("wlcg", "htcondor", "singularity")
-# try to get the terminal width, if this fails, we are probably in a remote job, set it to 140
-try:
-    current_width = os.get_terminal_size().columns
-except OSError:
-    current_width = 140
-console = Console(width=current_width)
+# wlcg and htcondor are needed at import time for the base classes below, the singularity
+# sandbox is only loaded once a sandbox is set up in KingmakerSandbox
+law.contrib.load("wlcg", "htcondor")
+
+
+class _LazyConsole:
+    """
+    Stand-in for the shared `rich.console.Console`. rich is only imported and the console only
+    created on first use, which keeps it out of the import of the task modules.
+    """
+
+    def __init__(self):
+        self._console = None
+
+    def __getattr__(self, name):
+        if self._console is None:
+            from rich.console import Console
+
+            # try to get the terminal width, if this fails, we are probably in a remote job,
+            # set it to 140
+            try:
+                current_width = os.get_terminal_size().columns
+            except OSError:
+                current_width = 140
+            self._console = Console(width=current_width)
+        return getattr(self._console, name)
+
+
+console = _LazyConsole()
 
 # Determine startup time to use as default production_tag
 # LOCAL_TIMESTAMP is used by remote workflows to ensure consistent tags
@@ -48,6 +91,437 @@ else:
     startup_dir = os.getcwd()
 
 
+# Changes of the environment by source scripts, cached in memory and in LAW_HOME
+#   (see set_environment)
+ENV_SNAPSHOT_DIR = os.path.join(os.getenv("LAW_HOME", "/tmp"), "env_snapshots")
+ENV_SNAPSHOT_TTL = 86400
+# Inherited variables that change the outcome of most setup scripts,
+#   variables referenced in the scripts themselves are added to these
+ENV_SNAPSHOT_VARS = ("PATH", "LD_LIBRARY_PATH", "PYTHONPATH", "HOME", "USER", "SHELL")
+# Bumped when the format of the snapshots changes
+ENV_SNAPSHOT_VERSION = 2
+_env_snapshots = {}
+_SOURCE_CRE = re.compile(rb"^\s*(?:source|\.)\s+([^\s;&|]+)", re.MULTILINE)
+
+
+def _sourced_script_contents(script, seen):
+    # yield (path, content) of `script` and of the scripts it sources, as far as their path
+    #   can be resolved without running the script
+    try:
+        path = os.path.expandvars(shlex.split(script)[0])
+    except (ValueError, IndexError):
+        return
+    if not os.path.isabs(path) and seen:
+        # relative to the sourcing script or to the working directory
+        base = os.path.join(os.path.dirname(seen[-1]), path)
+        if os.path.exists(base):
+            path = base
+    path = os.path.abspath(path)
+    if path in seen:
+        return
+    seen.append(path)
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except OSError:
+        content = b""
+    yield path, content
+    for nested in _SOURCE_CRE.findall(content):
+        yield from _sourced_script_contents(nested.decode(errors="replace"), seen)
+
+
+def env_snapshot_key(sourcescript):
+    """
+    Key of the environment changes made by sourcing `sourcescript`. It changes if the content
+    of one of the scripts, the working directory or any relevant inherited variable changes.
+    Scripts sourced by the listed scripts are hashed as well, if their path can be resolved
+    without running the script, e.g. not if it is computed with a command substitution.
+
+    :param sourcescript: List of scripts, each optionally followed by its arguments.
+    :return: A hex digest.
+    """
+    variables = set(ENV_SNAPSHOT_VARS)
+    parts = [ENV_SNAPSHOT_VERSION, os.getcwd()]
+    for script in sourcescript:
+        contents = list(_sourced_script_contents(script, []))
+        parts.append(
+            [script]
+            + [
+                [path, hashlib.sha256(content).hexdigest()]
+                for path, content in contents
+            ]
+        )
+        for _, content in contents:
+            variables.update(
+                name.decode()
+                for name in re.findall(rb"\$\{?([A-Za-z_][A-Za-z0-9_]*)", content)
+            )
+    parts.append(sorted((name, os.environ.get(name)) for name in variables))
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+def env_changes(before, after):
+    """
+    Return the changes from the environment `before` to `after` as a dict with the "set"
+    variables and their values and the names of the "unset" ones.
+    """
+    return {
+        "set": {
+            name: value for name, value in after.items() if before.get(name) != value
+        },
+        "unset": sorted(name for name in before if name not in after),
+    }
+
+
+def apply_env_changes(changes, env=None):
+    """
+    Apply `changes` as returned by `env_changes` to a copy of `env`, or of the current
+    environment, and return it.
+    """
+    env = dict(os.environ if env is None else env)
+    env.update(changes["set"])
+    for name in changes["unset"]:
+        env.pop(name, None)
+    return env
+
+
+def load_env_snapshot(key):
+    """
+    Return the cached environment changes for `key` from memory or from ENV_SNAPSHOT_DIR,
+    or None if there are none younger than ENV_SNAPSHOT_TTL.
+    """
+    env = _env_snapshots.get(key)
+    if env is not None:
+        return env
+    path = os.path.join(ENV_SNAPSHOT_DIR, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) >= ENV_SNAPSHOT_TTL:
+            return None
+        with open(path, "r") as f:
+            env = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _env_snapshots[key] = env
+    return env
+
+
+def store_env_snapshot(key, changes):
+    """
+    Cache the environment changes for `key` in memory and in ENV_SNAPSHOT_DIR. The file is
+    only readable by the user, as the environment can contain credentials.
+    """
+    _env_snapshots[key] = changes
+    path = os.path.join(ENV_SNAPSHOT_DIR, f"{key}.json")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(ENV_SNAPSHOT_DIR, exist_ok=True)
+        with open(
+            os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w"
+        ) as f:
+            json.dump(changes, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        console.log(f"Could not store environment snapshot {path}: {e}")
+
+
+@cache
+def htcondor_site_domain():
+    """
+    Determine the site profile ("ETP" or "CERN") of the submitting machine from its domain
+    name. The lookup is only done once per process.
+    """
+    domain_name = str(socket.getfqdn())
+
+    if domain_name.endswith("cern.ch"):
+        return "CERN"
+    elif domain_name.endswith(
+        ("etp.kit.edu", "darwin.kit.edu", "gridka.de", "bwforcluster")
+    ):
+        return "ETP"
+    console.log("Unknown domain, default to CERN lxplus settings.")
+    return "CERN"
+
+
+# Location of the uploaded job tarball, per packed files and output storage
+_job_tarball_uploads = {}
+# Files that are not packed into the job tarball
+JOB_TARBALL_EXCLUDES = ("*.pyc", "*.git")
+
+
+def _job_tarball_files(path):
+    # yield all files below path in a stable order, skipping what tar excludes,
+    #   missing paths are left for tar to report
+    name = os.path.basename(path)
+    if not os.path.lexists(path) or any(
+        fnmatch.fnmatch(name, pattern) for pattern in JOB_TARBALL_EXCLUDES
+    ):
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        for name in sorted(os.listdir(path)):
+            yield from _job_tarball_files(os.path.join(path, name))
+    else:
+        yield path
+
+
+def job_tarball_hash(paths, directory=None):
+    """
+    Hash the names and contents of all files that are packed into the job tarball.
+
+    :param paths: Files and directories relative to `directory`, or to the current directory.
+    :return: A hex digest, identical for identical tarball contents.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        if directory is not None:
+            path = os.path.join(directory, path)
+        for file_path in _job_tarball_files(path):
+            name = file_path
+            if directory is not None:
+                name = os.path.relpath(file_path, directory)
+            digest.update(name.encode() + b"\0")
+            if os.path.islink(file_path):
+                digest.update(os.readlink(file_path).encode())
+            else:
+                with open(file_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b""):
+                        digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def pack_job_tarball(tarball_path, paths):
+    """
+    Pack `paths` into the gzip-compressed tarball `tarball_path`. The compression runs on all
+    cores with pigz if it is available, the result can be unpacked with `tar -xzf` either way.
+    The tarball is written to a temporary file first, so a failed run leaves nothing behind.
+    """
+    os.makedirs(os.path.dirname(tarball_path), exist_ok=True)
+    tmp_path = f"{tarball_path}.{os.getpid()}.tmp"
+    compression = ["-I", "pigz"] if shutil.which("pigz") else ["-z"]
+    command = ["tar"]
+    for pattern in JOB_TARBALL_EXCLUDES:
+        command += ["--exclude", pattern]
+    command += compression + ["-cf", tmp_path] + list(paths)
+    code, out, error = interruptable_popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        # rich_console=console
+    )
+    if code != 0:
+        console.log(f"Error when taring job {error}")
+        console.log(f"Output: {out}")
+        console.log(f"tar returned non-zero exit status {code}")
+        console.rule()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise Exception("tar failed")
+    os.replace(tmp_path, tarball_path)
+    console.rule("Successful tar of framework tarball !")
+
+
+def node_resources():
+    """
+    Return the number of cores this process may use and the available memory in MB.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    memory = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    memory = int(line.split()[1]) // 1024
+                    break
+    except OSError:
+        pass
+    if memory is None:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 1024**2
+    return cores, memory
+
+
+def run_local_pool(jobs, cores, memory, poll_interval=2):
+    """
+    Run `jobs` as separate processes on this node, starting as many at a time as fit into
+    `cores` and `memory`. Pending jobs are started largest first, smaller jobs fill up the
+    remaining cores. A job that requests more than the whole pool runs on its own. The output of
+    each job is written to its log file.
+
+    :param jobs: Dict mapping a job name to a dict with the `command` (list), the `log` file
+        path and the requested `cpus` and `memory` in MB.
+    :param cores: Number of cores of the pool.
+    :param memory: Memory of the pool in MB.
+    :param poll_interval: Seconds between checks for finished jobs.
+    :return: Dict mapping each job name to the exit code of its process.
+    """
+    pending = sorted(
+        jobs, key=lambda name: (jobs[name]["cpus"], jobs[name]["memory"]), reverse=True
+    )
+    running = {}
+    exit_codes = {}
+    free_cores, free_memory = cores, memory
+    try:
+        while pending or running:
+            for name in list(pending):
+                job = jobs[name]
+                cpus = min(job["cpus"], cores)
+                mem = min(job["memory"], memory)
+                if cpus > free_cores or mem > free_memory:
+                    continue
+                os.makedirs(os.path.dirname(job["log"]), exist_ok=True)
+                log = open(job["log"], "w")
+                log.write(f"{shlex.join(job['command'])}\n\n")
+                log.flush()
+                process = subprocess.Popen(
+                    job["command"],
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+                running[name] = (process, log, cpus, mem, time.time())
+                pending.remove(name)
+                free_cores -= cpus
+                free_memory -= mem
+            time.sleep(poll_interval)
+            for name, (process, log, cpus, mem, start) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                log.close()
+                del running[name]
+                free_cores += cpus
+                free_memory += mem
+                exit_codes[name] = process.returncode
+                status = "finished" if process.returncode == 0 else "failed"
+                console.log(
+                    f"[{len(exit_codes)}/{len(jobs)}] {name} {status} after "
+                    f"{(time.time() - start) / 60:.1f} min (exit code {process.returncode}), "
+                    f"{len(running)} running, {len(pending)} pending, "
+                    f"{cores - free_cores}/{cores} cores in use"
+                )
+    finally:
+        # stop the remaining jobs and their children when the pool is interrupted
+        for process, log, *_ in running.values():
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            process.wait()
+            log.close()
+    return exit_codes
+
+
+# Long-lived singularity instances started by this process, see start_singularity_instance
+SINGULARITY_INSTANCES_ENV = "KINGMAKER_SINGULARITY_INSTANCES"
+_singularity_instances = {}
+
+
+def _singularity(*args):
+    return interruptable_popen(
+        ["singularity"] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def _stop_orphaned_singularity_instances():
+    # instances are named kingmaker_<key>_<pid of the starting process>, stop the ones whose
+    #   process is gone without stopping them, e.g. after it was killed
+    code, out, _ = _singularity("instance", "list", "--json")
+    if code != 0:
+        return
+    try:
+        instances = json.loads(out)["instances"]
+    except (ValueError, KeyError):
+        return
+    for instance in instances:
+        name = instance.get("instance", "")
+        m = re.match(r"^kingmaker_[0-9a-f]+_(\d+)$", name)
+        if m is None:
+            continue
+        try:
+            os.kill(int(m.group(1)), 0)
+        except ProcessLookupError:
+            console.log(f"Stopping orphaned singularity instance {name}")
+            _singularity("instance", "stop", name)
+        except PermissionError:
+            pass
+
+
+def _stop_singularity_instances(owner_pid):
+    # forked processes inherit the exit handlers, only the starting process stops the instances
+    if os.getpid() != owner_pid:
+        return
+    stop_singularity_instances()
+
+
+def stop_singularity_instances(keep=()):
+    """
+    Stop the singularity instances started by this process, except the ones with a key in
+    `keep`, and remove them from the environment handed to child processes.
+    """
+    instances = json.loads(os.getenv(SINGULARITY_INSTANCES_ENV, "{}"))
+    for key in list(_singularity_instances):
+        if key in keep:
+            continue
+        name = _singularity_instances.pop(key)
+        console.log(f"Stopping singularity instance {name}")
+        _singularity("instance", "stop", name)
+        instances.pop(key, None)
+    os.environ[SINGULARITY_INSTANCES_ENV] = json.dumps(instances)
+
+
+def stops_singularity_instances(func):
+    """
+    Decorator of a task's run method that stops the singularity instances started while it
+    runs. luigi ends the processes of its workers with os._exit, which skips the exit handlers.
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        running = set(_singularity_instances)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stop_singularity_instances(keep=running)
+
+    return wrapper
+
+
+def start_singularity_instance(image, args):
+    """
+    Return the name of a running singularity instance of `image`, started with the options
+    `args`, to run commands with ``singularity exec instance://<name>``. The instance is started
+    once and handed to all child processes through the environment, so e.g. the branches of a
+    local workflow share it. It has to be stopped with `stop_singularity_instances` by the
+    process that started it, the exit handler that stops it otherwise does not run in the
+    worker processes of luigi.
+
+    :param image: Container image.
+    :param args: List of options of ``singularity instance start``, e.g. bind mounts.
+    :return: The instance name.
+    """
+    key = hashlib.sha256(json.dumps([image, list(args)]).encode()).hexdigest()[:12]
+    instances = json.loads(os.getenv(SINGULARITY_INSTANCES_ENV, "{}"))
+    if key in instances:
+        return instances[key]
+    _stop_orphaned_singularity_instances()
+    name = f"kingmaker_{key}_{os.getpid()}"
+    console.log(f"Starting singularity instance {name} of {image}")
+    code, out, error = _singularity("instance", "start", *args, image, name)
+    if code != 0:
+        console.log(f"Error: {error}")
+        console.log(f"singularity instance start returned non-zero exit status {code}")
+        raise Exception("singularity instance start failed")
+    if not _singularity_instances:
+        atexit.register(_stop_singularity_instances, os.getpid())
+    _singularity_instances[key] = name
+    instances[key] = name
+    os.environ[SINGULARITY_INSTANCES_ENV] = json.dumps(instances)
+    return name
+
+
 class NanoAODVersions(Enum):
     v9 = "nanoAOD_v9"
     v12 = "nanoAOD_v12"
@@ -70,6 +544,11 @@ class Task(law.Task):
         default=False,
         significant=False,
     )
+    tree_index = luigi.BoolParameter(
+        description="Answer existence checks of remote outputs from one recursive listing of the production_tag, taken at startup. False by default.",
+        default=False,
+        significant=False,
+    )
 
     # Modify production_tag to check for override
     production_tag = luigi.Parameter(
@@ -149,9 +628,39 @@ class Task(law.Task):
             return self.local_target(path)
 
         if isinstance(path, (list, tuple)):
-            return [CachedWLCGFileTarget(self.remote_path(p)) for p in path]
+            return [self.remote_target(p) for p in path]
 
-        return CachedWLCGFileTarget(self.remote_path(path))
+        target = CachedWLCGFileTarget(self.remote_path(path))
+        register_cache_shard(target.fs, self.production_tag)
+        # only index on the submitting machine, jobs check just their own outputs
+        if self.tree_index and not os.environ.get("_CONDOR_JOB_IWD"):
+            use_tree_index(target.fs, self.production_tag)
+        return target
+
+    def shared_target(self, path):
+        """
+        Target of a content addressed file outside of the production_tag, shared by all
+        productions on the same output storage.
+        """
+        if self.is_local_output:
+            return law.LocalFileTarget(
+                path,
+                fs=law.LocalFileSystem(
+                    None, base=os.path.expandvars(self.local_output_path)
+                ),
+            )
+        return CachedWLCGFileTarget(path)
+
+    def prefetch_output_existence(self, tasks):
+        """
+        Check the outputs of all `tasks` in one go, with directory listings and remote stats
+        running concurrently, so that the following complete() calls of luigi are answered
+        from the existence cache.
+
+        :param tasks: A task or a (nested) list or dict of tasks.
+        """
+        outputs = [task.output() for task in flatten(tasks)]
+        exists_many(outputs)
 
     def convert_env_to_dict(self, env):
         my_env = {}
@@ -166,11 +675,21 @@ class Task(law.Task):
 
     # Function to apply a source-script and get the resulting environment.
     #   Anything apart from setting paths is likely not included in the resulting envs.
+    #   The changes the scripts make to the environment are cached per script content and
+    #       inherited environment, so repeated calls do not start a new shell, and are
+    #       applied on top of the current environment.
     def set_environment(self, sourcescript, silent=False):
         if not silent:
             console.log(f"with source script: {sourcescript}")
         if isinstance(sourcescript, str):
             sourcescript = [sourcescript]
+        snapshot_key = env_snapshot_key(sourcescript)
+        changes = load_env_snapshot(snapshot_key)
+        if changes is not None:
+            if not silent:
+                console.log("Reusing cached environment")
+            return apply_env_changes(changes)
+        inherited_env = dict(os.environ)
         source_command = [
             f"source {_sourcescript};" for _sourcescript in sourcescript
         ] + ["env"]
@@ -178,6 +697,8 @@ class Task(law.Task):
         code, out, error = interruptable_popen(
             source_command_string,
             shell=True,
+            # source is a bash builtin, /bin/sh may be dash
+            executable="/bin/bash",
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             # rich_console=console
@@ -187,6 +708,7 @@ class Task(law.Task):
             console.log(f"Error: {error}")
             raise Exception("source failed")
         my_env = self.convert_env_to_dict(out)
+        store_env_snapshot(snapshot_key, env_changes(inherited_env, my_env))
         return my_env
 
     # Run a bash command
@@ -293,7 +815,19 @@ class Task(law.Task):
             raise Exception("No command provided.")
 
 
+class HTCondorWorkflowProxy(law.htcondor.workflow.HTCondorWorkflowProxy):
+    def get_extra_submission_data(self, job_file, job_id, config, log=None):
+        extra = super().get_extra_submission_data(job_file, job_id, config, log=log)
+        # law replaces the job id of finished jobs by a dummy id before any callback sees them,
+        #   the extra data is kept, so the id is stored there to look up the usage of the job
+        if job_id != self.job_data.dummy_job_id:
+            extra["htcondor_job_id"] = job_id
+        return extra
+
+
 class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
+    workflow_proxy_cls = HTCondorWorkflowProxy
+
     ENV_NAME = luigi.Parameter(description="Environment to be used in HTCondor job.")
     htcondor_accounting_group = luigi.Parameter(
         description="Accounting group to be set in Hthe TCondor job submission."
@@ -345,7 +879,17 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
     )
     force_repack_tarball = luigi.BoolParameter(
         default=False,
-        description="Force repacking and re-uploading of the job tarball, even if it already exists remotely. Use this after updating task code without removing task outputs.",
+        description="Force repacking and re-uploading of the job tarball, even if it already exists remotely. Not needed after code changes, as the tarball is stored under the hash of its contents.",
+        significant=False,
+    )
+    htcondor_resource_model = luigi.BoolParameter(
+        default=False,
+        description="Request memory, disk and walltime per job from the recorded usage of earlier jobs with the same resource key and a similar number of events. The static requests are used until enough jobs were recorded. Turns off the grouped submission of the jobs, as one grouped submit file holds the same requests for all its jobs.",
+        significant=False,
+    )
+    htcondor_resource_margin = luigi.FloatParameter(
+        default=1.2,
+        description="Factor applied to the resources predicted from the recorded usage.",
         significant=False,
     )
 
@@ -366,6 +910,8 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
         "htcondor_container_image",
         "additional_files",
         "force_repack_tarball",
+        "htcondor_resource_model",
+        "htcondor_resource_margin",
         "workflow",
     }
     exclude_params_req = (
@@ -391,147 +937,257 @@ class HTCondorWorkflow(Task, law.htcondor.HTCondorWorkflow):
         hostfile = self.bootstrap_file
         return law.util.rel_path(__file__, hostfile)
 
-    def htcondor_job_config(self, config, job_num, branches):
-        domain_name = str(socket.getfqdn())
-
-        if domain_name.endswith("cern.ch"):
-            domain = "CERN"
-        elif domain_name.endswith(
-            ("etp.kit.edu", "darwin.kit.edu", "gridka.de", "bwforcluster")
-        ):
-            domain = "ETP"
-        else:
-            print("Unknown domain, default to CERN lxplus settings.")
-            domain = "CERN"
+    def htcondor_job_grouping_submit(self):
+        """
+        Whether the jobs may be submitted in one grouped submit file, if enabled in the law
+        config. A grouped submit file has the same content for all its jobs, so it is turned off
+        when the jobs need individual settings, like the requests of the resource model.
+        """
+        return not self.htcondor_resource_model
 
-        workflow_name = os.getenv("WF_NAME")
-        task_name = self.__class__.__name__
+    def htcondor_create_job_manager(self, **kwargs):
+        job_manager = super().htcondor_create_job_manager(**kwargs)
+        if not self.htcondor_job_grouping_submit():
+            job_manager.job_grouping_submit = False
+        return job_manager
 
-        # Write job config file
-        log_base_path = self.htcondor_log_directory().abspath
-        config.log = os.path.join(log_base_path, "Log_$(JobId).txt")
+    def htcondor_job_config(self, config, job_num, branches):
+        # Everything but the per-job fields is the same for all jobs of the submission
+        submission = self.htcondor_submission_config()
+        config.log = submission["log"]
         config.custom_log_file = os.path.join("All_$(JobId).txt")
         # config.stdout = "Out_$(JobId).txt"
         # config.stderr = "Err_$(JobId).txt"
-        # config.custom_content.append(("stream_error", "True"))  # Remove before commit. Streamed files will end up in
-        # config.custom_content.append(("stream_output", "True"))  # `self.htcondor_create_job_file_factory().dir
+        config.custom_content.extend(submission["custom_content"])
+        resources = self.htcondor_job_resources(branches)
+        if submission["domain"] == "ETP":
+            config.custom_content.append(("+RequestWalltime", resources["walltime"]))
+        elif submission["domain"] == "CERN":
+            config.custom_content.append(("+MaxRuntime", resources["walltime"]))
+        config.custom_content.append(("RequestMemory", resources["memory"]))
+        config.custom_content.append(("RequestDisk", resources["disk"]))
+        config.render_variables.update(submission["render_variables"])
+        return config
+
+    def htcondor_resource_key(self):
+        """
+        Key under which the resource usage of the jobs of this workflow is recorded, or None to
+        not record it. Jobs with the same key are expected to need similar resources for the
+        same number of input events.
+        """
+        return None
+
+    def htcondor_branch_events(self, branch):
+        """
+        Number of input events of a branch, or None if unknown.
+        """
+        return None
+
+    def htcondor_job_events(self, branches):
+        events = [self.htcondor_branch_events(branch) for branch in branches]
+        if None in events:
+            return None
+        return sum(events)
+
+    def htcondor_job_resources(self, branches):
+        """
+        Return the memory (MB), disk (kB) and walltime (s) requests of the job running
+        `branches`. With `htcondor_resource_model`, they are predicted from the recorded usage of
+        earlier jobs, otherwise or without enough history, the static requests are used.
+        """
+        resources = {
+            "memory": self.htcondor_request_memory,
+            "disk": self.htcondor_request_disk,
+            "walltime": self.htcondor_walltime,
+        }
+        key = self.htcondor_resource_key()
+        if not self.htcondor_resource_model or key is None:
+            return resources
+        # the history is read once per workflow
+        model = self.__dict__.get("_htcondor_resource_model")
+        if model is None:
+            model = fit_resource_model(ResourceHistory().jobs(key))
+            self.__dict__["_htcondor_resource_model"] = model
+            console.log(
+                f"Resource model for {key}: "
+                + ", ".join(
+                    f"{resource} {'from history' if params else 'static'}"
+                    for resource, params in model.items()
+                )
+            )
+        resources.update(
+            predict_resources(
+                model, self.htcondor_job_events(branches), self.htcondor_resource_margin
+            )
+        )
+        return resources
+
+    def htcondor_record_resources(self, finished_jobs):
+        """
+        Record the measured resource usage of finished jobs in the resource history. Jobs not
+        yet found in condor_history are looked up again in the following polls.
+
+        :param finished_jobs: Dict mapping job numbers to their job data.
+        """
+        key = self.htcondor_resource_key()
+        if key is None:
+            return
+        pending = self.__dict__.setdefault("_htcondor_resource_pending", {})
+        for data in finished_jobs.values():
+            job_id = data["extra"].get("htcondor_job_id")
+            if job_id is not None:
+                pending[job_id] = [self.htcondor_job_events(data["branches"]), 0]
+        if not pending:
+            return
+        pool = self.htcondor_pool if self.htcondor_pool != law.NO_STR else None
+        scheduler = (
+            self.htcondor_scheduler if self.htcondor_scheduler != law.NO_STR else None
+        )
+        usage = query_job_usage(list(pending), pool=pool, scheduler=scheduler)
+        if usage:
+            ResourceHistory().record(
+                key,
+                {
+                    job_id: dict(values, events=pending.pop(job_id)[0])
+                    for job_id, values in usage.items()
+                    if job_id in pending
+                },
+            )
+        for job_id in list(pending):
+            pending[job_id][1] += 1
+            if pending[job_id][1] >= MAX_HISTORY_ATTEMPTS:
+                del pending[job_id]
+
+    def htcondor_submission_config(self):
+        """
+        Build the parts of the job config that are shared by all jobs of this workflow: the site
+        specific submit file content, the render variables and the location of the uploaded job
+        tarball. They are computed for the first job and reused for all following ones.
+
+        :return: A dict with the site "domain", the "log" path, the "custom_content" list and
+            the "render_variables" dict.
+        """
+        submission = self.__dict__.get("_htcondor_submission")
+        if submission is not None:
+            return submission
+        domain = htcondor_site_domain()
+
+        # Write job config file
+        log_base_path = self.htcondor_log_directory().abspath
+        custom_content = []
+        # custom_content.append(("stream_error", "True"))  # Remove before commit. Streamed files will end up in
+        # custom_content.append(("stream_output", "True"))  # `self.htcondor_create_job_file_factory().dir
         if self.htcondor_requirements:
-            config.custom_content.append(("Requirements", self.htcondor_requirements))
-        config.custom_content.append(("universe", self.htcondor_universe))
-        config.custom_content.append(("container_image", self.htcondor_container_image))
+            custom_content.append(("Requirements", self.htcondor_requirements))
+        custom_content.append(("universe", self.htcondor_universe))
+        custom_content.append(("container_image", self.htcondor_container_image))
         if domain == "ETP":
-            config.custom_content.append(
-                ("accounting_group", self.htcondor_accounting_group)
-            )
-            config.custom_content.append(("+RemoteJob", self.htcondor_remote_job))
-            config.custom_content.append(("+RequestWalltime", self.htcondor_walltime))
-        elif domain == "CERN":
-            config.custom_content.append(("+MaxRuntime", self.htcondor_walltime))
-        config.custom_content.append(("x509userproxy", self.htcondor_user_proxy))
-        config.custom_content.append(("request_cpus", self.htcondor_request_cpus))
+            custom_content.append(("accounting_group", self.htcondor_accounting_group))
+            custom_content.append(("+RemoteJob", self.htcondor_remote_job))
+        custom_content.append(("x509userproxy", self.htcondor_user_proxy))
+        custom_content.append(("request_cpus", self.htcondor_request_cpus))
         # Only include "request_gpus" if any are requested, as nodes with GPU are otherwise excluded
         if float(self.htcondor_request_gpus) > 0:
-            config.custom_content.append(("request_gpus", self.htcondor_request_gpus))
-        config.custom_content.append(("RequestMemory", self.htcondor_request_memory))
-        config.custom_content.append(("RequestDisk", self.htcondor_request_disk))
+            custom_content.append(("request_gpus", self.htcondor_request_gpus))
 
-        # Ensure tarball dir exists
-        if not os.path.exists(f"tarballs/{self.production_tag}"):
-            os.makedirs(f"tarballs/{self.production_tag}")
-        # Repack tarball if it is not available remotely
+        render_variables = {
+            "USER": self.local_user,
+            "WF_NAME": os.getenv("WF_NAME"),
+            "ENV_NAME": self.ENV_NAME,
+            "TAG": self.production_tag,
+            "NTHREADS": self.htcondor_request_cpus,
+            "LUIGIPORT": os.getenv("LUIGIPORT"),
+            "SOURCE_SCRIPT": self.remote_source_script,
+            "IS_LOCAL_OUTPUT": str(self.is_local_output),
+            "TARBALL_PATH": self.htcondor_job_tarball(),
+            "LOCAL_TIMESTAMP": startup_time,
+            "LOCAL_PWD": startup_dir,
+        }
+        submission = {
+            "domain": domain,
+            "log": os.path.join(log_base_path, "Log_$(JobId).txt"),
+            "custom_content": custom_content,
+            "render_variables": render_variables,
+        }
+        self.__dict__["_htcondor_submission"] = submission
+        return submission
 
+    def htcondor_job_tarball(self):
+        """
+        Make sure the job tarball is available on the output storage and return its location.
+        The result is shared by all workflows of the process that pack the same files.
+        """
+        workflow_name = os.getenv("WF_NAME")
+        # The job tarball is content addressed: it is stored under the hash of its inputs,
+        #   so it is only packed and uploaded once for all production tags and tasks
+        tarball_inputs = [
+            "processor",
+            f"lawluigi_configs/{workflow_name}_luigi.cfg",
+            f"lawluigi_configs/{workflow_name}_law.cfg",
+            "law",
+        ] + list(self.additional_files)
         if self.is_local_output:
-            tarball = law.LocalFileTarget(
-                os.path.join(
-                    self.production_tag,
-                    self.__class__.__name__,
-                    "job_tarball",
-                    "processor.tar.gz",
-                ),
-                fs=law.LocalFileSystem(
-                    None,
-                    base=f"{os.path.expandvars(self.local_output_path)}",
-                ),
-            )
+            base = os.path.expandvars(self.local_output_path)
         else:
-            tarball = CachedWLCGFileTarget(
-                os.path.join(
-                    self.production_tag,
-                    self.__class__.__name__,
-                    "job_tarball",
-                    "processor.tar.gz",
-                )
-            )
+            base = os.path.expandvars(self.wlcg_path)
+        upload_key = (tuple(tarball_inputs), self.is_local_output, base)
+        if upload_key in _job_tarball_uploads:
+            return _job_tarball_uploads[upload_key]
+
+        tarball_hash = job_tarball_hash(tarball_inputs)
+        tarball = self.shared_target(
+            os.path.join("job_tarballs", tarball_hash, "processor.tar.gz")
+        )
         if not tarball.exists() or self.force_repack_tarball:
-            # Make new tarball
-            # get absolute path to tarball dir
-            tarball_dir = os.path.abspath(f"tarballs/{self.production_tag}")
             tarball_local = law.LocalFileTarget(
-                os.path.join(
-                    tarball_dir,
-                    task_name,
-                    "processor.tar.gz",
+                os.path.abspath(
+                    os.path.join("tarballs", tarball_hash, "processor.tar.gz")
                 )
             )
-            print(
+            if not tarball_local.exists() or self.force_repack_tarball:
+                pack_job_tarball(tarball_local.path, tarball_inputs)
+            console.log(
                 f"Uploading framework tarball from {tarball_local.path} to {tarball.path}"
             )
-            tarball_local.parent.touch()
-            # Create tarball containing:
-            #   The processor directory, the relevant config files, law
-            #   and any other files specified in the additional_files parameter
-            command = [
-                "tar",
-                "--exclude",
-                "*.pyc",
-                "--exclude",
-                "*.git",
-                "-czf",
-                tarball_local.path,
-                "processor",
-                f"lawluigi_configs/{workflow_name}_luigi.cfg",
-                f"lawluigi_configs/{workflow_name}_law.cfg",
-                "law",
-            ] + list(self.additional_files)
-            code, out, error = interruptable_popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                # rich_console=console
-            )
-            if code != 0:
-                console.log(f"Error when taring job {error}")
-                console.log(f"Output: {out}")
-                console.log(f"tar returned non-zero exit status {code}")
-                console.rule()
-                os.remove(tarball_local.path)
-                raise Exception("tar failed")
-            else:
-                console.rule("Successful tar of framework tarball !")
             # Copy new tarball to remote
             tarball.parent.touch()
             tarball.copy_from_local(src=tarball_local.path)
             console.rule("Framework tarball uploaded!")
-        config.render_variables["USER"] = self.local_user
-        config.render_variables["WF_NAME"] = os.getenv("WF_NAME")
-        config.render_variables["ENV_NAME"] = self.ENV_NAME
-        config.render_variables["TAG"] = self.production_tag
-        config.render_variables["NTHREADS"] = self.htcondor_request_cpus
-        config.render_variables["LUIGIPORT"] = os.getenv("LUIGIPORT")
-        config.render_variables["SOURCE_SCRIPT"] = self.remote_source_script
-
-        config.render_variables["IS_LOCAL_OUTPUT"] = str(self.is_local_output)
-        if not self.is_local_output:
-            config.render_variables["TARBALL_PATH"] = (
-                os.path.expandvars(self.wlcg_path) + tarball.path
-            )
-        else:
-            config.render_variables["TARBALL_PATH"] = (
-                os.path.expandvars(self.local_output_path) + tarball.path
+        _job_tarball_uploads[upload_key] = base + tarball.path
+        return _job_tarball_uploads[upload_key]
+
+    def htcondor_record_finished_jobs(self):
+        """
+        Record the outputs of newly finished jobs in the existence cache. law only reports a job
+        as finished once every branch in it ran successfully, i.e. after all outputs were
+        uploaded, so the completeness checks that follow need no remote stat for them.
+        The resource usage of these jobs is added to the resource history.
+        """
+        recorded_jobs = self.__dict__.setdefault("_cache_recorded_jobs", set())
+        finished_jobs = {}
+        for job_num, data in self.workflow_proxy.job_data.jobs.items():
+            if job_num in recorded_jobs or data["status"] != BaseJobManager.FINISHED:
+                continue
+            recorded_jobs.add(job_num)
+            finished_jobs[job_num] = data
+        if finished_jobs:
+            record_exists(
+                [
+                    self.as_branch(branch).output()
+                    for data in finished_jobs.values()
+                    for branch in data["branches"]
+                ]
             )
-        config.render_variables["LOCAL_TIMESTAMP"] = startup_time
-        config.render_variables["LOCAL_PWD"] = startup_dir
-        return config
+        self.htcondor_record_resources(finished_jobs)
+
+    def htcondor_poll_callback(self, poll_data):
+        self.htcondor_record_finished_jobs()
+        return super().htcondor_poll_callback(poll_data)
+
+    def htcondor_post_poll_callback(self, success, duration):
+        # the poll loop ends before the poll callback if enough jobs finished
+        self.htcondor_record_finished_jobs()
+        return super().htcondor_post_poll_callback(success, duration)
 
     def htcondor_use_local_scheduler(self):
         # always use a local scheduler in remote jobs
@@ -569,3 +1225,8 @@ class KingmakerSandbox(law.SandboxTask):
     sandbox_pre_setup_cmds = sandbox_pre_setup_cmds_factory(
         "X509_USER_PROXY", "LUIGIPORT", "WF_NAME"
     )
+
+    def _initialize_sandbox(self, force=False):
+        # law only finds the singularity sandbox once its contrib package is loaded
+        law.contrib.load("singularity")
+        super()._initialize_sandbox(force=force)
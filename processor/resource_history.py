@@ -0,0 +1,199 @@
+import os
+import json
+import math
+import time
+import shlex
+import sqlite3
+import subprocess
+from law.util import interruptable_popen
+from law.logger import get_logger
+
+logger = get_logger("custom.resource_history")
+
+RESOURCE_HISTORY_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/resource_history.sqlite'
+
+# Resources as requested from HTCondor: memory in MB, disk in kB and walltime in s,
+# together with the job ClassAd that holds the measured usage
+RESOURCE_CLASSADS = {
+    "memory": "MemoryUsage",
+    "disk": "DiskUsage",
+    "walltime": "RemoteWallClockTime",
+}
+# Requests derived from the history never go below these values
+RESOURCE_MINIMUM = {"memory": 1000, "disk": 1000000, "walltime": 1800}
+# Number of finished jobs needed before the history is used, and the most recent jobs used
+MIN_HISTORY_JOBS = 5
+MAX_HISTORY_JOBS = 500
+# Jobs whose usage was not found in condor_history are given up after this many polls
+MAX_HISTORY_ATTEMPTS = 10
+
+
+class ResourceHistory:
+    """
+    Measured resource usage of finished HTCondor jobs in a SQLite database, one row per job.
+
+    Jobs are grouped by a resource key, e.g. task, analysis, config, sample type and era, and
+    carry the number of input events they processed.
+    """
+
+    _SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS jobs (key TEXT NOT NULL, job_id TEXT NOT NULL, "
+        "ts REAL NOT NULL, events REAL, memory REAL, disk REAL, walltime REAL, "
+        "PRIMARY KEY (key, job_id))",
+        "CREATE INDEX IF NOT EXISTS jobs_key_ts ON jobs (key, ts)",
+    ]
+
+    def __init__(self, path=RESOURCE_HISTORY_PATH):
+        self.path = path
+
+    def _connect(self):
+        history_dir = os.path.dirname(self.path)
+        if history_dir and not os.path.exists(history_dir):
+            os.makedirs(history_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self._SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def record(self, key, jobs):
+        """
+        Store the usage of finished jobs.
+
+        :param key: Resource key, a JSON serializable list.
+        :param jobs: Dict mapping job ids to dicts with the number of "events" and the measured
+            "memory", "disk" and "walltime".
+        """
+        now = time.time()
+        rows = [
+            (
+                json.dumps(key),
+                job_id,
+                now,
+                job.get("events"),
+                job.get("memory"),
+                job.get("disk"),
+                job.get("walltime"),
+            )
+            for job_id, job in jobs.items()
+        ]
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+        conn.close()
+
+    def jobs(self, key, limit=MAX_HISTORY_JOBS):
+        """
+        Return the `limit` most recent jobs of `key` as dicts.
+        """
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT events, memory, disk, walltime FROM jobs WHERE key = ? "
+            "ORDER BY ts DESC LIMIT ?",
+            (json.dumps(key), limit),
+        ).fetchall()
+        conn.close()
+        return [
+            dict(zip(("events", "memory", "disk", "walltime"), row)) for row in rows
+        ]
+
+
+def fit_resource_model(jobs, min_jobs=MIN_HISTORY_JOBS):
+    """
+    Fit the usage of each resource as a linear function of the number of input events.
+
+    :param jobs: List of dicts as returned by `ResourceHistory.jobs`.
+    :return: Dict mapping each resource to a tuple (offset, slope, standard deviation of the
+        residuals), or to None if fewer than `min_jobs` jobs measured it. Without event counts
+        the slope is 0 and the offset the mean usage.
+    """
+    model = {}
+    for resource in RESOURCE_CLASSADS:
+        points = [
+            (job["events"] or 0.0, job[resource])
+            for job in jobs
+            if job[resource] is not None
+        ]
+        if len(points) < min_jobs:
+            model[resource] = None
+            continue
+        n = len(points)
+        mean_x = sum(x for x, _ in points) / n
+        mean_y = sum(y for _, y in points) / n
+        var_x = sum((x - mean_x) ** 2 for x, _ in points)
+        if var_x > 0:
+            slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+            # more events never need fewer resources
+            slope = max(slope, 0.0)
+        else:
+            slope = 0.0
+        offset = mean_y - slope * mean_x
+        residuals = [y - (offset + slope * x) for x, y in points]
+        sigma = math.sqrt(sum(r**2 for r in residuals) / max(n - 2, 1))
+        model[resource] = (offset, slope, sigma)
+    return model
+
+
+def predict_resources(model, events, margin):
+    """
+    Predict the resources of a job with `events` input events.
+
+    The prediction is the fitted usage plus two standard deviations, scaled by `margin`.
+
+    :return: Dict mapping the resources with a model to the integer request.
+    """
+    requests = {}
+    for resource, params in model.items():
+        if params is None:
+            continue
+        offset, slope, sigma = params
+        usage = offset + slope * (events or 0.0) + 2 * sigma
+        requests[resource] = max(
+            int(math.ceil(usage * margin)), RESOURCE_MINIMUM[resource]
+        )
+    return requests
+
+
+def query_job_usage(job_ids, pool=None, scheduler=None):
+    """
+    Look up the measured resource usage of finished jobs with condor_history.
+
+    :param job_ids: List of HTCondor job ids (cluster.proc).
+    :return: Dict mapping the job ids found in the history to dicts with their "memory",
+        "disk" and "walltime" usage.
+    """
+    if not job_ids:
+        return {}
+    cmd = ["condor_history"] + list(job_ids)
+    if pool:
+        cmd += ["-pool", pool]
+    if scheduler:
+        cmd += ["-name", scheduler]
+    cmd += ["-af:j"] + list(RESOURCE_CLASSADS.values())
+    cmd += ["-limit", str(len(job_ids))]
+    code, out, error = interruptable_popen(
+        shlex.join(cmd),
+        shell=True,
+        executable="/bin/bash",
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if code != 0:
+        logger.warning(f"condor_history returned non-zero exit status {code}: {error}")
+        return {}
+    usage = {}
+    for line in out.splitlines():
+        fields = line.split()
+        if len(fields) != len(RESOURCE_CLASSADS) + 1:
+            continue
+        values = {}
+        for resource, value in zip(RESOURCE_CLASSADS, fields[1:]):
+            try:
+                values[resource] = float(value)
+            except ValueError:
+                # undefined ClassAds
+                values[resource] = None
+        usage[fields[0]] = values
+    return usage
@@ -2,18 +2,31 @@ import law
 import luigi
 import os
 import json
+import shlex
 from framework import (
     console,
     HTCondorWorkflow,
     Task,
     KingmakerSandbox,
+    node_resources,
+    run_local_pool,
     sandbox_pre_setup_cmds_factory,
+    start_singularity_instance,
+    stop_singularity_instances,
 )
+from caching import CachedWLCGFileTarget, record_exists
+from unpack_cache import UNPACK_CACHE_DIR, UnpackCache, file_adler32
+from contextlib import contextmanager
 from law.task.base import WrapperTask
-from rich.table import Table
-from helpers.helpers import convert_to_comma_seperated
+from helpers.helpers import convert_to_comma_seperated, get_xrootd_checksum
 import hashlib
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Failed uploads are retried after 1, 2, 4, ... s, at most one minute
+UPLOAD_BACKOFF_BASE = 1
+UPLOAD_BACKOFF_MAX = 60
 
 
 class ProduceBase(WrapperTask, Task):
@@ -106,6 +119,8 @@ class ProduceBase(WrapperTask, Task):
         data["sample_types"] = set()
         data["eras"] = set()
         data["details"] = {}
+        from rich.table import Table
+
         table = Table(title=f"Samples (selected Scopes: {self.scopes})")
         table.add_column("Samplenick", justify="left")
         table.add_column("Era", justify="left")
@@ -160,6 +175,44 @@ class CROWNExecuteBase(HTCondorWorkflow, law.LocalWorkflow):
         significant=False,
         description="Map specific sample_types to custom files_per_task",
     )
+    local_cores = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="Number of cores to run the branches of the local workflow on in parallel, packed by htcondor_request_cpus and htcondor_request_memory. -1 uses all cores of the node, 0 runs the branches one after another.",
+    )
+    local_memory = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="Memory (MB) available to the parallel branches of the local workflow. 0 uses the available memory of the node.",
+    )
+    local_singularity_instance = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="Run the commands of local branches in one long-lived singularity instance of the container image, instead of starting a new container for every command.",
+    )
+    upload_workers = luigi.IntParameter(
+        default=4,
+        significant=False,
+        description="Number of output files uploaded in parallel at the end of a branch.",
+    )
+    unpack_cache_dir = luigi.Parameter(
+        default="",
+        significant=False,
+        description="Node-local directory of the unpacked CROWN tarballs, shared by all tasks on the machine. Empty uses $KINGMAKER_UNPACK_CACHE or /tmp/kingmaker_unpack_cache_<uid>.",
+    )
+    unpack_cache_quota = luigi.FloatParameter(
+        default=20.0,
+        significant=False,
+        description="Size (GB) above which the least recently used unpacked tarballs are removed.",
+    )
+
+    # luigi exits with 0 on failed tasks unless told otherwise
+    local_retcode_args = {
+        "--retcode-task-failed": "1",
+        "--retcode-scheduling-error": "1",
+        "--retcode-missing-data": "1",
+        "--retcode-unhandled-exception": "1",
+    }
 
     def htcondor_output_directory(self):
         if hasattr(self, "friend_config") and self.friend_config != "":
@@ -169,6 +222,16 @@ class CROWNExecuteBase(HTCondorWorkflow, law.LocalWorkflow):
             path = f"htcondor_files/ntuples/{self.nick}"
         return self.local_dir_target(path)
 
+    def htcondor_resource_key(self):
+        if hasattr(self, "friend_config") and self.friend_config != "":
+            config = self.friend_config
+        else:
+            config = self.config
+        return [self.task_family, self.analysis, config, self.sample_type, self.era]
+
+    def htcondor_branch_events(self, branch):
+        return self.branch_map[branch].get("nevents")
+
     def htcondor_job_config(self, config, job_num, branches):
         effective_name = (
             self.friend_mapping[self.friend_config]["friend_tag"]
@@ -182,6 +245,229 @@ class CROWNExecuteBase(HTCondorWorkflow, law.LocalWorkflow):
         config.custom_content.append(("JobBatchName", condor_batch_name_pattern))
         return config
 
+    def local_log_directory(self):
+        return law.LocalDirectoryTarget(
+            os.path.join(self.htcondor_output_directory().abspath, "local_logs")
+        )
+
+    def local_branch_command(self, branch):
+        """
+        Build the `law run` command of a single branch, the same way law does for the branches of
+        an HTCondor job, but with a local scheduler.
+        """
+        exclude_args = (
+            self.exclude_params_branch
+            | self.exclude_params_workflow
+            | {"effective_workflow", "local_cores", "local_memory"}
+        )
+        proxy_cmd = law.task.proxy.ProxyCommand(
+            self.as_branch(branch),
+            exclude_task_args=exclude_args,
+            exclude_global_args=["workers", "local-scheduler", self.task_family + "-*"],
+        )
+        proxy_cmd.add_arg("--branch", str(branch), overwrite=True)
+        proxy_cmd.add_arg("--local-scheduler", "True", overwrite=True)
+        for key, value in self.htcondor_cmdline_args().items():
+            proxy_cmd.add_arg(key, value, overwrite=True)
+        for key, value in self.local_retcode_args.items():
+            proxy_cmd.add_arg(key, value, overwrite=True)
+        return shlex.split(proxy_cmd.build())
+
+    def local_workflow_pre_run(self):
+        """
+        With `local_cores` set, run all missing branches of the local workflow in parallel
+        processes on this node before law starts them one after another. Each branch runs in
+        its own `law run` process and writes its log to `local_log_directory`. The branches
+        found complete afterwards are not run again by law.
+        """
+        if self.local_cores == 0:
+            return super().local_workflow_pre_run()
+        node_cores, node_memory = node_resources()
+        cores = node_cores if self.local_cores < 0 else self.local_cores
+        memory = self.local_memory or node_memory
+        existing = set(self.output()["collection"].count(keys=True)[1])
+        missing = [
+            branch for branch in self.get_branch_tasks() if branch not in existing
+        ]
+        if not missing:
+            return
+        log_dir = self.local_log_directory().abspath
+        jobs = {
+            f"branch {branch}": {
+                "branch": branch,
+                "command": self.local_branch_command(branch),
+                "log": os.path.join(log_dir, f"branch_{branch}.log"),
+                "cpus": int(self.htcondor_request_cpus),
+                "memory": int(float(self.htcondor_request_memory)),
+            }
+            for branch in missing
+        }
+        console.rule(
+            f"Running {len(jobs)} branches of {self.task_family} on {cores} cores "
+            f"and {memory} MB"
+        )
+        console.log(f"Branch logs are written to {log_dir}")
+        if self.local_singularity_instance:
+            # start the instance here, so that all branches share it
+            self.local_container_instance()
+        try:
+            exit_codes = run_local_pool(jobs, cores, memory)
+        finally:
+            stop_singularity_instances()
+        finished = [
+            jobs[name]["branch"] for name, code in exit_codes.items() if code == 0
+        ]
+        failed = [jobs[name] for name, code in exit_codes.items() if code != 0]
+        if finished:
+            # the branches only exit successfully after their outputs were uploaded
+            record_exists([self.as_branch(branch).output() for branch in finished])
+        if failed:
+            for job in failed:
+                console.log(f"Branch {job['branch']} failed, see {job['log']}")
+            raise Exception(f"{len(failed)} of {len(jobs)} local branches failed")
+        console.rule(f"Finished {len(jobs)} branches of {self.task_family}")
+
+    def local_singularity_args(self):
+        singularity_args = ["-B", "/etc/grid-security/certificates", "-B", "/cvmfs"]
+        if self.is_local_output:
+            singularity_args += ["-B", "/" + self.local_output_path.split("/")[1]]
+        # the executables are linked from the unpack cache, /tmp is bound by default
+        if self.unpack_cache_dir:
+            os.makedirs(self.unpack_cache_dir, exist_ok=True)
+            singularity_args += ["-B", self.unpack_cache_dir]
+        return singularity_args
+
+    def local_container_instance(self):
+        """
+        Return the name of the long-lived singularity instance of the container image that the
+        commands of local branches run in, starting it on first use.
+        """
+        return start_singularity_instance(
+            str(self.htcondor_container_image), self.local_singularity_args()
+        )
+
+    def target_checksum(self, target):
+        """
+        Return the adler32 checksum of a file target without reading it remotely: from the
+        XRootD server, or from the file itself for local targets. None if the server does not
+        provide one.
+        """
+        if isinstance(target, law.LocalFileTarget):
+            return file_adler32(target.abspath)
+        try:
+            return get_xrootd_checksum(target.uri())
+        except Exception as e:
+            console.log(f"Could not query the checksum of {target.uri()}: {e}")
+            return None
+
+    def upload_outputs(self, uploads, retries=5):
+        """
+        Upload local files to their output targets, `upload_workers` at a time. Each upload is
+        verified against the adler32 checksum reported by the server, or against the file size
+        if the server does not provide checksums. Failed or corrupt uploads are removed and
+        retried with exponential backoff. An upload only counts as existing in the target cache
+        after it was verified.
+
+        :param uploads: List of tuples (output target, local path).
+        :param retries: Number of attempts per file.
+        :return: A list of dicts with the "uri", "size", "adler32" and the "verified" property
+            of each upload.
+        """
+
+        def upload(item):
+            target, path = item
+            size = os.path.getsize(path)
+            checksum = file_adler32(path)
+            cached = isinstance(target, CachedWLCGFileTarget)
+            for i in range(retries):
+                start = time.time()
+                try:
+                    if cached:
+                        target.copy_from_local(path, record=False)
+                    else:
+                        target.copy_from_local(path)
+                    remote_checksum = self.target_checksum(target)
+                    if remote_checksum is not None:
+                        verified = "adler32"
+                        ok = remote_checksum == checksum
+                    else:
+                        verified = "size"
+                        remote_checksum = target.stat().st_size
+                        ok = remote_checksum == size
+                except Exception as e:
+                    console.log(f"Upload of {path} failed (attempt {i+1}): {e}")
+                else:
+                    if ok:
+                        if cached:
+                            record_exists(target)
+                        console.log(
+                            f"Uploaded {os.path.basename(path)} ({size / 1024**2:.1f} MB, "
+                            f"adler32 {checksum}) in {time.time() - start:.1f} s"
+                        )
+                        return {
+                            "uri": target.uri(),
+                            "size": size,
+                            "adler32": checksum,
+                            "verified": verified,
+                        }
+                    console.log(
+                        f"Upload of {path} is corrupt (attempt {i+1}): "
+                        f"{verified} {remote_checksum}, expected "
+                        f"{checksum if verified == 'adler32' else size}"
+                    )
+                    target.remove(silent=True)
+                if i + 1 < retries:
+                    delay = min(UPLOAD_BACKOFF_BASE * 2**i, UPLOAD_BACKOFF_MAX)
+                    time.sleep(delay * random.uniform(0.5, 1.0))
+            raise Exception(f"Upload of {path} failed after {retries} attempts")
+
+        if not uploads:
+            return []
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(self.upload_workers, len(uploads)))
+        ) as executor:
+            return list(executor.map(upload, uploads))
+
+    def tarball_checksum(self, tarball):
+        """
+        Content key of a tarball target, obtained without downloading it: the adler32 checksum
+        from the XRootD server, or from the file itself for local targets. If the server does
+        not provide a checksum, the key is derived from the URI, size and modification time.
+        """
+        checksum = self.target_checksum(tarball)
+        if checksum is not None:
+            return f"adler32-{checksum}"
+        stat = tarball.stat()
+        key = f"{tarball.uri()}:{stat.st_size}:{stat.st_mtime}"
+        return f"stat-{hashlib.sha256(key.encode()).hexdigest()[:16]}"
+
+    @contextmanager
+    def unpacked_tarball(self, tarball):
+        """
+        Context manager yielding the directory of the unpacked tarball target in the node-local
+        `UnpackCache`. The tarball is only downloaded and unpacked if no task on the machine did
+        so before, and the directory is not evicted until the context is left.
+        """
+        key = self.tarball_checksum(tarball)
+        cache = UnpackCache(
+            self.unpack_cache_dir or UNPACK_CACHE_DIR, self.unpack_cache_quota
+        )
+
+        @contextmanager
+        def fetch():
+            console.log(f"Getting CROWN tarball from {tarball.uri()}")
+            with tarball.localize("r") as _file:
+                if key.startswith("adler32-"):
+                    checksum = file_adler32(_file.abspath)
+                    if f"adler32-{checksum}" != key:
+                        raise Exception(
+                            f"Checksum of {tarball.uri()} is {checksum}, expected {key}"
+                        )
+                yield _file.abspath
+
+        with cache.entry(key, fetch) as entry:
+            yield entry
+
     def wrap_executable_command(self, command):
         """
         CROWN executables are linked with an RPATH pointing at the container's
@@ -193,12 +479,15 @@ class CROWNExecuteBase(HTCondorWorkflow, law.LocalWorkflow):
         """
         if self.effective_workflow != "local":
             return command
-        singularity_args = ["-B", "/etc/grid-security/certificates", "-B", "/cvmfs"]
-        if self.is_local_output:
-            singularity_args += ["-B", "/" + self.local_output_path.split("/")[1]]
+        if self.local_singularity_instance:
+            return [
+                "singularity",
+                "exec",
+                f"instance://{self.local_container_instance()}",
+            ] + command
         return (
             ["singularity", "exec"]
-            + singularity_args
+            + self.local_singularity_args()
             + [str(self.htcondor_container_image)]
             + command
         )
@@ -314,7 +603,8 @@ class CROWNBuildBase(KingmakerSandbox, Task):
         tarball file that needs to be uploaded
         :param retries: The `retries` parameter is an optional parameter that specifies the number of times
         the upload should be retried in case of failure. By default, it is set to 3, meaning that the upload
-        will be attempted up to 3 times before giving up, defaults to 3 (optional)
+        will be attempted up to 3 times before giving up, defaults to 3 (optional). The waiting time between
+        attempts doubles after each failure, with some jitter so that parallel uploads do not retry in lockstep
         :return: The function `upload_tarball` returns a boolean value. It returns `True` if the tarball is
         successfully uploaded, and `False` if the upload fails after the specified number of retries.
         """
@@ -327,6 +617,8 @@ class CROWNBuildBase(KingmakerSandbox, Task):
                 return True
             except Exception as e:
                 console.log(f"Upload failed (attempt {i+1}): {e}")
-                time.sleep(1)
+                if i + 1 < retries:
+                    delay = min(UPLOAD_BACKOFF_BASE * 2**i, UPLOAD_BACKOFF_MAX)
+                    time.sleep(delay * random.uniform(0.5, 1.0))
         console.log(f"Upload failed after {retries} attempts.")
         return False
@@ -1,10 +1,9 @@
 import luigi
 import os
-import tarfile
 import subprocess
-import time
 import law
-from framework import console
+from framework import console, stops_singularity_instances
+from unpack_cache import link_entry
 from CROWNMain import CROWNRun
 from helpers.helpers import create_abspath
 from CROWNBase import CROWNExecuteBase
@@ -43,6 +42,7 @@ class CROWNFriend(CROWNExecuteBase):
             for inputfile in inputs["ntuples"]["collection"]._flat_target_list
             if inputfile.path.endswith(".root")
         ]
+        ntuple_branches = CROWNRun.req(self).branch_map
         required_friends = self.friend_mapping[self.friend_config].get("requires", [])
         friend_inputs = [
             inputs[
@@ -73,6 +73,9 @@ class CROWNFriend(CROWNExecuteBase):
                     + inputfile.path,
                     "filecounter": int(counter / len(self.scopes)),
                 }
+                branch_map[counter]["nevents"] = ntuple_branches.get(
+                    branch_map[counter]["filecounter"], {}
+                ).get("nevents")
                 filename = inputfile.path.split("/")[-1]
                 for friend_index, _ in enumerate(required_friends):
                     if not friend_branches[friend_index][counter].path.endswith(
@@ -124,6 +127,7 @@ class CROWNFriend(CROWNExecuteBase):
         targets = self.remote_target(nicks)
         return targets
 
+    @stops_singularity_instances
     def run(self):
         """
         The function runs a CROWN friend process, unpacking a tarball if necessary, setting the
@@ -153,58 +157,36 @@ class CROWNFriend(CROWNExecuteBase):
         ]
         # set the outputfilename to the first name in the output list, removing the scope suffix
         _outputfile = str(output.basename.replace(f"_{scope}.root", ".root"))
-        _abs_executable = "{}/{}_{}_{}".format(
-            _workdir, self.friend_config, sample_type, era
-        )
-        console.log(
-            "Getting CROWN friend_tarball from {}".format(
-                inputs["friend_tarball"].uri()
-            )
-        )
-        with inputs["friend_tarball"].localize("r") as _file:
-            _tarballpath = _file.path
-        # first unpack the tarball if the exec is not there yet
-        tempfile = os.path.join(
-            _workdir,
-            "unpacking_{}_{}_{}".format(self.friend_config, sample_type, era),
-        )
-        while os.path.exists(tempfile):
-            time.sleep(1)
-        if not os.path.exists(_abs_executable):
-            # create a temp file to signal that we are unpacking
-            open(
-                tempfile,
-                "a",
-            ).close()
-            tar = tarfile.open(_tarballpath, "r:gz")
-            tar.extractall(_workdir)
-            os.remove(tempfile)
         _crown_args = [_outputfile] + [_inputfile] + _friend_inputs
         _executable = "./{}_{}_{}_{}".format(
             self.friend_config, sample_type, era, scope
         )
-        # actual payload:
-        console.rule("Starting CROWNMultiFriends")
-        console.log("Executable: {}".format(_executable))
-        console.log("inputfile(s) {} {}".format(_inputfile, _friend_inputs))
-        console.log("outputfile {}".format(_outputfile))
-        console.log("workdir {}".format(_workdir))  # run CROWN
-        command = self.wrap_executable_command([_executable] + _crown_args)
-        console.log(f"Running command: {command}")
-        with subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
-            cwd=_workdir,
-        ) as p:
-            for line in p.stdout:
-                if line != "\n":
-                    console.log(line.replace("\n", ""))
-            for line in p.stderr:
-                if line != "\n":
-                    console.log("Error: {}".format(line.replace("\n", "")))
+        # the executable is unpacked once per node and linked into the workdir,
+        # the shared lock on it is held until CROWN is done
+        with self.unpacked_tarball(inputs["friend_tarball"]) as _unpacked:
+            link_entry(_unpacked, _workdir)
+            # actual payload:
+            console.rule("Starting CROWNMultiFriends")
+            console.log("Executable: {}".format(_executable))
+            console.log("inputfile(s) {} {}".format(_inputfile, _friend_inputs))
+            console.log("outputfile {}".format(_outputfile))
+            console.log("workdir {}".format(_workdir))  # run CROWN
+            command = self.wrap_executable_command([_executable] + _crown_args)
+            console.log(f"Running command: {command}")
+            with subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=1,
+                universal_newlines=True,
+                cwd=_workdir,
+            ) as p:
+                for line in p.stdout:
+                    if line != "\n":
+                        console.log(line.replace("\n", ""))
+                for line in p.stderr:
+                    if line != "\n":
+                        console.log("Error: {}".format(line.replace("\n", "")))
         if p.returncode != 0:
             console.log(
                 "Error when running crown {}".format(
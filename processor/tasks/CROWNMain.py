@@ -1,25 +1,61 @@
+import law
 import luigi
 import os
-import tarfile
 import subprocess
 import threading
 import time
 import json
 import hashlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from CROWNBase import CROWNBuildBase
-from framework import console, Task
+from framework import console, job_tarball_hash, node_resources, Task
+from framework import stops_singularity_instances
+from caching import exists_many
+from resource_history import ResourceHistory, fit_resource_model
+from unpack_cache import link_entry, pack_tarball
 from helpers.helpers import create_abspath
 from CROWNBase import CROWNExecuteBase
-from helpers.helpers import get_alternate_file_uri
+from helpers.helpers import ReplicaCache, locate_replicas
+from helpers.helpers import resolve_alternate_file_uris
 from helpers.helpers import convert_to_comma_seperated
 
 _dataset_filelist_cache = {}
 _dataset_filelist_lock = threading.Lock()
 
+# Servers to read the input files from, in order of preference: if the file is available on
+# GridKA, take it from there, otherwise, use the official European or global redirector.
+PREFERRED_XROOTD_SERVERS = [
+    "root://cmsdcache-kit-disk.gridka.de",
+    "root://xrootd-cms.infn.it",
+    "root://cms-xrd-global.cern.ch",
+]
+# Name of the job input file with the replicas located on the submission host
+REPLICAS_FILE = "replicas.json"
+
 _source_hash_cache = {}
 _source_hash_lock = threading.Lock()
 
 
+def is_crown_executable(name, config):
+    # the executables of a config are named <config>_<sample_type>_<era>
+    return name.startswith(config) and not name.endswith((".tar.gz", ".hash"))
+
+
+def pack_crown_executable(unpacked_dir, config, sample_type, era, tarball, threads=1):
+    """
+    Pack the executable of a sample type and era from the install directory of the combined
+    build into `tarball`, the libraries are packed once by CROWNBuildLibs.
+    """
+    executables = [
+        name
+        for name in os.listdir(unpacked_dir)
+        if is_crown_executable(name, config) and name.endswith(f"{sample_type}_{era}")
+    ]
+    os.makedirs(os.path.dirname(tarball), exist_ok=True)
+    pack_tarball(unpacked_dir, executables, tarball, threads)
+    return tarball
+
+
 def load_dataset_filelist(dataset_task):
     # dataset_task.output().localize() is a real network copy; cache it so the
     # per-sample cost is paid once even though create_branch_map runs it again later
@@ -39,16 +75,92 @@ def load_dataset_filelist(dataset_task):
     return inputdata
 
 
+def estimate_file_events(inputdata):
+    """
+    Estimate the number of events of each file of a sample from the sample database entry.
+
+    Per-file event counts are taken from the optional "file_nevents" mapping. Otherwise the
+    total "nevents" of the sample is split by the optional "file_sizes" mapping of byte sizes,
+    or evenly between the files.
+
+    :param inputdata: Sample database entry with the "filelist".
+    :return: A list with the number of events of each file in the filelist, or None if the
+        sample has no event count.
+    """
+    filelist = inputdata["filelist"]
+    file_nevents = inputdata.get("file_nevents") or {}
+    if filelist and all(filename in file_nevents for filename in filelist):
+        return [float(file_nevents[filename]) for filename in filelist]
+    nevents = inputdata.get("nevents")
+    if not nevents:
+        return None
+    file_sizes = inputdata.get("file_sizes") or {}
+    if filelist and all(file_sizes.get(filename) for filename in filelist):
+        total_size = sum(float(file_sizes[filename]) for filename in filelist)
+        return [nevents * float(file_sizes[f]) / total_size for f in filelist]
+    return [nevents / len(filelist)] * len(filelist)
+
+
+def pack_files_by_events(filelist, file_events, events_per_task):
+    """
+    Group consecutive files into branches of up to `events_per_task` events (next fit). A file
+    with more events than the target gets a branch of its own. The grouping only depends on
+    the order of the filelist and the event counts, so the branch numbering is reproducible.
+
+    :return: A list of (files, events) tuples, one per branch.
+    """
+    branches = []
+    files, events = [], 0.0
+    for filename, nevents in zip(filelist, file_events):
+        if files and events + nevents > events_per_task:
+            branches.append((files, events))
+            files, events = [], 0.0
+        files.append(filename)
+        events += nevents
+    if files:
+        branches.append((files, events))
+    return branches
+
+
 class CROWNRun(CROWNExecuteBase):
     """
     Gather and compile CROWN with the given configuration
     """
 
     problematic_eras = luigi.ListParameter()
+    branch_map_mode = luigi.ChoiceParameter(
+        choices=["files", "events"],
+        default="files",
+        significant=False,
+        description="Group the input files into branches by a fixed number of files (files_per_task) or by their number of events (events_per_task or walltime_per_task). Only used when the branch map of the nick is first created for a production_tag, see CROWNRun.branch_map_target.",
+    )
+    events_per_task = luigi.IntParameter(
+        default=2000000,
+        significant=False,
+        description="Target number of events per branch in the events branch map mode. Only used when the branch map of the nick is first created for a production_tag.",
+    )
+    resolve_replicas = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="Locate the replicas of all input files on the preferred servers concurrently on the submission host when the branch map is created, and pass them to the jobs.",
+    )
+    rank_replicas = luigi.BoolParameter(
+        default=False,
+        significant=False,
+        description="Probe the XRootD servers holding the input files in each job and read from them in the order of their measured latency and throughput, instead of the order of PREFERRED_XROOTD_SERVERS.",
+    )
+    walltime_per_task = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="Target runtime (s) per branch in the events branch map mode, converted to events with the recorded runtime of earlier jobs. Uses events_per_task if 0 or without enough history. Only used when the branch map of the nick is first created for a production_tag.",
+    )
 
     def workflow_requires(self):
         requirements = {}
         requirements["dataset"] = {}
+        requirements["crown_libs"] = CROWNBuildLibs.req(
+            self, htcondor_request_cpus=self.htcondor_request_cpus
+        )
         for sample_type in self.all_sample_types:
             for era in self.all_eras:
                 requirements[f"tarball_{sample_type}_{era}"] = CROWNBuild.req(
@@ -59,14 +171,52 @@ class CROWNRun(CROWNExecuteBase):
                 )
         return requirements
 
-    def create_branch_map(self):
-        branch_map = {}
-        branchcounter = 0
+    def target_events_per_task(self):
+        """
+        Return the target number of events per branch. With `walltime_per_task`, it is derived
+        from the runtime per event recorded for earlier jobs of this sample type and era.
+        """
+        if self.walltime_per_task > 0:
+            model = fit_resource_model(
+                ResourceHistory().jobs(self.htcondor_resource_key())
+            )
+            offset, slope, _ = model["walltime"] or (0, 0, 0)
+            if slope > 0:
+                return max(int((self.walltime_per_task - max(offset, 0)) / slope), 1)
+            console.log(
+                f"No runtime history for {self.nick}, using events_per_task={self.events_per_task}"
+            )
+        return self.events_per_task
+
+    def branch_map_target(self):
+        """
+        File with the files of each branch of the nick. It is written when the branch map is
+        first created for the production_tag and used from then on, as the outputs are named
+        by the branch number. Later changes of the branching parameters or of the resource
+        history do not renumber the branches of an existing production.
+        """
+        return self.remote_target(f"branch_maps/{self.nick}.json")
+
+    def group_input_files(self):
+        """
+        Group the input files of the nick into branches following the branching parameters.
+
+        :return: A list of (files, events) tuples, one per branch, events may be None.
+        """
         dataset = ConfigureDatasets.req(self)
         inputdata = load_dataset_filelist(dataset)
-        branches = {}
-        if len(inputdata["filelist"]) == 0:
+        filelist = inputdata["filelist"]
+        if len(filelist) == 0:
             raise Exception("No files found for dataset {}".format(self.nick))
+        file_events = estimate_file_events(inputdata)
+        if self.branch_map_mode == "events" and file_events is not None:
+            return pack_files_by_events(
+                filelist, file_events, self.target_events_per_task()
+            )
+        if self.branch_map_mode == "events":
+            console.log(
+                f"No event counts for {self.nick}, grouping its files by files_per_task"
+            )
         files_per_task = self.files_per_task
         custom_fpt = self.custom_files_per_task.get(self.sample_type)
         if custom_fpt is not None:
@@ -75,19 +225,96 @@ class CROWNRun(CROWNExecuteBase):
             era in self.nick for era in self.problematic_eras
         ):
             files_per_task = 1
-        for filecounter, filename in enumerate(inputdata["filelist"]):
-            if (int(filecounter / files_per_task)) not in branches:
-                branches[int(filecounter / files_per_task)] = []
-            branches[int(filecounter / files_per_task)].append(filename)
-        for x in branches:
-            branch_map[branchcounter] = {}
-            branch_map[branchcounter]["nick"] = self.nick
-            branch_map[branchcounter]["era"] = self.era
-            branch_map[branchcounter]["sample_type"] = self.sample_type
-            branch_map[branchcounter]["files"] = branches[x]
-            branchcounter += 1
+        return [
+            (
+                filelist[i : i + files_per_task],
+                (
+                    sum(file_events[i : i + files_per_task])
+                    if file_events is not None
+                    else None
+                ),
+            )
+            for i in range(0, len(filelist), files_per_task)
+        ]
+
+    def create_branch_map(self):
+        target = self.branch_map_target()
+        if target.exists():
+            branches = [
+                (branch["files"], branch["nevents"])
+                for branch in target.load(formatter="json")["branches"]
+            ]
+        else:
+            branches = self.group_input_files()
+            # the jobs only get here if the branch map could not be written
+            if not os.getenv("_CONDOR_JOB_IWD"):
+                target.parent.touch()
+                target.dump(
+                    {
+                        "branch_map_mode": self.branch_map_mode,
+                        "branches": [
+                            {"files": files, "nevents": nevents}
+                            for files, nevents in branches
+                        ],
+                    },
+                    formatter="json",
+                )
+        filelist = [filename for files, _ in branches for filename in files]
+        if self.resolve_replicas and not os.getenv("_CONDOR_JOB_IWD"):
+            # the jobs only resolve the files of their own branches
+            start = time.time()
+            locate_replicas(filelist, PREFERRED_XROOTD_SERVERS)
+            console.log(
+                f"Located replicas of {len(filelist)} files of {self.nick} "
+                f"in {time.time() - start:.1f} s"
+            )
+        branch_map = {}
+        for branchcounter, (files, nevents) in enumerate(branches):
+            branch_map[branchcounter] = {
+                "nick": self.nick,
+                "era": self.era,
+                "sample_type": self.sample_type,
+                "files": files,
+                "nevents": nevents,
+            }
         return branch_map
 
+    def htcondor_job_config(self, config, job_num, branches):
+        config = super().htcondor_job_config(config, job_num, branches)
+        if self.resolve_replicas:
+            # ship the replicas of the job's input files, located with the branch map
+            if isinstance(job_num, list):
+                # grouped submission, the jobs of the submit file share one replicas file and
+                #   each looks up its own files in it
+                job_dir = f"group_{law.util.create_hash(job_num)}"
+                branches = [
+                    branch for job_branches in branches for branch in job_branches
+                ]
+            else:
+                job_dir = str(job_num)
+            files = [f for branch in branches for f in self.branch_map[branch]["files"]]
+            cache = ReplicaCache()
+            attempts = self.workflow_proxy.job_data.attempts
+            if any(
+                attempts.get(num, 0)
+                for num in (job_num if isinstance(job_num, list) else [job_num])
+            ):
+                # a retry, the shipped replicas may be the ones that could not be read,
+                #   the job locates its files again instead
+                cache.invalidate(files)
+            replicas = cache.get_many(files, PREFERRED_XROOTD_SERVERS)
+            path = os.path.join(
+                self.htcondor_output_directory().abspath,
+                "replicas",
+                job_dir,
+                REPLICAS_FILE,
+            )
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(replicas, f)
+            config.input_files["replicas"] = law.JobInputFile(path, copy=False)
+        return config
+
     def output(self):
         targets = []
         nicks = [
@@ -102,6 +329,20 @@ class CROWNRun(CROWNExecuteBase):
         targets = self.remote_target(nicks)
         return targets
 
+    def upload_metadata_target(self):
+        """
+        File with the size and adler32 checksum of the uploaded outputs of the branch. It is not
+        part of the output, so productions without it are still complete.
+        """
+        return self.remote_target(
+            "upload_metadata/{era}/{nick}/{nick}_{branch}.json".format(
+                era=self.branch_data["era"],
+                nick=self.branch_data["nick"],
+                branch=self.branch,
+            )
+        )
+
+    @stops_singularity_instances
     def run(self):
         outputs = self.output()
         inputs = self.workflow_input()
@@ -113,71 +354,65 @@ class CROWNRun(CROWNExecuteBase):
         )
         create_abspath(_workdir)
         _inputfiles = branch_data["files"]
+        _original_inputfiles = _inputfiles
         _sample_type = branch_data["sample_type"]
         _era = branch_data["era"]
 
-        # This call aims to get a "better" XRootD server to access the file.
-        # If the file is available on GridKA, take it from there.
-        # Otherwise, use the official European or global redirector.
-        _inputfiles = [
-            get_alternate_file_uri(
-                filename,
-                [
-                    "root://cmsdcache-kit-disk.gridka.de",
-                    "root://xrootd-cms.infn.it",
-                    "root://cms-xrd-global.cern.ch",
-                ],
-            )
-            for filename in _inputfiles
-        ]
+        # This call aims to get a "better" XRootD server to access the file, from
+        # PREFERRED_XROOTD_SERVERS, with rank_replicas ranked by their measured latency
+        # and throughput. Replicas located on the submission host are shipped with the job, the
+        # others are located concurrently.
+        _replicas = {}
+        _replicas_file = os.path.join(os.getenv("LAW_JOB_INIT_DIR", ""), REPLICAS_FILE)
+        if os.getenv("LAW_JOB_INIT_DIR") and os.path.exists(_replicas_file):
+            with open(_replicas_file, "r") as f:
+                _replicas = json.load(f)
+        _inputfiles = resolve_alternate_file_uris(
+            _inputfiles,
+            PREFERRED_XROOTD_SERVERS,
+            known=_replicas,
+            rank=self.rank_replicas,
+        )
         # set the outputfilename to the first name in the output list, removing the scope suffix
         _outputfile = str(
             outputs[0].basename.replace("_{}.root".format(self.scopes[0]), ".root")
         )
-        _abs_executable = "{}/{}_{}_{}".format(
-            _workdir, self.config, _sample_type, _era
-        )
         _tarball = inputs["tarball_{}_{}".format(_sample_type, _era)]
-        console.log(f"Getting CROWN tarball from {_tarball.uri()}")
-        with _tarball.localize("r") as _file:
-            _tarballpath = _file.path
-        # first unpack the tarball if the exec is not there yet
-        _tempfile = os.path.join(
-            _workdir,
-            "unpacking_{}_{}_{}".format(self.config, _sample_type, _era),
+        _libs_tarball = self.shared_target(
+            inputs["crown_libs"].load(formatter="json")["path"]
         )
-        while os.path.exists(_tempfile):
-            time.sleep(1)
-        if not os.path.exists(_abs_executable) and not os.path.exists(_tempfile):
-            # create a temp file to signal that we are unpacking
-            open(_tempfile, "a").close()
-            tar = tarfile.open(_tarballpath, "r:gz")
-            tar.extractall(_workdir)
-            os.remove(_tempfile)
         _crown_args = [_outputfile] + _inputfiles
         _executable = "./{}_{}_{}".format(self.config, _sample_type, _era)
-        # actual payload:
-        console.rule("Starting CROWNRun")
-        console.log("Executable: {}".format(_executable))
-        console.log("inputfile {}".format(_inputfiles))
-        console.log("outputfile {}".format(_outputfile))
-        console.log("workdir {}".format(_workdir))  # run CROWN
-        command = self.wrap_executable_command([_executable] + _crown_args)
-        console.log(f"Running command: {command}")
-        with subprocess.Popen(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=1,
-            universal_newlines=True,
-            cwd=_workdir,
-        ) as p:
-            for line in p.stdout:
-                if line != "\n":
-                    console.log(line.replace("\n", ""))
-            for line in p.stderr:
-                if line != "\n":
-                    console.log("Error: {}".format(line.replace("\n", "")))
+        # the executable is unpacked once per node and linked into the workdir,
+        # the shared lock on it is held until CROWN is done
+        with self.unpacked_tarball(_libs_tarball) as _libs, self.unpacked_tarball(
+            _tarball
+        ) as _unpacked:
+            link_entry(_libs, _workdir)
+            # next to the linked libraries, which it finds relative to its location
+            link_entry(_unpacked, _workdir, copy_files=True)
+            # actual payload:
+            console.rule("Starting CROWNRun")
+            console.log("Executable: {}".format(_executable))
+            console.log("inputfile {}".format(_inputfiles))
+            console.log("outputfile {}".format(_outputfile))
+            console.log("workdir {}".format(_workdir))  # run CROWN
+            command = self.wrap_executable_command([_executable] + _crown_args)
+            console.log(f"Running command: {command}")
+            with subprocess.Popen(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=1,
+                universal_newlines=True,
+                cwd=_workdir,
+            ) as p:
+                for line in p.stdout:
+                    if line != "\n":
+                        console.log(line.replace("\n", ""))
+                for line in p.stderr:
+                    if line != "\n":
+                        console.log("Error: {}".format(line.replace("\n", "")))
         if p.returncode != 0:
             console.log(
                 "Error when running crown {}".format(
@@ -185,34 +420,52 @@ class CROWNRun(CROWNExecuteBase):
                 )
             )
             console.log("crown returned non-zero exit status {}".format(p.returncode))
+            # an input may not be readable from the resolved replica anymore, check the
+            #   replicas again in the next run instead of reusing them from the cache
+            ReplicaCache().invalidate(_original_inputfiles)
             raise Exception("crown failed")
         else:
             console.log("Successful")
         console.log("Output files afterwards: {}".format(os.listdir(_workdir)))
-        # Small delay to ensure file handles are released
-        time.sleep(1)
-        for i, outputfile in enumerate(outputs):
-            local_filename = os.path.join(
+        local_filenames = [
+            os.path.join(
                 _workdir,
-                _outputfile.replace(".root", "_{}.root".format(self.scopes[i])),
-            )
-            # if the output files were produced in multithreaded mode,
-            # we have to open the files once again, setting the
-            # kEntriesReshuffled bit to false, otherwise,
-            # we cannot add any friends to the trees
-            command = self.wrap_executable_command(
-                [
-                    "python3",
-                    "processor/tasks/helpers/ResetROOTStatusBit.py",
-                    "--input {}".format(local_filename),
-                ]
+                _outputfile.replace(".root", "_{}.root".format(scope)),
             )
-            self.run_command(
-                command=command,
-                silent=True,
+            for scope in self.scopes
+        ]
+        # if the output files were produced in multithreaded mode,
+        # we have to open the files once again, setting the
+        # kEntriesReshuffled bit to false, otherwise,
+        # we cannot add any friends to the trees.
+        # All scopes are handled in one process to pay the ROOT import once.
+        command = self.wrap_executable_command(
+            [
+                "python3",
+                "processor/tasks/helpers/ResetROOTStatusBit.py",
+                "--input",
+            ]
+            + local_filenames
+        )
+        _start = time.time()
+        out = self.run_command(
+            command=command,
+            silent=True,
+            collect_out=True,
+        )
+        summary = [line for line in out.splitlines() if line.startswith("Reset ")]
+        console.log(
+            f"{summary[-1] if summary else 'Reset status bits'} "
+            f"(total {time.time() - _start:.2f} s)"
+        )
+        # upload the outputs of all scopes concurrently and keep their checksums and sizes
+        uploads = self.upload_outputs(list(zip(outputs, local_filenames)))
+        try:
+            self.upload_metadata_target().dump(
+                {"branch": self.branch, "outputs": uploads}, formatter="json", indent=4
             )
-            # for each outputfile, add the scope suffix
-            outputfile.copy_from_local(local_filename)
+        except Exception as e:
+            console.log(f"Could not store the upload metadata: {e}")
         console.rule("Finished CROWNRun")
 
 
@@ -335,7 +588,7 @@ class CROWNBuild(CROWNBuildBase):
 
     def requires(self):
         result = {
-            "combined_build": CROWNBuildCombined.req(
+            "executables": CROWNBuildExecutables.req(
                 self,
                 htcondor_request_cpus=self.htcondor_request_cpus,
             )
@@ -347,6 +600,13 @@ class CROWNBuild(CROWNBuildBase):
             f"crown_{self.analysis}_{self.config}_{self.sample_type}_{self.era}.tar.gz"
         )
 
+    def crown_tarball_path(self):
+        """
+        Local path of the tarball before the upload
+        """
+        _tag = f"{self.production_tag}/CROWN_{self.analysis}_{self.config}_{self.sample_type}_{self.era}"
+        return os.path.join(str(self.install_dir), _tag, self.output().basename)
+
     def run(self):
         # get output file path
         output = self.output()
@@ -354,42 +614,29 @@ class CROWNBuild(CROWNBuildBase):
         _config = str(self.config)
         _era = str(self.era)
         _sample_type = str(self.sample_type)
-        # also use the tag for the local tarball creation
-        _tag = (
-            f"{self.production_tag}/CROWN_{_analysis}_{_config}_{_sample_type}_{_era}"
-        )
-        _install_dir = os.path.join(str(self.install_dir), _tag)
+        # usually packed and uploaded together with all other eras and sample types
+        if output.exists():
+            console.log(f"{output.basename} already uploaded by CROWNBuildExecutables")
+            return
         _unpacked_dir = os.path.join(
             str(self.install_dir), f"{self.production_tag}/CROWN_{_analysis}_{_config}"
         )
-        _tarball = os.path.join(_install_dir, output.basename)
-        os.makedirs(os.path.dirname(_tarball), exist_ok=True)
         if not os.path.exists(_unpacked_dir):
             raise FileNotFoundError(
                 f"No builds for {self.production_tag}/CROWN_{_analysis}_{_config} found"
             )
-
-        # now pack the specific tarball, excluding unwanted executables
-        def exclude_files(tarinfo):
-            filename = os.path.basename(tarinfo.name)
-            if filename.endswith(".tar.gz"):
-                return None
-            if filename.startswith(f"{_config}") and not filename.endswith(
-                f"{_sample_type}_{_era}"
-            ):
-                return None
-            else:
-                return tarinfo
-
         console.log(f"Creating tarball for {_sample_type} {_era}")
-        with tarfile.open(_tarball, "w:gz") as tar:
-            tar.add(
-                _unpacked_dir,
-                arcname=".",
-                filter=exclude_files,
-            )
+        _tarball = pack_crown_executable(
+            _unpacked_dir,
+            _config,
+            _sample_type,
+            _era,
+            self.crown_tarball_path(),
+            node_resources()[0],
+        )
         # now upload the tarball
-        self.upload_tarball(output, os.path.join(_install_dir, output.basename), 10)
+        if not self.upload_tarball(output, _tarball, 10):
+            raise Exception(f"Upload of {_tarball} failed")
         # delete the local tarball
         os.remove(_tarball)
         console.rule(
@@ -397,6 +644,163 @@ class CROWNBuild(CROWNBuildBase):
         )
 
 
+class CROWNBuildExecutables(CROWNBuildBase):
+    """
+    Pack the executables of all sample types and eras of the combined CROWN build in parallel
+    and upload them as the outputs of the CROWNBuild tasks
+    """
+
+    pack_workers = luigi.IntParameter(
+        default=0,
+        significant=False,
+        description="Number of tarballs packed in parallel, sharing the cores of the node. 0 packs all at once, up to the number of cores.",
+    )
+    upload_streams = luigi.IntParameter(
+        default=8,
+        significant=False,
+        description="Number of tarballs uploaded in parallel.",
+    )
+
+    def requires(self):
+        result = {
+            "combined_build": CROWNBuildCombined.req(
+                self,
+                htcondor_request_cpus=self.htcondor_request_cpus,
+            )
+        }
+        return result
+
+    def crown_builds(self):
+        return {
+            f"{sample_type}_{era}": CROWNBuild.req(
+                self, sample_type=sample_type, era=era
+            )
+            for sample_type in self.all_sample_types
+            for era in self.all_eras
+        }
+
+    def output(self):
+        return {key: task.output() for key, task in self.crown_builds().items()}
+
+    def run(self):
+        _analysis = str(self.analysis)
+        _config = str(self.config)
+        _unpacked_dir = os.path.join(
+            str(self.install_dir), f"{self.production_tag}/CROWN_{_analysis}_{_config}"
+        )
+        if not os.path.exists(_unpacked_dir):
+            raise FileNotFoundError(
+                f"No builds for {self.production_tag}/CROWN_{_analysis}_{_config} found"
+            )
+        builds = self.crown_builds()
+        outputs = {key: task.output() for key, task in builds.items()}
+        existing = exists_many(list(outputs.values()))
+        missing = {
+            key: task for key, task in builds.items() if not existing[outputs[key]]
+        }
+        if not missing:
+            console.log("All CROWN tarballs are already uploaded")
+            return
+        cores = node_resources()[0]
+        workers = min(len(missing), self.pack_workers or cores)
+        threads = max(1, cores // workers)
+        console.rule(
+            f"Packing {len(missing)} CROWN tarballs with {workers} workers "
+            f"of {threads} threads"
+        )
+        failed = []
+        with ProcessPoolExecutor(max_workers=workers) as pack_pool, ThreadPoolExecutor(
+            max_workers=max(1, self.upload_streams)
+        ) as upload_pool:
+            packed = {
+                pack_pool.submit(
+                    pack_crown_executable,
+                    _unpacked_dir,
+                    _config,
+                    task.sample_type,
+                    task.era,
+                    task.crown_tarball_path(),
+                    threads,
+                ): key
+                for key, task in missing.items()
+            }
+            uploads = {}
+            # upload each tarball as soon as it is packed
+            for future in as_completed(packed):
+                key = packed[future]
+                tarball = future.result()
+                console.log(f"Packed {os.path.basename(tarball)}")
+                uploads[
+                    upload_pool.submit(self.upload_tarball, outputs[key], tarball, 10)
+                ] = (key, tarball)
+            for future in as_completed(uploads):
+                key, tarball = uploads[future]
+                if future.result():
+                    os.remove(tarball)
+                else:
+                    failed.append(key)
+        if failed:
+            raise Exception(f"Upload of the CROWN tarballs {failed} failed")
+        console.rule(f"Finished CROWNBuildExecutables for {_analysis} {_config}")
+
+
+class CROWNBuildLibs(CROWNBuildBase):
+    """
+    Pack the libraries and data files shared by all executables of the combined CROWN build
+    into one tarball. The tarball is stored under the hash of its contents outside of the
+    production_tag, so identical builds of other eras and productions share it, and the
+    output only points to it.
+    """
+
+    def requires(self):
+        result = {
+            "combined_build": CROWNBuildCombined.req(
+                self,
+                htcondor_request_cpus=self.htcondor_request_cpus,
+            )
+        }
+        return result
+
+    def output(self):
+        return self.remote_target(
+            f"crown_{self.analysis}_{self.config}_libs_{self.get_tarball_hash()}.json"
+        )
+
+    def run(self):
+        output = self.output()
+        _analysis = str(self.analysis)
+        _config = str(self.config)
+        _tag = f"{self.production_tag}/CROWN_{_analysis}_{_config}"
+        _unpacked_dir = os.path.join(str(self.install_dir), _tag)
+        _install_dir = os.path.join(str(self.install_dir), f"{_tag}_libs")
+        if not os.path.exists(_unpacked_dir):
+            raise FileNotFoundError(f"No builds for {_tag} found")
+        # everything but the executables and the tarballs and markers of the build
+        _shared = [
+            name
+            for name in os.listdir(_unpacked_dir)
+            if not is_crown_executable(name, _config)
+            and not name.endswith((".tar.gz", ".hash"))
+        ]
+        _hash = job_tarball_hash(_shared, directory=_unpacked_dir)
+        libs = self.shared_target(
+            os.path.join("crown_libs", _hash, "crown_libs.tar.gz")
+        )
+        if libs.exists():
+            console.log(f"Shared CROWN libraries already uploaded to {libs.path}")
+        else:
+            _tarball = os.path.join(_install_dir, _hash, libs.basename)
+            os.makedirs(os.path.dirname(_tarball), exist_ok=True)
+            console.log(f"Creating tarball of {_shared}")
+            pack_tarball(_unpacked_dir, _shared, _tarball, node_resources()[0])
+            if not self.upload_tarball(libs, _tarball, 10):
+                raise Exception(f"Upload of {_tarball} failed")
+            os.remove(_tarball)
+        output.parent.touch()
+        output.dump({"path": libs.path}, formatter="json", indent=4)
+        console.rule(f"Finished CROWNBuildLibs for {_analysis} {_config}")
+
+
 class BuildCROWNLib(CROWNBuildBase):
     """
     Compile the CROWN shared libary to be used for all executables with the given configuration
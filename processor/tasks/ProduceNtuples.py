@@ -205,4 +205,10 @@ class ProduceNtuples(ProduceBase):
                     sample_type=data["details"][samplenick]["sample_type"],
                 )
 
+        # check the outputs of all workflows concurrently instead of one by one in luigi,
+        #   once per task, as luigi calls requires() repeatedly
+        if not self.__dict__.get("_prefetched_output_existence"):
+            self.prefetch_output_existence(requirements)
+            self.__dict__["_prefetched_output_existence"] = True
+
         return requirements
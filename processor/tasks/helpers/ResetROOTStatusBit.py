@@ -1,33 +1,63 @@
-import ROOT
-import argparse
+import time
+
+_import_start = time.perf_counter()
+import ROOT  # noqa: E402
+import argparse  # noqa: E402
+
+_import_time = time.perf_counter() - _import_start
 
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Reset ROOT status bit")
-    parser.add_argument("--input", help="input file")
+    parser.add_argument(
+        "--input",
+        nargs="+",
+        help="input file(s), all processed in this process",
+    )
     args = parser.parse_args()
     return args
 
 
 def reset_status_bit(input_file):
+    """
+    Reset the kEntriesReshuffled bit of the ntuple tree in `input_file`. The file is only
+    opened for update, and only the tree header rewritten, if the bit is set.
+
+    :return: True if the bit was reset.
+    """
     print(f"Trying to reset status bit for {input_file}")
-    rfile = ROOT.TFile(input_file, "UPDATE")
+    rfile = ROOT.TFile(input_file, "READ")
     if "ntuple" not in [x.GetTitle() for x in rfile.GetListOfKeys()]:
         print(f"ntuple tree not found in {input_file}, continueing...")
         rfile.Close()
-        return
+        return False
+    is_set = rfile.Get("ntuple").TestBit(ROOT.TTree.EStatusBits.kEntriesReshuffled)
+    rfile.Close()
+    if not is_set:
+        print(f"Bit is not set for {input_file}, nothing to do")
+        return False
+    print("Bit is set, resetting....")
+    rfile = ROOT.TFile(input_file, "UPDATE")
     t = rfile.Get("ntuple")
-    if t.TestBit(ROOT.TTree.EStatusBits.kEntriesReshuffled):
-        print("Bit is set, resetting....")
-        t.ResetBit(ROOT.TTree.EStatusBits.kEntriesReshuffled)
-    rfile.Write()
+    t.ResetBit(ROOT.TTree.EStatusBits.kEntriesReshuffled)
+    t.Write("", ROOT.TObject.kOverwrite)
     rfile.Close()
     print(f"Successfully reset status bit for {input_file}")
+    return True
 
 
 # call the function with the input file
 if __name__ == "__main__":
     args = parse_args()
-    reset_status_bit(args.input)
+    start = time.perf_counter()
+    n_reset = 0
+    for input_file in args.input:
+        file_start = time.perf_counter()
+        n_reset += reset_status_bit(input_file)
+        print(f"{input_file}: {time.perf_counter() - file_start:.2f} s")
+    print(
+        f"Reset status bit in {n_reset} of {len(args.input)} files in "
+        f"{time.perf_counter() - start:.2f} s, ROOT import {_import_time:.2f} s"
+    )
     print("Done")
     exit(0)
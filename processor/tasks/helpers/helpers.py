@@ -1,29 +1,67 @@
 from functools import cache
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re
+import json
+import time
+import sqlite3
+import statistics
 import traceback
 import logging
 from law.logger import get_logger
-from XRootD.client import FileSystem
-from XRootD.client.flags import StatInfoFlags
 
 # Get law loggers for this module
 logger = get_logger("xrootd.stat")
 
+# Resolved replicas of input files, see resolve_alternate_file_uris
+REPLICA_CACHE_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/replica_cache.sqlite'
+# Found replicas are reused for a day, files without a replica on the preferred
+# servers are checked again after an hour. Entries of inputs that could not be read are
+# dropped before, see ReplicaCache.invalidate
+REPLICA_TTL = 86400
+MISSING_REPLICA_TTL = 3600
+REPLICA_STAT_TIMEOUT = 10
+REPLICA_WORKERS = 32
+# History of the XRootD servers, see rank_xrootd_servers
+SERVER_STATS_PATH = f'{os.getenv("LAW_HOME", "/tmp")}/xrootd_server_stats.sqlite'
+SERVER_HISTORY_AGE = 2 * 86400
+SERVER_HISTORY_MEASUREMENTS = 50
+# Servers are probed with a small read at most every 15 minutes
+SERVER_PROBE_INTERVAL = 900
+PROBE_READ_BYTES = 4 * 1024**2
+# Size of a typical input file, to weigh the open latency against the throughput
+SERVER_REFERENCE_BYTES = 2 * 1024**3
+SERVER_MAX_FAILURE_RATE = 0.5
+SERVER_PREFERENCE_PENALTY = 0.2
+
+
+# The XRootD bindings are only imported on first use, so that importing the task modules in
+# `law index`, `law run` and every job bootstrap does not pay for them.
+def _traced_fs_stat(original_stat):
+    """
+    Wrap `XRootD.client.FileSystem.stat` to trace all XRootD stat calls with their call site.
+    Only active when the xrootd.stat logger is set to debug level.
+    """
 
-# Patch FileSystem.stat to trace all XRootD stat calls with their call site.
-# Only active when TRACE_XRD_STAT=1 is set at call time.
-_original_fs_stat = FileSystem.stat
+    def stat(self, path, *args, **kwargs):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"[XRootD STAT] {self.url}{path}")
+            logger.debug("".join(traceback.format_stack(limit=6)))
+        return original_stat(self, path, *args, **kwargs)
 
+    stat._kingmaker_traced = True
+    return stat
 
-def _traced_fs_stat(self, path, *args, **kwargs):
-    if logger.isEnabledFor(logging.DEBUG):
-        logger.debug(f"[XRootD STAT] {self.url}{path}")
-        logger.debug("".join(traceback.format_stack(limit=6)))
-    return _original_fs_stat(self, path, *args, **kwargs)
 
+def _xrootd_filesystem_class():
+    """
+    Import `XRootD.client.FileSystem` and patch its stat method for tracing, once.
+    """
+    from XRootD.client import FileSystem
 
-FileSystem.stat = _traced_fs_stat
+    if not getattr(FileSystem.stat, "_kingmaker_traced", False):
+        FileSystem.stat = _traced_fs_stat(FileSystem.stat)
+    return FileSystem
 
 
 def convert_to_comma_seperated(listobject):
@@ -68,7 +106,7 @@ def create_abspath(file_path):
 
 
 @cache
-def get_xrootd_client(xrootd_server: str) -> FileSystem:
+def get_xrootd_client(xrootd_server: str) -> "XRootD.client.FileSystem":
     """
     Get the `XRootD.client.FileSystem` for an `xrootd_server`.
 
@@ -80,7 +118,7 @@ def get_xrootd_client(xrootd_server: str) -> FileSystem:
     :returns: An `XRootD.client.FileSystem`, providing a file system-like
         interface to the server.
     """
-    return FileSystem(xrootd_server)
+    return _xrootd_filesystem_class()(xrootd_server)
 
 
 def get_alternate_file_uri(
@@ -119,18 +157,428 @@ def get_alternate_file_uri(
     # Check whether the file fulfills the pattern of a usual XRootD file path.
     # If not, just return the file without modifying the path. Otherwise,
     # extract the file path without the server address.
-    m = re.match(r"^((root|davs)://[^/]+)/+(.+)$", file)
-    if m is None:
+    path = _xrootd_path(file)
+    if path is None:
         return file
-    path = f"/{m.group(3).rstrip('/')}"
 
     # Cycle through the given XRootD servers and check if the file exists
     # there. Return the first one that is found. If no file is found on the
     # servers given in the list, the original file is returned.
     for xrootd_server in xrootd_servers:
-        status, stat_info = get_xrootd_client(xrootd_server).stat(path)
-        if status.ok:
-            if (stat_info.flags & StatInfoFlags.IS_READABLE) > 0:
-                return f"{xrootd_server.rstrip('/')}///{path.lstrip('/')}"
+        if _is_readable(xrootd_server, path):
+            return _replica_uri(xrootd_server, path)
 
     return file
+
+
+def get_xrootd_checksum(
+    file: str, checksum_type: str = "adler32", timeout: int = REPLICA_STAT_TIMEOUT
+) -> str:
+    """
+    Query the checksum of a file from its XRootD server, without reading the file.
+
+    :param file: File URI for a file on an XRootD server.
+    :param checksum_type: Checksum algorithm, as named by XRootD.
+    :param timeout: Timeout of the query in seconds.
+
+    :returns: The checksum as hex string, or None if `file` is no XRootD URI or the server
+        does not provide a checksum of this type.
+    """
+    m = re.match(r"^(root://[^/]+)", file)
+    if m is None:
+        return None
+    from XRootD.client.flags import QueryCode
+
+    status, response = get_xrootd_client(m.group(1)).query(
+        QueryCode.CHECKSUM,
+        f"{_xrootd_path(file)}?cks.type={checksum_type}",
+        timeout=timeout,
+    )
+    if not status.ok or not response:
+        return None
+    fields = response.decode().strip("\x00").split()
+    if len(fields) != 2 or fields[0] != checksum_type:
+        return None
+    return fields[1].lower().zfill(8)
+
+
+def _xrootd_path(file):
+    m = re.match(r"^((root|davs)://[^/]+)/+(.+)$", file)
+    if m is None:
+        return None
+    return f"/{m.group(3).rstrip('/')}"
+
+
+def _replica_uri(xrootd_server, path):
+    return f"{xrootd_server.rstrip('/')}///{path.lstrip('/')}"
+
+
+def _is_readable(xrootd_server, path, timeout=0):
+    from XRootD.client.flags import StatInfoFlags
+
+    status, stat_info = get_xrootd_client(xrootd_server).stat(path, timeout=timeout)
+    return status.ok and (stat_info.flags & StatInfoFlags.IS_READABLE) > 0
+
+
+class ReplicaCache:
+    """
+    Persistent cache of the preferred servers that hold an input file in a SQLite database, so
+    that branches, local runs and re-submissions reuse them. Entries are keyed by the file and
+    the set of candidate servers, a file without replica on these servers is stored with an
+    empty list.
+    """
+
+    def __init__(self, path=REPLICA_CACHE_PATH):
+        self.path = path
+
+    def _connect(self):
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS readable_servers (file TEXT NOT NULL, "
+            "servers TEXT NOT NULL, readable TEXT NOT NULL, ts REAL NOT NULL, "
+            "PRIMARY KEY (file, servers))"
+        )
+        return conn
+
+    def get_many(self, files, xrootd_servers):
+        """
+        Return ``{file: [readable servers]}`` for the files with a valid entry.
+        """
+        servers = json.dumps(sorted(xrootd_servers))
+        now = time.time()
+        located = {}
+        conn = self._connect()
+        for file in set(files):
+            row = conn.execute(
+                "SELECT readable, ts FROM readable_servers WHERE file = ? AND servers = ?",
+                (file, servers),
+            ).fetchone()
+            if row is None:
+                continue
+            readable, ts = json.loads(row[0]), row[1]
+            ttl = REPLICA_TTL if readable else MISSING_REPLICA_TTL
+            if now - ts < ttl:
+                located[file] = readable
+        conn.close()
+        return located
+
+    def put_many(self, located, xrootd_servers):
+        servers = json.dumps(sorted(xrootd_servers))
+        now = time.time()
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO readable_servers VALUES (?, ?, ?, ?)",
+                [
+                    (file, servers, json.dumps(readable), now)
+                    for file, readable in located.items()
+                ],
+            )
+        conn.close()
+
+    def invalidate(self, files):
+        """
+        Drop the entries of `files`, e.g. after a job failed to read them, so that their replicas
+        are located again on the next use.
+        """
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "DELETE FROM readable_servers WHERE file = ?",
+                [(file,) for file in set(files)],
+            )
+        conn.close()
+
+
+def locate_replicas(
+    files: list[str],
+    xrootd_servers: list[str],
+    timeout: int = REPLICA_STAT_TIMEOUT,
+    max_workers: int = REPLICA_WORKERS,
+    known: dict = None,
+) -> dict:
+    """
+    Find the servers in `xrootd_servers` that hold a readable replica of each file, with all
+    stat requests for all files and servers running concurrently, each limited to `timeout`
+    seconds. Results are taken from and stored in the `ReplicaCache`.
+
+    :param files: File URIs.
+    :param xrootd_servers: List of candidate XRootD server URIs.
+    :param timeout: Timeout of a single stat request in seconds.
+    :param max_workers: Number of concurrent stat requests.
+    :param known: Optional dict of already located ``{file: [readable servers]}``, e.g.
+        located on the submission host, that is used before the cache.
+
+    :returns: A dict ``{file: [readable servers]}`` for all files with an XRootD-like URI,
+        with the servers in the order of `xrootd_servers`.
+    """
+    wanted = set(files)
+    located = {
+        file: readable for file, readable in (known or {}).items() if file in wanted
+    }
+    paths = {
+        file: _xrootd_path(file)
+        for file in wanted
+        if file not in located and _xrootd_path(file) is not None
+    }
+    if paths:
+        cache = ReplicaCache()
+        located.update(cache.get_many(list(paths), xrootd_servers))
+        paths = {file: path for file, path in paths.items() if file not in located}
+    if paths:
+        requests = [
+            (server, path) for path in paths.values() for server in xrootd_servers
+        ]
+
+        def check(request):
+            server, path = request
+            try:
+                return _is_readable(server, path, timeout=timeout)
+            except Exception as e:
+                logger.warning(f"Could not stat {path} on {server}: {e}")
+                return False
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            readable = dict(zip(requests, executor.map(check, requests)))
+        found = {
+            file: [server for server in xrootd_servers if readable[(server, path)]]
+            for file, path in paths.items()
+        }
+        cache.put_many(found, xrootd_servers)
+        located.update(found)
+    return located
+
+
+def resolve_alternate_file_uris(
+    files: list[str],
+    xrootd_servers: list[str],
+    timeout: int = REPLICA_STAT_TIMEOUT,
+    max_workers: int = REPLICA_WORKERS,
+    known: dict = None,
+    rank: bool = False,
+) -> list[str]:
+    """
+    Resolve the preferred replica of each file like `get_alternate_file_uri`, with the
+    replicas found by `locate_replicas`.
+
+    :param files: File URIs.
+    :param xrootd_servers: List of XRootD server URIs in order of preference.
+    :param timeout: Timeout of a single stat request in seconds.
+    :param max_workers: Number of concurrent stat requests.
+    :param known: Optional dict of already located ``{file: [readable servers]}``.
+    :param rank: Probe the servers holding the files if their history is outdated, and
+        prefer them in the order of `rank_xrootd_servers` instead of the given order.
+
+    :returns: The list of resolved file URIs, in the order of `files`.
+    """
+    located = locate_replicas(files, xrootd_servers, timeout, max_workers, known)
+    order = xrootd_servers
+    if rank:
+        stats = XRootDServerStats()
+        # probe every server with the first file it holds
+        candidates = {}
+        for file in files:
+            for server in located.get(file, []):
+                candidates.setdefault(server, _xrootd_path(file))
+        probe_xrootd_servers(candidates, stats=stats, timeout=timeout)
+        order = rank_xrootd_servers(xrootd_servers, stats=stats)
+        logger.info(f"XRootD servers ranked by their history: {order}")
+    resolved = []
+    for file in files:
+        readable = set(located.get(file, []))
+        server = next((server for server in order if server in readable), None)
+        if server is None:
+            resolved.append(file)
+        else:
+            resolved.append(_replica_uri(server, _xrootd_path(file)))
+    return resolved
+
+
+class XRootDServerStats:
+    """
+    History of the open latency and the read throughput achieved with XRootD servers in a
+    SQLite database, one row per measurement. Measurements are tagged with their source and
+    summarized per source.
+    """
+
+    _SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS measurements (server TEXT NOT NULL, ts REAL NOT NULL, "
+        "source TEXT NOT NULL, ok INTEGER NOT NULL, latency REAL, throughput REAL)",
+        "CREATE INDEX IF NOT EXISTS measurements_server_ts ON measurements (server, ts)",
+    ]
+
+    def __init__(self, path=SERVER_STATS_PATH):
+        self.path = path
+
+    def _connect(self):
+        stats_dir = os.path.dirname(self.path)
+        if stats_dir and not os.path.exists(stats_dir):
+            os.makedirs(stats_dir, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        for statement in self._SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def record(self, server, source, ok=True, latency=None, throughput=None):
+        """
+        Store a measurement of `server`.
+
+        :param source: Origin of the measurement, e.g. "probe".
+        :param ok: Whether the file could be opened and read.
+        :param latency: Time to open the file in s.
+        :param throughput: Read throughput in bytes/s.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?)",
+                (server, time.time(), source, int(ok), latency, throughput),
+            )
+            # only the recent history is used, keep the database small
+            conn.execute(
+                "DELETE FROM measurements WHERE ts < ?",
+                (time.time() - SERVER_HISTORY_AGE,),
+            )
+        conn.close()
+
+    def summary(self, servers, source="probe"):
+        """
+        Summarize the last `SERVER_HISTORY_MEASUREMENTS` measurements from `source` of each
+        server.
+
+        :return: Dict mapping the servers with measurements to dicts with the number of
+            measurements "n" and "failures", the median "latency" and "throughput" of the
+            successful ones, or None, and the time of the last measurement "last".
+        """
+        cutoff = time.time() - SERVER_HISTORY_AGE
+        summary = {}
+        conn = self._connect()
+        for server in servers:
+            rows = conn.execute(
+                "SELECT ts, ok, latency, throughput FROM measurements "
+                "WHERE server = ? AND source = ? AND ts > ? ORDER BY ts DESC LIMIT ?",
+                (server, source, cutoff, SERVER_HISTORY_MEASUREMENTS),
+            ).fetchall()
+            if not rows:
+                continue
+            latencies = [row[2] for row in rows if row[1] and row[2] is not None]
+            throughputs = [row[3] for row in rows if row[1] and row[3] is not None]
+            summary[server] = {
+                "n": len(rows),
+                "failures": sum(1 for row in rows if not row[1]),
+                "latency": statistics.median(latencies) if latencies else None,
+                "throughput": statistics.median(throughputs) if throughputs else None,
+                "last": rows[0][0],
+            }
+        conn.close()
+        return summary
+
+
+def probe_xrootd_server(
+    xrootd_server: str,
+    path: str,
+    read_bytes: int = PROBE_READ_BYTES,
+    timeout: int = REPLICA_STAT_TIMEOUT,
+) -> dict:
+    """
+    Open `path` on `xrootd_server` and read its first `read_bytes` bytes.
+
+    :returns: A dict with "ok", the open "latency" in s and the read "throughput" in bytes/s.
+    """
+    from XRootD.client import File
+
+    f = File()
+    start = time.perf_counter()
+    status, _ = f.open(_replica_uri(xrootd_server, path), timeout=timeout)
+    if not status.ok:
+        return {"ok": False, "latency": None, "throughput": None}
+    latency = time.perf_counter() - start
+    start = time.perf_counter()
+    status, data = f.read(0, read_bytes, timeout=timeout)
+    elapsed = time.perf_counter() - start
+    f.close(timeout=timeout)
+    if not status.ok:
+        return {"ok": False, "latency": latency, "throughput": None}
+    return {
+        "ok": True,
+        "latency": latency,
+        "throughput": len(data) / elapsed if elapsed > 0 and data else None,
+    }
+
+
+def probe_xrootd_servers(
+    candidates: dict,
+    stats: XRootDServerStats = None,
+    timeout: int = REPLICA_STAT_TIMEOUT,
+    interval: float = SERVER_PROBE_INTERVAL,
+):
+    """
+    Concurrently probe the servers whose last probe is older than `interval` seconds, and
+    record the results.
+
+    :param candidates: Dict mapping servers to the path of a file they hold.
+    """
+    stats = stats or XRootDServerStats()
+    summary = stats.summary(list(candidates))
+    now = time.time()
+    outdated = {
+        server: path
+        for server, path in candidates.items()
+        if server not in summary or now - summary[server]["last"] > interval
+    }
+    if not outdated:
+        return
+
+    def probe(item):
+        server, path = item
+        try:
+            return probe_xrootd_server(server, path, timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Could not probe {path} on {server}: {e}")
+            return {"ok": False, "latency": None, "throughput": None}
+
+    with ThreadPoolExecutor(max_workers=len(outdated)) as executor:
+        results = list(executor.map(probe, outdated.items()))
+    for server, result in zip(outdated, results):
+        stats.record(server, "probe", **result)
+
+
+def rank_xrootd_servers(
+    xrootd_servers: list[str], stats: XRootDServerStats = None
+) -> list[str]:
+    """
+    Order servers by the expected time to open and read a file of `SERVER_REFERENCE_BYTES`,
+    from the median latency and throughput of their probes. Servers with a failure rate of at least
+    `SERVER_MAX_FAILURE_RATE` are moved to the end. Servers without history are assumed to be as
+    fast as the best measured one, so that they are tried and measured. A server has to be
+    `SERVER_PREFERENCE_PENALTY` faster per position to overtake a server earlier in the list,
+    which keeps the given order when the servers perform alike.
+
+    :param xrootd_servers: List of XRootD server URIs in order of preference.
+
+    :returns: The reordered list.
+    """
+    summary = (stats or XRootDServerStats()).summary(xrootd_servers)
+    scores = {}
+    for server, info in summary.items():
+        if info["throughput"]:
+            scores[server] = (info["latency"] or 0.0) + (
+                SERVER_REFERENCE_BYTES / info["throughput"]
+            )
+    best = min(scores.values(), default=0.0)
+
+    def key(item):
+        index, server = item
+        info = summary.get(server)
+        degraded = info is not None and (
+            info["failures"] / info["n"] >= SERVER_MAX_FAILURE_RATE
+        )
+        score = scores.get(server, best) * (1 + SERVER_PREFERENCE_PENALTY * index)
+        return (degraded, score, index)
+
+    return [server for _, server in sorted(enumerate(xrootd_servers), key=key)]
@@ -0,0 +1,235 @@
+import os
+import time
+import zlib
+import fcntl
+import shlex
+import shutil
+import tarfile
+import subprocess
+from contextlib import contextmanager
+from law.logger import get_logger
+
+logger = get_logger("custom.unpack_cache")
+
+# Node-level location of the unpacked tarballs, outside of the job scratch directories, so that
+# it is shared by all branches, tasks and productions running on the same machine
+UNPACK_CACHE_DIR = os.getenv(
+    "KINGMAKER_UNPACK_CACHE", f"/tmp/kingmaker_unpack_cache_{os.getuid()}"
+)
+# Least recently used entries are removed once the cache exceeds this size in GB
+UNPACK_CACHE_QUOTA = 20
+ADLER32_BLOCK_SIZE = 8 * 1024**2
+
+
+def file_adler32(path):
+    """
+    Compute the adler32 checksum of a local file, in the zero-padded hex format of XRootD.
+    """
+    checksum = 1
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(ADLER32_BLOCK_SIZE), b""):
+            checksum = zlib.adler32(block, checksum)
+    return f"{checksum:08x}"
+
+
+def _run_pipeline(command):
+    subprocess.run(
+        ["bash", "-o", "pipefail", "-c", command],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+
+def pack_tarball(directory, names, path, threads=1):
+    """
+    Pack `names` from `directory` into the gzipped tarball at `path`. The compression runs on
+    `threads` cores with pigz if it is installed, the output is a regular gzip file either way.
+    """
+    if shutil.which("pigz") is not None:
+        _run_pipeline(
+            f"tar -C {shlex.quote(directory)} -cf - -- "
+            f"{' '.join(shlex.quote(name) for name in names)} "
+            f"| pigz -p {int(threads)} > {shlex.quote(path)}"
+        )
+    else:
+        with tarfile.open(path, "w:gz") as tar:
+            for name in names:
+                tar.add(os.path.join(directory, name), arcname=name)
+
+
+def extract_tarball(path, destination):
+    """
+    Unpack the gzipped tarball at `path` into `destination`, decompressing with pigz if it is
+    installed.
+    """
+    os.makedirs(destination, exist_ok=True)
+    if shutil.which("pigz") is not None:
+        _run_pipeline(
+            f"pigz -dc {shlex.quote(path)} | tar -C {shlex.quote(destination)} -xf -"
+        )
+    else:
+        with tarfile.open(path, "r:gz") as tar:
+            tar.extractall(destination)
+
+
+def _directory_size(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+class UnpackCache:
+    """
+    Content-addressed cache of unpacked tarballs in a local directory.
+
+    Each entry is a directory named after the checksum of its tarball, with a lock file next to
+    it. Users hold a shared lock while they use an entry, so any number of them can use it at
+    once. A missing entry is unpacked under an exclusive lock into a temporary directory and
+    renamed into place, so it is either complete or absent.
+    Entries are only evicted when no one else holds their lock, least recently used first, and
+    locks are released by the kernel when a process dies, so no stale markers are left behind.
+    """
+
+    def __init__(self, path=UNPACK_CACHE_DIR, quota=UNPACK_CACHE_QUOTA):
+        self.path = path
+        self.quota = quota * 1024**3
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def _lock_file(self, key):
+        return os.path.join(self.path, f"{key}.lock")
+
+    def _size_file(self, key):
+        return os.path.join(self.path, f"{key}.size")
+
+    @contextmanager
+    def entry(self, key, fetch):
+        """
+        Context manager yielding the directory of the unpacked tarball with checksum `key`.
+
+        :param key: Checksum of the tarball.
+        :param fetch: Context manager factory yielding the local path of the tarball, only
+            called if the entry does not exist yet.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entry = self._entry(key)
+        populated = False
+        with open(self._lock_file(key), "a") as lock:
+            while True:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if os.path.isdir(entry):
+                    break
+                # converting the lock is not atomic, so the entry is checked again each time,
+                #   it may have been unpacked or evicted by someone else in the meantime
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.isdir(entry):
+                    self._populate(key, fetch)
+                    populated = True
+            if not populated:
+                logger.info(f"Using unpacked tarball {entry}")
+            # mark as used for the eviction
+            os.utime(self._lock_file(key))
+            self.evict(keep=key)
+            yield entry
+
+    def _populate(self, key, fetch):
+        # remove the leftovers of unpacking attempts that crashed, they hold no lock
+        for name in os.listdir(self.path):
+            if name.startswith(f".tmp-{key}-"):
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        tmp_dir = os.path.join(self.path, f".tmp-{key}-{os.getpid()}")
+        start = time.time()
+        with fetch() as tarball:
+            extract_tarball(tarball, tmp_dir)
+        with open(self._size_file(key), "w") as f:
+            f.write(str(_directory_size(tmp_dir)))
+        os.rename(tmp_dir, self._entry(key))
+        logger.info(
+            f"Unpacked tarball into {self._entry(key)} in {time.time() - start:.1f} s"
+        )
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries that are not in use, until the cache is below
+        the quota.
+
+        :param keep: Key of an entry that is never removed.
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".lock"):
+                continue
+            key = name[: -len(".lock")]
+            if key == keep or not os.path.isdir(self._entry(key)):
+                continue
+            try:
+                with open(self._size_file(key), "r") as f:
+                    size = int(f.read())
+            except (OSError, ValueError):
+                size = _directory_size(self._entry(key))
+            entries.append((os.path.getmtime(self._lock_file(key)), key, size))
+        total = sum(size for _, _, size in entries)
+        if keep is not None and os.path.exists(self._size_file(keep)):
+            with open(self._size_file(keep), "r") as f:
+                total += int(f.read())
+        for _, key, size in sorted(entries):
+            if total <= self.quota:
+                break
+            with open(self._lock_file(key), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # in use
+                    continue
+                if not os.path.isdir(self._entry(key)):
+                    # evicted by someone else in the meantime
+                    continue
+                # move out of place first, so the entry is never seen half deleted
+                trash = os.path.join(self.path, f".tmp-{key}-evicted-{os.getpid()}")
+                os.rename(self._entry(key), trash)
+                shutil.rmtree(trash, ignore_errors=True)
+                if os.path.exists(self._size_file(key)):
+                    os.remove(self._size_file(key))
+            total -= size
+            logger.info(f"Evicted unpacked tarball {key} ({size / 1024**2:.0f} MB)")
+
+
+def link_entry(entry, workdir, copy_files=False):
+    """
+    Link the top-level files and directories of a cache entry into `workdir`, replacing
+    existing files of the same name.
+
+    :param copy_files: Hard link or copy the top-level files instead of symlinking them. An
+        executable resolves its libraries relative to its real location, so an executable packed
+        without its libraries has to be placed next to the linked libraries.
+    """
+    for name in os.listdir(entry):
+        link = os.path.join(workdir, name)
+        source = os.path.join(entry, name)
+        copy = copy_files and os.path.isfile(source)
+        if not copy and os.path.islink(link) and os.readlink(link) == source:
+            continue
+        if copy and not os.path.islink(link) and os.path.isfile(link):
+            if os.path.samefile(link, source):
+                continue
+        if os.path.isdir(link) and not os.path.islink(link):
+            # unpacked into the working directory by an earlier version
+            shutil.rmtree(link)
+        tmp_link = os.path.join(workdir, f".{name}.{os.getpid()}")
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        if not copy:
+            os.symlink(source, tmp_link)
+        else:
+            try:
+                os.link(source, tmp_link)
+            except OSError:
+                # different file system
+                shutil.copy2(source, tmp_link)
+        os.replace(tmp_link, link)
@@ -0,0 +1,157 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Barrier, Thread
+from rich import print as rprint
+from rich.table import Table
+
+# The cache location is fixed when processor/caching.py is imported,
+# so point LAW_HOME to a scratch directory before importing it.
+os.environ["LAW_HOME"] = tempfile.mkdtemp(prefix="kingmaker_cache_bench_")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "processor"))
+
+import law  # noqa: E402
+import caching  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks for the target existence cache in processor/caching.py"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    exists_parser = subparsers.add_parser(
+        "exists", help="Throughput of cached CachedWLCGFileTarget.exists() calls"
+    )
+    exists_parser.add_argument(
+        "--threads", type=int, nargs="+", default=[1, 8, 32], help="thread counts"
+    )
+    exists_parser.add_argument(
+        "--targets", type=int, default=10000, help="number of cached targets"
+    )
+    exists_parser.add_argument(
+        "--calls", type=int, default=200000, help="total exists() calls per run"
+    )
+    key_parser = subparsers.add_parser(
+        "collection-key",
+        help="Cost of the collection key, computed from scratch and memoized",
+    )
+    key_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000, 50000],
+        help="collection sizes",
+    )
+    key_parser.add_argument(
+        "--repeat", type=int, default=5, help="status queries per collection"
+    )
+    return parser.parse_args()
+
+
+def make_targets(n_targets):
+    """
+    Create `n_targets` file targets on a dummy WLCG file system and mark all of them as existing
+    in the cache, so that every exists() call in the benchmark is a cache hit and no remote
+    request is made.
+
+    :param n_targets: Number of targets to create.
+    :return: A list of `CachedWLCGFileTarget` objects.
+    """
+    fs = law.wlcg.WLCGFileSystem(None, base="root://benchmark.invalid//store")
+    targets = [
+        caching.CachedWLCGFileTarget(f"/bench/CROWNRun/mt/sample_{i}.root", fs=fs)
+        for i in range(n_targets)
+    ]
+    now = time.time()
+    for target in targets:
+        caching._queue_cache_update(target._cache_key(), {"ts": now})
+    caching._atexit_flush()
+    caching._refresh_snapshot()
+    return targets
+
+
+def bench_exists(targets, n_threads, n_calls):
+    """
+    Call exists() `n_calls` times in total, split evenly over `n_threads` threads.
+
+    :return: The achieved throughput in calls per second.
+    """
+    calls_per_thread = n_calls // n_threads
+    barrier = Barrier(n_threads + 1)
+
+    def worker(offset):
+        n = len(targets)
+        barrier.wait()
+        for i in range(calls_per_thread):
+            if not targets[(offset + i) % n].exists():
+                raise RuntimeError("benchmark target unexpectedly missing from cache")
+
+    threads = [Thread(target=worker, args=(i * 7919,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return calls_per_thread * n_threads / elapsed
+
+
+def bench_collection_key(size, repeat):
+    """
+    Time `repeat` collection key lookups for a collection of `size` targets, once hashing all
+    targets on every lookup and once through the memoized layout of the collection instance.
+    The one-time cost of building the layout is measured separately.
+
+    :return: A tuple with the average time per lookup in ms for both variants and the time to
+        build the layout in ms.
+    """
+    fs = law.wlcg.WLCGFileSystem(None, base="root://benchmark.invalid//store")
+    collection = caching.CachedSiblingFileCollection(
+        [
+            caching.CachedWLCGFileTarget(f"/bench/CROWNRun/mt/sample_{i}.root", fs=fs)
+            for i in range(size)
+        ]
+    )
+    start = time.perf_counter()
+    for _ in range(repeat):
+        caching._get_collection_key(collection.targets)
+    uncached = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    collection._cache_layout()
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        collection._cache_layout()
+    memoized = (time.perf_counter() - start) / repeat
+    return uncached * 1e3, memoized * 1e3, build * 1e3
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.benchmark == "exists":
+        targets = make_targets(args.targets)
+        table = Table(title=f"Cached exists() throughput ({args.targets} targets)")
+        table.add_column("Threads", justify="right")
+        table.add_column("Calls/s", justify="right")
+        table.add_column("µs/call", justify="right")
+        for n_threads in args.threads:
+            rate = bench_exists(targets, n_threads, args.calls)
+            table.add_row(str(n_threads), f"{rate:,.0f}", f"{1e6 / rate:.2f}")
+        rprint(table)
+    elif args.benchmark == "collection-key":
+        table = Table(title=f"Collection key per status query ({args.repeat} queries)")
+        table.add_column("Targets", justify="right")
+        table.add_column("Hashed ms/query", justify="right")
+        table.add_column("Memoized ms/query", justify="right")
+        table.add_column("Memoization ms (once)", justify="right")
+        for size in args.sizes:
+            uncached, memoized, build = bench_collection_key(size, args.repeat)
+            table.add_row(
+                f"{size:,}", f"{uncached:.3f}", f"{memoized:.4f}", f"{build:.1f}"
+            )
+        rprint(table)
+    shutil.rmtree(os.environ["LAW_HOME"], ignore_errors=True)
@@ -0,0 +1,173 @@
+import argparse
+import configparser
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from rich import print as rprint
+from rich.table import Table
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# modules that are only needed on first use and must not be pulled in by the task imports
+DEFERRED_MODULES = ["rich", "XRootD", "law.contrib.singularity"]
+# median import time in ms above which the check fails, a few times the usual ~250 ms so that
+# only real regressions and not slow machines are caught
+DEFAULT_BUDGET = 1000.0
+
+# runs in a fresh interpreter, prints the import time in ms and the loaded deferred modules
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+for module in sys.argv[1].split(","):
+    __import__(module)
+elapsed = (time.perf_counter() - start) * 1e3
+loaded = [m for m in sys.argv[2].split(",") if m in sys.modules]
+print(json.dumps({"ms": elapsed, "loaded": loaded}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Import time of the law task modules in fresh interpreters, as done by "
+        "`law index`, `law run` and every job bootstrap"
+    )
+    parser.add_argument(
+        "--config",
+        default=os.path.join(REPO_DIR, "lawluigi_configs", "KingMaker_law.cfg"),
+        help="law config whose [modules] are imported",
+    )
+    parser.add_argument(
+        "--runs", type=int, default=10, help="number of fresh interpreters"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=DEFAULT_BUDGET,
+        help="fail if the median import time exceeds this value in ms, 0 to disable",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=15,
+        help="number of slowest modules to show from -X importtime",
+    )
+    return parser.parse_args()
+
+
+def task_modules(config_path):
+    """
+    Read the module names from the [modules] section of a law config.
+    """
+    config = configparser.ConfigParser(allow_no_value=True, delimiters=("=",))
+    config.optionxform = str
+    config.read(config_path)
+    return list(config["modules"])
+
+
+def probe_env():
+    """
+    Environment of the probe interpreters, with the processor modules on the path and a scratch
+    LAW_HOME, so that no state of the user is touched.
+    """
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [
+            os.path.join(REPO_DIR, "processor"),
+            os.path.join(REPO_DIR, "processor", "tasks"),
+        ]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+    env["LAW_HOME"] = tempfile.mkdtemp(prefix="kingmaker_import_bench_")
+    env.setdefault("WF_NAME", "KingMaker")
+    env.setdefault("ANALYSIS_DATA_PATH", env["LAW_HOME"])
+    return env
+
+
+def run_probe(command, env):
+    """
+    Run a probe interpreter and exit with its error output if the imports fail.
+    """
+    out = subprocess.run(
+        command, env=env, cwd=env["LAW_HOME"], capture_output=True, text=True
+    )
+    if out.returncode != 0:
+        rprint(f"[red]Importing the task modules failed:[/red]\n{out.stderr}")
+        sys.exit(2)
+    return out
+
+
+def measure(modules, env):
+    """
+    Import `modules` in a fresh interpreter.
+
+    :return: A dict with the import time in ms and the loaded deferred modules.
+    """
+    out = run_probe(
+        [sys.executable, "-c", PROBE, ",".join(modules), ",".join(DEFERRED_MODULES)],
+        env,
+    )
+    return json.loads(out.stdout.splitlines()[-1])
+
+
+def slowest_imports(modules, env, top):
+    """
+    Run the imports once with -X importtime.
+
+    :return: The `top` modules with the largest self time, as tuples (module, self ms,
+        cumulative ms).
+    """
+    out = run_probe(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "; ".join(f"import {module}" for module in modules),
+        ],
+        env,
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((name.strip(), int(self_us) / 1e3, int(cumulative_us) / 1e3))
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:top]
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    modules = task_modules(args.config)
+    env = probe_env()
+    # the first run fills the bytecode cache and is not counted
+    measure(modules, env)
+    results = [measure(modules, env) for _ in range(args.runs)]
+    times = [result["ms"] for result in results]
+    median = statistics.median(times)
+
+    table = Table(title=f"Slowest imports of {', '.join(modules)}")
+    table.add_column("Module")
+    table.add_column("Self ms", justify="right")
+    table.add_column("Cumulative ms", justify="right")
+    for name, self_ms, cumulative_ms in slowest_imports(modules, env, args.top):
+        table.add_row(name, f"{self_ms:.1f}", f"{cumulative_ms:.1f}")
+    rprint(table)
+    shutil.rmtree(env["LAW_HOME"], ignore_errors=True)
+    rprint(
+        f"Import time over {args.runs} runs: median {median:.1f} ms, "
+        f"min {min(times):.1f} ms, max {max(times):.1f} ms"
+    )
+
+    failed = False
+    loaded = sorted({module for result in results for module in result["loaded"]})
+    if loaded:
+        rprint(f"[red]Deferred modules imported eagerly: {', '.join(loaded)}[/red]")
+        failed = True
+    if args.budget and median > args.budget:
+        rprint(f"[red]Median exceeds the budget of {args.budget:.1f} ms[/red]")
+        failed = True
+    sys.exit(1 if failed else 0)
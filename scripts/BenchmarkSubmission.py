@@ -0,0 +1,164 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from rich import print as rprint
+from rich.table import Table
+
+# LAW_HOME is read when the processor modules are imported,
+# so point it to a scratch directory before importing them.
+os.environ["LAW_HOME"] = tempfile.mkdtemp(prefix="kingmaker_submission_bench_")
+os.environ.setdefault("WF_NAME", "KingMaker")
+os.environ["ANALYSIS_DATA_PATH"] = os.environ["LAW_HOME"]
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(REPO_DIR, "processor"))
+
+import law  # noqa: E402
+import framework  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the per-job work in HTCondorWorkflow.htcondor_job_config "
+        "with a mocked remote file system"
+    )
+    parser.add_argument(
+        "--jobs", type=int, nargs="+", default=[100, 1000], help="jobs per submission"
+    )
+    parser.add_argument(
+        "--stat-latency",
+        type=float,
+        default=20.0,
+        help="simulated latency of a remote stat in ms",
+    )
+    parser.add_argument(
+        "--dns-latency",
+        type=float,
+        default=5.0,
+        help="simulated latency of the domain name lookup in ms",
+    )
+    return parser.parse_args()
+
+
+def mock_environment(stat_latency, dns_latency):
+    """
+    Replace the remote tarball target and the domain name lookup in `framework` by mocks with
+    the given latencies in ms. The mocked tarball always exists, so nothing is packed or
+    uploaded.
+
+    :return: A dict counting the calls of the mocks.
+    """
+    calls = {"stat": 0, "dns": 0}
+
+    class MockRemoteTarget(law.LocalFileTarget):
+        def exists(self):
+            calls["stat"] += 1
+            time.sleep(stat_latency / 1000)
+            return True
+
+    def getfqdn():
+        calls["dns"] += 1
+        time.sleep(dns_latency / 1000)
+        return "bench.etp.kit.edu"
+
+    framework.CachedWLCGFileTarget = MockRemoteTarget
+    framework.socket.getfqdn = getfqdn
+    return calls
+
+
+class BenchmarkWorkflow(framework.HTCondorWorkflow):
+    def create_branch_map(self):
+        return {0: None}
+
+    def output(self):
+        return law.LocalFileTarget(self.local_path("benchmark.txt"))
+
+    def run(self):
+        pass
+
+
+def make_workflow():
+    return BenchmarkWorkflow(
+        wlcg_path="root://benchmark.invalid//store/",
+        local_output_path=os.environ["LAW_HOME"],
+        production_tag="benchmark",
+        ENV_NAME="KingMaker",
+        htcondor_accounting_group="benchmark",
+        htcondor_remote_job="True",
+        htcondor_walltime="3600",
+        htcondor_request_memory="2000",
+        htcondor_request_disk="2000000",
+        htcondor_universe="container",
+        htcondor_container_image="benchmark.sif",
+        bootstrap_file="setup_law_remote.sh",
+    )
+
+
+def submit(n_jobs, memoized, grouped):
+    """
+    Render the job config of `n_jobs` jobs of one workflow. With grouped submission, the law
+    default, it is rendered once for all jobs, with lists of job numbers and branches, as for
+    one grouped submit file. Otherwise, it is rendered per job, and without memoization, the
+    cached submission facts are dropped after each job, which redoes the per-submission work
+    per job.
+
+    :return: The time per job in ms.
+    """
+    # luigi reuses task instances with the same parameters, start from a fresh submission
+    workflow = make_workflow()
+    workflow.__dict__.pop("_htcondor_submission", None)
+    start = time.perf_counter()
+    if grouped:
+        config = law.job.base.BaseJobFileFactory.Config()
+        config.custom_content = []
+        config.render_variables = {}
+        job_nums = list(range(1, n_jobs + 1))
+        workflow.htcondor_job_config(
+            config, job_nums, [[job_num - 1] for job_num in job_nums]
+        )
+        return (time.perf_counter() - start) / n_jobs * 1e3
+    for job_num in range(1, n_jobs + 1):
+        if not memoized:
+            workflow.__dict__.pop("_htcondor_submission", None)
+            framework._job_tarball_uploads.clear()
+            framework.htcondor_site_domain.cache_clear()
+        config = law.job.base.BaseJobFileFactory.Config()
+        config.custom_content = []
+        config.render_variables = {}
+        workflow.htcondor_job_config(config, job_num, [job_num - 1])
+    return (time.perf_counter() - start) / n_jobs * 1e3
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # the job tarball inputs are given relative to the repository
+    os.chdir(REPO_DIR)
+    calls = mock_environment(args.stat_latency, args.dns_latency)
+    table = Table(
+        title=f"htcondor_job_config per job (stat {args.stat_latency} ms, "
+        f"DNS {args.dns_latency} ms)"
+    )
+    table.add_column("Jobs", justify="right")
+    table.add_column("Submission", justify="center")
+    table.add_column("Memoized", justify="center")
+    table.add_column("ms/job", justify="right")
+    table.add_column("Remote stats", justify="right")
+    table.add_column("DNS lookups", justify="right")
+    for n_jobs in args.jobs:
+        for grouped, memoized in ((False, False), (False, True), (True, True)):
+            framework._job_tarball_uploads.clear()
+            framework.htcondor_site_domain.cache_clear()
+            calls.update(stat=0, dns=0)
+            ms_per_job = submit(n_jobs, memoized, grouped)
+            table.add_row(
+                f"{n_jobs:,}",
+                "grouped" if grouped else "per job",
+                "yes" if memoized else "no",
+                f"{ms_per_job:.2f}",
+                f"{calls['stat']:,}",
+                f"{calls['dns']:,}",
+            )
+    rprint(table)
+    shutil.rmtree(os.environ["LAW_HOME"], ignore_errors=True)
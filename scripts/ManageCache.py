@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from rich import print as rprint
+from rich.table import Table
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "processor"))
+
+import law  # noqa: E402
+import caching  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Maintenance of the target existence cache in $LAW_HOME"
+    )
+    parser.add_argument(
+        "--drop-tag",
+        metavar="TAG",
+        action="append",
+        default=[],
+        help="delete the cache shards of a production_tag, can be given multiple times",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    stats_parser = subparsers.add_parser("stats", help="show the size of all shards")
+    stats_parser.add_argument("--tag", help="only show the shards of this tag")
+
+    prune_parser = subparsers.add_parser(
+        "prune", help="delete entries older than a given age"
+    )
+    prune_parser.add_argument(
+        "--max-age",
+        type=float,
+        required=True,
+        help="maximum age of the kept entries in hours",
+    )
+    prune_parser.add_argument("--tag", help="only prune the shards of this tag")
+
+    export_parser = subparsers.add_parser(
+        "export", help="write the cached targets to a JSON file"
+    )
+    export_parser.add_argument("file", help="output JSON file")
+    export_parser.add_argument("--tag", help="only export the shards of this tag")
+
+    import_parser = subparsers.add_parser(
+        "import", help="merge the cached targets from an exported JSON file"
+    )
+    import_parser.add_argument("file", help="JSON file written by export")
+
+    verify_parser = subparsers.add_parser(
+        "verify",
+        help="check a random sample of cached targets on the remote storage",
+    )
+    verify_parser.add_argument(
+        "--sample", type=int, default=200, help="number of targets to check"
+    )
+    verify_parser.add_argument("--tag", help="only check the shards of this tag")
+    verify_parser.add_argument(
+        "--workers", type=int, default=16, help="number of concurrent checks"
+    )
+    verify_parser.add_argument(
+        "--delete-stale",
+        action="store_true",
+        help="delete the entries of targets that no longer exist",
+    )
+    return parser.parse_args()
+
+
+def drop_tags(tags):
+    """
+    Delete the cache shards of the given production tags. A shard is a separate database file,
+    so this takes the same time no matter how many entries it holds.
+
+    :param tags: List of production tags.
+    """
+    for tag in tags:
+        deleted = caching.drop_cache_shard(tag)
+        if deleted:
+            rprint(f"Dropped cache of [bold]{tag}[/bold] ({len(deleted)} files)")
+        else:
+            rprint(f"[yellow]No cache found for {tag}[/yellow]")
+
+
+def format_age(ts, now):
+    if ts is None:
+        return "-"
+    return f"{(now - ts) / 3600:.1f} h"
+
+
+def show_stats(tag):
+    """
+    Print the number of entries and the age range of every table in every shard.
+
+    :param tag: Only show the shards of this production tag, or all if None.
+    """
+    now = time.time()
+    table = Table(title="Target existence cache")
+    table.add_column("Shard")
+    table.add_column("Size", justify="right")
+    for column in ("Targets", "Listings", "Collections"):
+        table.add_column(column, justify="right")
+    table.add_column("Oldest target", justify="right")
+    table.add_column("Newest target", justify="right")
+    for store in caching.cache_stores(tag):
+        summary = store.summary()
+        size = sum(
+            os.path.getsize(store.path + suffix)
+            for suffix in ("", "-wal")
+            if os.path.exists(store.path + suffix)
+        )
+        n_targets, oldest, newest = summary["targets"]
+        table.add_row(
+            os.path.basename(store.path),
+            f"{size / 1024**2:.1f} MB",
+            f"{n_targets:,}",
+            f"{summary['listings'][0]:,}",
+            f"{summary['collections'][0]:,}",
+            format_age(oldest, now),
+            format_age(newest, now),
+        )
+    rprint(table)
+
+
+def prune(max_age, tag):
+    """
+    Delete all entries older than `max_age` hours.
+
+    :param max_age: Maximum age in hours.
+    :param tag: Only prune the shards of this production tag, or all if None.
+    """
+    cutoff = time.time() - max_age * 3600
+    for store in caching.cache_stores(tag):
+        before = store.summary()["targets"][0]
+        store.prune(cutoff)
+        after = store.summary()["targets"][0]
+        rprint(
+            f"{os.path.basename(store.path)}: removed {before - after:,} of {before:,} targets"
+        )
+
+
+def export_cache(path, tag):
+    """
+    Write the target entries of all shards to a JSON file of the form
+    ``{shard file name: {key: timestamp}}``. Listings and collection bitmaps expire quickly
+    and are not exported.
+
+    :param path: Output file.
+    :param tag: Only export the shards of this production tag, or all if None.
+    """
+    snapshot = {
+        os.path.basename(store.path): store.all_targets()
+        for store in caching.cache_stores(tag)
+    }
+    with open(path, "w") as f:
+        json.dump(snapshot, f)
+    rprint(
+        f"Exported {sum(len(v) for v in snapshot.values()):,} targets "
+        f"of {len(snapshot)} shards to {path}"
+    )
+
+
+def import_cache(path):
+    """
+    Merge the target entries of a file written by `export_cache` into the local shards.
+    Existing entries are overwritten with the imported timestamp.
+
+    :param path: JSON file to import.
+    """
+    with open(path, "r") as f:
+        snapshot = json.load(f)
+    for name, targets in snapshot.items():
+        if os.path.basename(name) != name:
+            rprint(f"[red]Skipping invalid shard name {name}[/red]")
+            continue
+        if name == os.path.basename(caching.CACHE_PATH):
+            store_path = caching.CACHE_PATH
+        else:
+            store_path = os.path.join(caching.CACHE_SHARD_DIR, name)
+        store = caching._TargetCacheStore(store_path)
+        store.put_many({key: {"ts": ts} for key, ts in targets.items()})
+        rprint(f"{name}: imported {len(targets):,} targets")
+
+
+def make_target(key, file_systems):
+    """
+    Create a target for a cache key, which is either a remote URI or a local path.
+    One WLCG file system is created per storage endpoint.
+    """
+    parsed = urlparse(key)
+    if not parsed.scheme or parsed.scheme == "file":
+        return law.LocalFileTarget(parsed.path if parsed.scheme else key)
+    base = f"{parsed.scheme}://{parsed.netloc}/"
+    if base not in file_systems:
+        file_systems[base] = law.wlcg.WLCGFileSystem(None, base=base)
+    return law.wlcg.WLCGFileTarget(parsed.path, fs=file_systems[base])
+
+
+def verify(n_sample, tag, workers, delete_stale):
+    """
+    Check a random sample of the cached targets on the storage, to estimate the fraction of
+    entries that no longer exist.
+
+    :param n_sample: Number of targets to check.
+    :param tag: Only check the shards of this production tag, or all if None.
+    :param workers: Number of concurrent checks.
+    :param delete_stale: Delete the entries of targets found missing.
+    """
+    keys = {}
+    for store in caching.cache_stores(tag):
+        for key in store.all_targets():
+            keys[key] = store
+    if not keys:
+        rprint("The cache is empty")
+        return
+    sample = random.sample(sorted(keys), min(n_sample, len(keys)))
+    file_systems = {}
+    targets = [make_target(key, file_systems) for key in sample]
+
+    def check(target):
+        try:
+            return target.exists()
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(check, targets))
+
+    stale = [key for key, result in zip(sample, results) if result is False]
+    errors = [
+        (key, result)
+        for key, result in zip(sample, results)
+        if isinstance(result, Exception)
+    ]
+    checked = len(sample) - len(errors)
+    for key in stale:
+        rprint(f"[yellow]stale[/yellow] {key}")
+    for key, error in errors:
+        rprint(f"[red]error[/red] {key}: {error}")
+    if checked:
+        rate = len(stale) / checked
+        error = (rate * (1 - rate) / checked) ** 0.5
+        rprint(
+            f"{len(stale)} of {checked} checked entries are stale, "
+            f"estimated stale rate {rate:.2%} ± {error:.2%} of {len(keys):,} entries"
+        )
+    if delete_stale and stale:
+        by_store = {}
+        for key in stale:
+            by_store.setdefault(keys[key], []).append(key)
+        for store, store_keys in by_store.items():
+            store.delete_many(store_keys)
+        rprint(f"Deleted {len(stale)} stale entries")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.drop_tag and args.command is None:
+        rprint("Nothing to do, see --help")
+    drop_tags(args.drop_tag)
+    if args.command == "stats":
+        show_stats(args.tag)
+    elif args.command == "prune":
+        prune(args.max_age, args.tag)
+    elif args.command == "export":
+        export_cache(args.file, args.tag)
+    elif args.command == "import":
+        import_cache(args.file)
+    elif args.command == "verify":
+        verify(args.sample, args.tag, args.workers, args.delete_stale)
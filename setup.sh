@@ -336,8 +336,9 @@ action() {
 
     clear_law_cache (){
         echo "Clearing Law file target cache..."
-        rm "${LAW_HOME}/target_exists_cache.json"
-        rm "${LAW_HOME}/target_exists_cache.json.lock"
+        rm -f "${LAW_HOME}"/target_exists_cache.sqlite*
+        rm -f "${LAW_HOME}"/target_exists_cache.json*
+        rm -rf "${LAW_HOME}"/target_exists_cache
     }
 
     # law
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the processor modules import each other as top-level modules, as in the law config
+PROCESSOR_DIR = os.path.join(os.path.dirname(__file__), "..", "processor")
+sys.path.insert(0, PROCESSOR_DIR)
+sys.path.insert(0, os.path.join(PROCESSOR_DIR, "tasks"))
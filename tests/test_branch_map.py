@@ -0,0 +1,109 @@
+import json
+
+import pytest
+from luigi.task_register import Register
+
+import CROWNMain
+from CROWNMain import CROWNRun, pack_files_by_events
+from resource_history import ResourceHistory
+
+NICK = "DYJetsToLL_2018"
+FILE_EVENTS = [100, 250, 50, 400, 100, 100]
+
+
+def test_pack_files_by_events():
+    files = [f"f{i}.root" for i in range(len(FILE_EVENTS))]
+    assert pack_files_by_events(files, FILE_EVENTS, 300) == [
+        (["f0.root"], 100),
+        (["f1.root", "f2.root"], 300),
+        (["f3.root"], 400),
+        (["f4.root", "f5.root"], 200),
+    ]
+
+
+@pytest.fixture
+def production(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sample_dir = tmp_path / "sample_database" / "nanoAOD_v15" / "2018" / "dy"
+    sample_dir.mkdir(parents=True)
+    filelist = [f"root://server//store/f{i}.root" for i in range(len(FILE_EVENTS))]
+    (sample_dir / f"{NICK}.json").write_text(
+        json.dumps(
+            {
+                "era": "2018",
+                "sample_type": "dy",
+                "nfiles": len(filelist),
+                "nevents": sum(FILE_EVENTS),
+                "filelist": filelist,
+                "file_nevents": dict(zip(filelist, FILE_EVENTS)),
+            }
+        )
+    )
+    history = ResourceHistory(str(tmp_path / "resource_history.sqlite"))
+    monkeypatch.setattr(CROWNMain, "ResourceHistory", lambda: history)
+    return history
+
+
+def make_run(tmp_path, production_tag="test", **kwargs):
+    params = dict(
+        wlcg_path="",
+        local_output_path=str(tmp_path / "output"),
+        is_local_output=True,
+        production_tag=production_tag,
+        ENV_NAME="env",
+        htcondor_accounting_group="group",
+        htcondor_remote_job="True",
+        htcondor_walltime="3600",
+        htcondor_request_memory="2000",
+        htcondor_request_disk="2000000",
+        htcondor_universe="vanilla",
+        htcondor_container_image="image",
+        bootstrap_file="bootstrap.sh",
+        scopes=["mt"],
+        all_sample_types=["dy"],
+        all_eras=["2018"],
+        nick=NICK,
+        sample_type="dy",
+        era="2018",
+        shifts="None",
+        analysis="analysis",
+        config="config",
+        files_per_task=2,
+        problematic_eras=[],
+        branch_map_mode="events",
+        events_per_task=300,
+    )
+    params.update(kwargs)
+    # a new instance per call, as in a new driver process
+    Register.clear_instance_cache()
+    return CROWNRun(**params)
+
+
+def files_of(task):
+    return {branch: data["files"] for branch, data in task.get_branch_map().items()}
+
+
+def test_branch_map_is_kept_for_the_production(tmp_path, production):
+    first = files_of(make_run(tmp_path))
+    assert len(first) == 4
+    # changed branching parameters do not renumber the branches of the production
+    assert files_of(make_run(tmp_path, events_per_task=100)) == first
+    assert files_of(make_run(tmp_path, branch_map_mode="files")) == first
+    # a new production uses them
+    assert len(files_of(make_run(tmp_path, "other", events_per_task=100))) == 6
+
+
+def test_branch_map_does_not_follow_the_resource_history(tmp_path, production):
+    run = make_run(tmp_path, walltime_per_task=600)
+    first = files_of(run)
+    # jobs with 1 s per event make 600 events per branch the target from now on
+    production.record(
+        run.htcondor_resource_key(),
+        {
+            f"{i}.0": {"events": events, "walltime": events}
+            for i, events in enumerate([100, 200, 300, 400, 500])
+        },
+    )
+    assert make_run(tmp_path, walltime_per_task=600).target_events_per_task() == 600
+    assert files_of(make_run(tmp_path, walltime_per_task=600)) == first
+    assert len(files_of(make_run(tmp_path, "other", walltime_per_task=600))) == 2
@@ -0,0 +1,106 @@
+import time
+
+import law
+import pytest
+
+import caching
+from caching import CachedSiblingFileCollection, exists_many, use_tree_index
+
+
+class IndexedFileSystem(law.LocalFileSystem):
+    # local stand-in for the WLCG file system, which maps paths to URIs
+    def uri(self, path, **kwargs):
+        return law.LocalFileTarget(self.abspath(path)).uri()
+
+
+class ShortLivedTarget(law.LocalFileTarget):
+    cache_ttl = 5
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    store = caching._ShardedTargetCacheStore(
+        caching._TargetCacheStore(str(tmp_path / "cache.sqlite")),
+        str(tmp_path / "shards"),
+    )
+    monkeypatch.setattr(caching, "_STORE", store)
+    monkeypatch.setattr(caching, "_TARGET_CACHE", {})
+    for name in ("_LISTINGS", "_BITMAPS", "_NEGATIVE_CACHE"):
+        monkeypatch.setattr(caching, name, caching._LRUCache(100))
+    monkeypatch.setattr(caching, "_TREE_INDEXES", {})
+    monkeypatch.setattr(caching, "_INDEXED_TAGS", set())
+    return store
+
+
+@pytest.fixture
+def tag(tmp_path):
+    directory = tmp_path / "tag" / "sample"
+    directory.mkdir(parents=True)
+    (directory / "a.root").write_text("a")
+    use_tree_index(IndexedFileSystem(), str(tmp_path / "tag"), persist=True)
+    return directory
+
+
+def test_index_answers_listed_targets(tag, monkeypatch):
+    target = law.LocalFileTarget(str(tag / "a.root"))
+    monkeypatch.setattr(caching, "_uncached_exists", pytest.fail)
+    assert exists_many([target]) == {target: True}
+
+
+def test_index_miss_is_checked(tag, monkeypatch):
+    # written by another process after the walk
+    (tag / "b.root").write_text("b")
+    target = law.LocalFileTarget(str(tag / "b.root"))
+    # the listing stored by the walk is as good as any other cached listing
+    assert exists_many([target]) == {target: False}
+    monkeypatch.setattr(caching, "LISTING_TTL", 0)
+    assert exists_many([target]) == {target: True}
+
+
+def test_index_miss_is_checked_in_collections(tag, monkeypatch):
+    (tag / "b.root").write_text("b")
+    targets = [law.LocalFileTarget(str(tag / f"{name}.root")) for name in "ab"]
+    collection = CachedSiblingFileCollection(targets)
+    assert collection.count() == 1
+    monkeypatch.setattr(CachedSiblingFileCollection, "listing_ttl", 0)
+    assert collection.count() == 2
+
+
+def test_exists_many_uses_target_ttl(tmp_path):
+    # cached as existing a minute ago, deleted since
+    targets = [
+        law.LocalFileTarget(str(tmp_path / "long.root")),
+        ShortLivedTarget(str(tmp_path / "short.root")),
+    ]
+    for target in targets:
+        caching._TARGET_CACHE[target.uri()] = {"ts": time.time() - 60}
+    assert exists_many(targets) == {targets[0]: True, targets[1]: False}
+    assert exists_many(targets, ttl=3600) == {targets[0]: True, targets[1]: True}
+
+
+def test_lru_cache_drops_least_recently_used():
+    cache = caching._LRUCache(2)
+    cache["a"], cache["b"] = 1, 2
+    assert cache.get("a") == 1
+    cache["c"] = 3
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_bitmap_of_other_version_is_ignored(tmp_path, store):
+    targets = [law.LocalFileTarget(str(tmp_path / f"{name}.root")) for name in "ab"]
+    for target in targets:
+        target.touch()
+    collection = CachedSiblingFileCollection(targets)
+    assert collection.count() == 2
+    _, key, route_key, *_ = collection._cache_layout()
+    assert store.get_bitmap(key, route_key)["version"] == caching.BITMAP_VERSION
+    # a bitmap with the same size but a different layout must not be read as complete
+    store.route(route_key)._write(
+        "UPDATE collections SET version = ? WHERE key = ?",
+        [(caching.BITMAP_VERSION + 1, key)],
+    )
+    caching._BITMAPS.pop(key)
+    targets[1].remove()
+    assert collection.count() == 1
@@ -0,0 +1,96 @@
+import os
+
+import pytest
+
+import framework
+from framework import Task
+
+
+class EnvTask(Task):
+    def run(self):
+        pass
+
+
+@pytest.fixture
+def task(tmp_path, monkeypatch):
+    monkeypatch.setattr(framework, "ENV_SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+    monkeypatch.setattr(framework, "_env_snapshots", {})
+    monkeypatch.chdir(tmp_path)
+    return EnvTask(wlcg_path="")
+
+
+@pytest.fixture
+def shells(monkeypatch):
+    # count the shells started to source the scripts
+    calls = []
+    popen = framework.interruptable_popen
+
+    def interruptable_popen(*args, **kwargs):
+        calls.append(args[0])
+        return popen(*args, **kwargs)
+
+    monkeypatch.setattr(framework, "interruptable_popen", interruptable_popen)
+    return calls
+
+
+def write(path, content):
+    path.write_text(content)
+    return str(path)
+
+
+def test_snapshot_is_reused(task, tmp_path, shells):
+    script = write(tmp_path / "setup.sh", "export KM_SETUP=1\n")
+    assert task.set_environment(script, silent=True)["KM_SETUP"] == "1"
+    assert task.set_environment(script, silent=True)["KM_SETUP"] == "1"
+    assert len(shells) == 1
+
+
+def test_inherited_variables_are_current(task, tmp_path, shells, monkeypatch):
+    script = write(tmp_path / "setup.sh", "export KM_SETUP=1\n")
+    monkeypatch.setenv("X509_USER_PROXY", "/tmp/old_proxy")
+    monkeypatch.setenv("KM_REMOVED", "1")
+    task.set_environment(script, silent=True)
+    monkeypatch.setenv("X509_USER_PROXY", "/tmp/new_proxy")
+    monkeypatch.delenv("KM_REMOVED")
+    env = task.set_environment(script, silent=True)
+    assert len(shells) == 1
+    assert env["X509_USER_PROXY"] == "/tmp/new_proxy"
+    assert "KM_REMOVED" not in env
+    assert env["KM_SETUP"] == "1"
+
+
+def test_script_changes_are_replayed(task, tmp_path, monkeypatch):
+    script = write(
+        tmp_path / "setup.sh", "export PATH=/opt/km/bin:$PATH\nunset KM_UNSET\n"
+    )
+    monkeypatch.setenv("KM_UNSET", "1")
+    first = task.set_environment(script, silent=True)
+    second = task.set_environment(script, silent=True)
+    assert second["PATH"] == first["PATH"] == "/opt/km/bin:" + os.environ["PATH"]
+    assert "KM_UNSET" not in first and "KM_UNSET" not in second
+
+
+def test_changed_script_is_sourced_again(task, tmp_path, shells):
+    script = write(tmp_path / "setup.sh", "export KM_SETUP=1\n")
+    task.set_environment(script, silent=True)
+    write(tmp_path / "setup.sh", "export KM_SETUP=2\n")
+    assert task.set_environment(script, silent=True)["KM_SETUP"] == "2"
+    assert len(shells) == 2
+
+
+def test_changed_nested_script_is_sourced_again(task, tmp_path, shells):
+    write(tmp_path / "nested.sh", "export KM_NESTED=1\n")
+    script = write(tmp_path / "setup.sh", "source nested.sh\n")
+    assert task.set_environment(script, silent=True)["KM_NESTED"] == "1"
+    write(tmp_path / "nested.sh", "export KM_NESTED=2\n")
+    assert task.set_environment(script, silent=True)["KM_NESTED"] == "2"
+    assert len(shells) == 2
+
+
+def test_snapshot_is_shared_between_processes(task, tmp_path, shells, monkeypatch):
+    script = write(tmp_path / "setup.sh", "export KM_SETUP=1\n")
+    task.set_environment(script, silent=True)
+    # a new process only has the snapshots in ENV_SNAPSHOT_DIR
+    monkeypatch.setattr(framework, "_env_snapshots", {})
+    assert task.set_environment(script, silent=True)["KM_SETUP"] == "1"
+    assert len(shells) == 1
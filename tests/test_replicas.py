@@ -0,0 +1,26 @@
+import time
+
+from helpers import helpers
+from helpers.helpers import ReplicaCache
+
+SERVERS = ["root://a.example.org", "root://b.example.org"]
+FILES = [
+    "root://xrootd-cms.infn.it//store/f1.root",
+    "root://cms-xrd-global.cern.ch//store/f2.root",
+]
+
+
+def test_invalidate(tmp_path):
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put_many({FILES[0]: SERVERS, FILES[1]: SERVERS[1:]}, SERVERS)
+    assert cache.get_many(FILES, SERVERS) == {FILES[0]: SERVERS, FILES[1]: SERVERS[1:]}
+    cache.invalidate([FILES[0]])
+    assert cache.get_many(FILES, SERVERS) == {FILES[1]: SERVERS[1:]}
+
+
+def test_found_replicas_expire(tmp_path, monkeypatch):
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put_many({FILES[0]: SERVERS}, SERVERS)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + helpers.REPLICA_TTL)
+    assert cache.get_many(FILES, SERVERS) == {}
@@ -0,0 +1,94 @@
+import law
+import pytest
+
+import framework
+from framework import HTCondorWorkflow
+from law.job.base import BaseJobManager
+from resource_history import ResourceHistory
+
+
+class ResourceTask(HTCondorWorkflow, law.LocalWorkflow):
+    def create_branch_map(self):
+        return {0: {"nevents": 100}, 1: {"nevents": 200}}
+
+    def htcondor_resource_key(self):
+        return ["ResourceTask"]
+
+    def htcondor_branch_events(self, branch):
+        return self.branch_map[branch]["nevents"]
+
+    def output(self):
+        return self.local_target(f"output_{self.branch}.txt")
+
+    def run(self):
+        pass
+
+
+@pytest.fixture
+def task(tmp_path):
+    return make_task(tmp_path)
+
+
+def make_task(tmp_path, **kwargs):
+    return ResourceTask(
+        workflow="htcondor",
+        wlcg_path="",
+        production_tag="test",
+        is_local_output=True,
+        local_output_path=str(tmp_path),
+        ENV_NAME="env",
+        htcondor_accounting_group="group",
+        htcondor_remote_job="True",
+        htcondor_walltime="3600",
+        htcondor_request_memory="2000",
+        htcondor_request_disk="2000000",
+        htcondor_universe="vanilla",
+        htcondor_container_image="image",
+        bootstrap_file="bootstrap.sh",
+        **kwargs,
+    )
+
+
+def test_finished_job_is_recorded(task, tmp_path, monkeypatch):
+    history = ResourceHistory(str(tmp_path / "resource_history.sqlite"))
+    monkeypatch.setattr(framework, "ResourceHistory", lambda: history)
+    queried = []
+
+    def query_job_usage(job_ids, pool=None, scheduler=None):
+        queried.append(list(job_ids))
+        return {
+            job_id: {"memory": 1500.0, "disk": 500000.0, "walltime": 900.0}
+            for job_id in job_ids
+        }
+
+    monkeypatch.setattr(framework, "query_job_usage", query_job_usage)
+
+    proxy = task.workflow_proxy
+    job_data = proxy.job_data
+    # submission, as done by law after condor_submit returned the job id
+    job_data.jobs[1] = job_data.job_data(branches=[0, 1])
+    job_data.jobs[1]["job_id"] = "1234.0"
+    job_data.jobs[1]["extra"].update(
+        proxy.get_extra_submission_data("job.jdl", "1234.0", None)
+    )
+    # law sets the dummy id once the job finished, before the poll callback is invoked
+    job_data.jobs[1]["status"] = BaseJobManager.FINISHED
+    job_data.jobs[1]["job_id"] = job_data.dummy_job_id
+
+    task.htcondor_poll_callback(proxy.poll_data)
+
+    assert queried == [["1234.0"]]
+    assert history.jobs(["ResourceTask"]) == [
+        {"events": 300.0, "memory": 1500.0, "disk": 500000.0, "walltime": 900.0}
+    ]
+    # the job is recorded only once
+    task.htcondor_post_poll_callback(True, 0)
+    assert queried == [["1234.0"]]
+
+
+def test_resource_model_disables_grouped_submission(tmp_path):
+    job_manager = make_task(tmp_path).htcondor_create_job_manager()
+    # the setting of the law config is kept without the resource model
+    assert job_manager.job_grouping_submit == type(job_manager).job_grouping_submit
+    task = make_task(tmp_path, htcondor_resource_model=True)
+    assert task.htcondor_create_job_manager().job_grouping_submit is False
@@ -0,0 +1,72 @@
+import fcntl
+import multiprocessing
+import os
+import time
+from contextlib import contextmanager
+
+from unpack_cache import UnpackCache, pack_tarball
+
+N_PROCESSES = 8
+
+
+def make_tarball(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "executable").write_text("payload")
+    path = str(tmp_path / "tarball.tar.gz")
+    pack_tarball(str(source), ["executable"], path)
+    return path
+
+
+def use_entry(args):
+    cache_dir, tarball, fetch_log = args
+
+    @contextmanager
+    def fetch():
+        with open(fetch_log, "a") as f:
+            f.write(f"{os.getpid()}\n")
+        # give the other processes time to pile up on the lock
+        time.sleep(0.2)
+        yield tarball
+
+    with UnpackCache(cache_dir).entry("key", fetch) as entry:
+        with open(os.path.join(entry, "executable")) as f:
+            return f.read()
+
+
+def test_concurrent_users_fetch_once(tmp_path):
+    tarball = make_tarball(tmp_path)
+    fetch_log = str(tmp_path / "fetches")
+    args = (str(tmp_path / "cache"), tarball, fetch_log)
+    with multiprocessing.get_context("fork").Pool(N_PROCESSES) as pool:
+        results = pool.map(use_entry, [args] * N_PROCESSES)
+    assert results == ["payload"] * N_PROCESSES
+    with open(fetch_log) as f:
+        assert len(f.readlines()) == 1
+    # no temporary directories are left behind
+    assert sorted(os.listdir(tmp_path / "cache")) == ["key", "key.lock", "key.size"]
+
+
+def test_entry_in_use_is_not_evicted(tmp_path):
+    tarball = make_tarball(tmp_path)
+
+    @contextmanager
+    def fetch():
+        yield tarball
+
+    cache_dir = str(tmp_path / "cache")
+    with UnpackCache(cache_dir).entry("used", fetch) as used:
+        # a quota of 0 evicts every entry that is not locked by another user
+        with UnpackCache(cache_dir, quota=0).entry("other", fetch):
+            pass
+        assert os.path.isdir(used)
+        # the shared lock of this user is still held
+        with open(os.path.join(cache_dir, "used.lock")) as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                locked = False
+            except BlockingIOError:
+                locked = True
+        assert locked
+    UnpackCache(cache_dir, quota=0).evict()
+    assert not os.path.exists(used)
@@ -0,0 +1,106 @@
+import law
+import pytest
+
+import CROWNBase
+from CROWNBase import CROWNExecuteBase
+from unpack_cache import file_adler32
+
+
+class UploadTask(CROWNExecuteBase):
+    def create_branch_map(self):
+        return {0: {}}
+
+    def output(self):
+        return self.local_target("output.root")
+
+    def run(self):
+        pass
+
+
+class FlakyTarget(law.LocalFileTarget):
+    """
+    Local target whose first `n_failures` copies raise, and whose next `n_corrupt` copies write
+    truncated files.
+    """
+
+    def __init__(self, path, n_failures=0, n_corrupt=0):
+        super().__init__(path)
+        self.n_failures = n_failures
+        self.n_corrupt = n_corrupt
+        self.copies = 0
+
+    def copy_from_local(self, src, **kwargs):
+        self.copies += 1
+        if self.copies <= self.n_failures:
+            raise IOError("connection reset")
+        result = super().copy_from_local(src, **kwargs)
+        if self.copies <= self.n_failures + self.n_corrupt:
+            with open(self.abspath, "r+b") as f:
+                f.truncate(10)
+        return result
+
+
+@pytest.fixture
+def task(tmp_path, monkeypatch):
+    monkeypatch.setattr(CROWNBase, "UPLOAD_BACKOFF_BASE", 0)
+    return UploadTask(
+        workflow="local",
+        wlcg_path="",
+        production_tag="test",
+        is_local_output=True,
+        local_output_path=str(tmp_path / "output"),
+        ENV_NAME="env",
+        htcondor_accounting_group="group",
+        htcondor_remote_job="True",
+        htcondor_walltime="3600",
+        htcondor_request_memory="2000",
+        htcondor_request_disk="2000000",
+        htcondor_universe="vanilla",
+        htcondor_container_image="image",
+        bootstrap_file="bootstrap.sh",
+        scopes=["mt"],
+        all_sample_types=["dy"],
+        all_eras=["2018"],
+        nick="upload_test",
+        sample_type="dy",
+        era="2018",
+        shifts="None",
+        analysis="tau",
+        config="config",
+        files_per_task=1,
+    )
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    path = tmp_path / "local.root"
+    path.write_bytes(b"CROWN output " * 1000)
+    return str(path)
+
+
+@pytest.mark.parametrize("n_failures, n_corrupt", [(0, 0), (1, 0), (0, 2), (1, 1)])
+def test_upload_is_retried_until_verified(
+    task, tmp_path, local_file, n_failures, n_corrupt
+):
+    target = FlakyTarget(str(tmp_path / "remote.root"), n_failures, n_corrupt)
+    (result,) = task.upload_outputs([(target, local_file)])
+    assert target.copies == n_failures + n_corrupt + 1
+    assert result["verified"] == "adler32"
+    assert result["adler32"] == file_adler32(local_file) == file_adler32(target.abspath)
+
+
+def test_corrupt_upload_is_removed(task, tmp_path, local_file):
+    target = FlakyTarget(str(tmp_path / "remote.root"), n_corrupt=3)
+    with pytest.raises(Exception, match="failed after 3 attempts"):
+        task.upload_outputs([(target, local_file)], retries=3)
+    assert target.copies == 3
+    assert not target.exists()
+
+
+def test_upload_verified_by_size(task, tmp_path, local_file, monkeypatch):
+    # servers without checksum support
+    monkeypatch.setattr(UploadTask, "target_checksum", lambda self, target: None)
+    target = FlakyTarget(str(tmp_path / "remote.root"), n_corrupt=1)
+    (result,) = task.upload_outputs([(target, local_file)])
+    assert target.copies == 2
+    assert result["verified"] == "size"